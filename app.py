@@ -1,15 +1,58 @@
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, url_for, jsonify
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
-
-from forms import UserAddForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload
+
+from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
+from models import db, connect_db, User, Message, Follows, Likes
+from pagination import Page, decode_cursor, paginate
+from hashing import HashingPoolSaturated, hasher
+import database
+import explain
+import loader
+import http_cache
+import metrics
+import partitions
+import recommendations
+import timeline
+import search
+from search import user_search
+from user_cache import user_cache
+from fragments import fragment_cache
+from write_behind import write_queue
 
 CURR_USER_KEY = "curr_user"
 
+
+class WarblerGlobals(_AppCtxGlobals):
+    """Flask's `g`, except `g.user` is only looked up when first used.
+
+    Anonymous requests and views that never touch `g.user` don't query
+    for it at all; the rest usually get it from `user_cache`.
+    """
+
+    @property
+    def user(self):
+        """The logged-in user, or None."""
+
+        if '_user' not in self.__dict__:
+            user_id = session.get(CURR_USER_KEY)
+            self._user = None if user_id is None else user_cache.get(user_id)
+
+        return self._user
+
+    @user.setter
+    def user(self, user):
+        self._user = user
+
+
 app = Flask(__name__)
+app.app_ctx_globals_class = WarblerGlobals
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
@@ -20,9 +63,30 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 100))
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 30))
+app.config['SEARCH_MAX_RESULTS'] = int(os.environ.get('SEARCH_MAX_RESULTS', 300))
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+app.config['DB_READ_STATEMENT_TIMEOUT'] = int(
+    os.environ.get('DB_READ_STATEMENT_TIMEOUT', 5000))
+# Comma-separated read replica URLs; reads stay on the primary without them.
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+app.config['REPLICA_POLICY'] = os.environ.get('REPLICA_POLICY', 'round_robin')
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+metrics.init_app(app)
+hasher.init_app(app)
+user_cache.init_app(app)
+http_cache.init_app(app, CURR_USER_KEY)
+fragment_cache.init_app(app)
+write_queue.init_app(app)
 
 
 ##############################################################################
@@ -31,13 +95,9 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """Forget any user left on `g`; `g.user` is loaded on first use."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-
-    else:
-        g.user = None
+    g.__dict__.pop('_user', None)
 
 
 def do_login(user):
@@ -104,6 +164,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # authenticate() may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -132,17 +194,35 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username or location;
+    results are ranked and paged, up to SEARCH_MAX_RESULTS in all. Without
+    'q', users are listed by id, a page at a time.
     """
 
     search = request.args.get('q')
+    per_page = app.config['USERS_PER_PAGE']
 
     if not search:
-        users = User.query.all()
+        after = request.args.get('after', 0, type=int)
+        users = (User
+                 .query
+                 .filter(User.id > after)
+                 .order_by(User.id)
+                 .limit(per_page + 1)
+                 .all())
+        next_url = (url_for('list_users', after=users[per_page - 1].id)
+                    if len(users) > per_page else None)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = max(request.args.get('page', 1, type=int), 1)
+        limit = min(page * per_page + 1, app.config['SEARCH_MAX_RESULTS'])
+        users = user_search.search(search, limit)[(page - 1) * per_page:]
+        next_url = (url_for('list_users', q=search, page=page + 1)
+                    if len(users) > per_page else None)
 
-    return render_template('users/index.html', users=users)
+    users = users[:per_page]
+    following = g.user.following_status(u.id for u in users) if g.user else set()
+    return render_template('users/index.html', users=users,
+                           following=following, next_url=next_url)
 
 
 @app.route('/users/<int:user_id>')
@@ -151,40 +231,113 @@ def users_show(user_id):
 
     user = User.query.get_or_404(user_id)
 
+    # Everything an anonymous visitor sees comes from this row, bar the
+    # messages: a delete then a post leaves the counters as they were,
+    # but not the newest message (one seek on its index).
+    before = request.args.get('before')
+    newest = (db.session.query(Message.timestamp, Message.id)
+              .filter(Message.user_id == user_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .first())
+    etag = http_cache.etag('user', user.id, user.version, user.message_count,
+                           user.following_count, user.follower_count,
+                           user.likes_count, newest, before)
+    if http_cache.is_fresh(etag):
+        return http_cache.not_modified(etag)
+
     # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    likes = [message.id for message in user.likes]
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    # user.messages won't be in order by default. Every message's author
+    # is `user`, already in the session, so `message.user` costs no query.
+    messages = paginate(Message.query.filter(Message.user_id == user_id),
+                        Message.timestamp, Message.id,
+                        before=decode_cursor(before),
+                        per_page=app.config['MESSAGES_PER_PAGE'])
+    likes = (g.user.liked_among(message.id for message in messages)
+             if g.user else set())
+    return http_cache.cacheable(
+        render_template('users/show.html', user=user, messages=messages,
+                        likes=likes, next_cursor=messages.next_cursor),
+        etag)
 
 
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following, newest follow first."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    before = decode_cursor(request.args.get('before'))
+    followed_users = follow_page(Follows.user_following_id,
+                                 Follows.user_being_followed_id,
+                                 user.id, before)
+    if user.id == g.user.id:
+        followed_users = with_pending_follows(user, followed_users, before)
+    following = g.user.following_status(u.id for u in followed_users)
+    return render_template('users/following.html', user=user,
+                           followed_users=followed_users, following=following,
+                           next_cursor=followed_users.next_cursor)
 
 
 @app.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user, newest follow first."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers = follow_page(Follows.user_being_followed_id,
+                            Follows.user_following_id,
+                            user.id, decode_cursor(request.args.get('before')))
+    following = g.user.following_status(u.id for u in followers)
+    return render_template('users/followers.html', user=user,
+                           followers=followers, following=following,
+                           next_cursor=followers.next_cursor)
+
+
+# Just what a user card shows -- not the whole row.
+USER_CARD_COLUMNS = (User.id, User.username, User.image_url,
+                     User.header_image_url, User.bio)
+
+
+def follow_page(user_col, other_col, user_id, before):
+    """One page of the users at the `other_col` end of `user_id`'s follows.
+
+    With `user_col` the follower, that's who they follow; the other way
+    round, their followers. Newest follow first.
+    """
+
+    query = (db.session
+             .query(*USER_CARD_COLUMNS, Follows.created_at)
+             .join(Follows, other_col == User.id)
+             .filter(user_col == user_id))
+    return paginate(query, Follows.created_at, other_col, before=before,
+                    per_page=app.config['USERS_PER_PAGE'],
+                    key=lambda row: (row.created_at, row.id))
+
+
+def with_pending_follows(user, followed_users, before):
+    """A page of `followed_users` as it will be once `user`'s queued
+    follows and unfollows (see write_behind.py) are written."""
+
+    pending = write_queue.pending('follow', user.id)
+    if not pending:
+        return followed_users
+
+    items = [u for u in followed_users if pending.get(u.id, True)]
+    shown = {u.id for u in items}
+    added = [id for id, state in pending.items() if state and id not in shown]
+    # New follows are the newest, so they belong on the first page.
+    if added and before is None:
+        items = (db.session
+                 .query(*USER_CARD_COLUMNS)
+                 .filter(User.id.in_(added))
+                 .all()) + items
+    return Page(items, followed_users.next_cursor)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -196,8 +349,14 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    if write_queue.enabled:
+        write_queue.enqueue('follow', g.user.id, followed_user.id, True)
+    else:
+        db.session.add(Follows(user_being_followed_id=followed_user.id,
+                               user_following_id=g.user.id))
+        db.session.flush()
+        timeline.backfill(g.user.id, followed_user.id)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -210,43 +369,139 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    if write_queue.enabled:
+        if follow_id not in g.user.following_status([follow_id]):
+            abort(404)
+        write_queue.enqueue('follow', g.user.id, follow_id, False)
+    else:
+        follow = Follows.query.get_or_404((follow_id, g.user.id))
+        db.session.delete(follow)
+        timeline.remove_author(g.user.id, follow_id)
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 #show_likes route
 @app.route('/users/<int:user_id>/likes', methods=["GET"])
 def show_likes(user_id):
+    """Show the messages this user has liked."""
+
     if not g.user:
         flash("Access unauthorized.", 'danger')
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user, likes=user.likes)
+    messages = paginate((Message
+                         .query
+                         .options(joinedload(Message.user))
+                         .join(Likes, Likes.message_id == Message.id)
+                         .filter(Likes.user_id == user_id)),
+                        Message.timestamp, Message.id,
+                        before=decode_cursor(request.args.get('before')),
+                        per_page=app.config['MESSAGES_PER_PAGE'])
+    return render_template('users/likes.html', user=user, messages=messages,
+                           next_cursor=messages.next_cursor)
 
 #add_like route
 @app.route('/messages/<int:message_id>/like', methods=['POST'])
 def add_like(message_id):
-    """Toggle a liked message for users that are currently logged in"""
+    """Toggle a liked message for users that are currently logged in.
+
+    The like buttons send the state they want in `liked` ("1" or "0"),
+    so a resubmitted form can't undo itself.
+    """
 
     if not g.user:
         flash("Access unauthorized.", 'danger')
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    if liked_message.user_id == g.user.id:
-        return abort(403)
+    author_id = (db.session.query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+    if author_id is None:
+        abort(404)
+    if author_id == g.user.id:
+        abort(403)
+
+    want = request.form.get('liked')
+    if write_queue.enabled:
+        if want is None:
+            liked = message_id not in g.user.liked_among([message_id])
+        else:
+            liked = want == '1'
+        write_queue.enqueue('like', g.user.id, message_id, liked)
+    elif want is None:
+        Likes.toggle(g.user.id, message_id)
+        db.session.commit()
+    else:
+        Likes.set(g.user.id, message_id, want == '1')
+        db.session.commit()
+
+    return redirect(request.referrer or "/")
+
+
+@app.route('/api/messages/<int:message_id>/like', methods=['POST'])
+def api_like(message_id):
+    """Like or unlike a message; answers with its new state as JSON.
 
-    if liked_message in g.user.likes:
-        g.user.likes.remove(liked_message)
+    A JSON body of `{"liked": true|false}` sets the state (safe to
+    retry); with no body it's a toggle.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    author_id = (db.session.query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+    if author_id is None:
+        return jsonify(error="No such message."), 404
+    if author_id == g.user.id:
+        return jsonify(error="You can't like your own warble."), 403
+
+    body = request.get_json(silent=True) or {}
+    if write_queue.enabled:
+        liked, count = queue_like(message_id, body.get('liked'))
+    elif 'liked' in body:
+        liked, count = Likes.set(g.user.id, message_id, bool(body['liked']))
     else:
-        g.user.likes.append(liked_message)
-        
+        liked, count = Likes.toggle(g.user.id, message_id)
     db.session.commit()
 
-    return redirect("/")
+    return jsonify(message_id=message_id, liked=liked, likes_count=count)
+
+
+@app.route('/api/users/recommendations')
+def api_recommendations():
+    """Accounts the logged-in user might follow, best first, as JSON.
+
+    Precomputed by `flask recommend`; `?limit=` caps how many.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    limit = request.args.get('limit', recommendations.TOP_K, type=int)
+    limit = max(0, min(limit, recommendations.TOP_K))
+
+    return jsonify(recommendations=[
+        dict(row._mapping)
+        for row in recommendations.for_user(g.user.id, limit)])
+
+
+def queue_like(message_id, liked=None):
+    """Queue a like (or unlike, or with `liked` None a toggle) for
+    `g.user`. Returns `(liked, likes_count)`, the count being what it
+    will be once the queue catches up."""
+
+    in_db = Likes.query.filter_by(user_id=g.user.id,
+                                  message_id=message_id).count()
+    if liked is None:
+        liked = message_id not in g.user.liked_among([message_id])
+    liked = bool(liked)
+
+    write_queue.enqueue('like', g.user.id, message_id, liked)
+    return liked, Likes._count(message_id) + liked - in_db
 
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
@@ -257,7 +512,9 @@ def profile():
         flash("Access unauthorized.", 'danger')
         return redirect("/")
 
-    user = g.user
+    # g.user may be a cached snapshot up to USER_CACHE_TTL old; the
+    # password check and the edit need the row as it is now.
+    user = User.query.populate_existing().get(g.user.id)
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
@@ -269,6 +526,7 @@ def profile():
             user.bio = form.bio.data
 
             db.session.commit()
+            user_cache.invalidate(user.id)
             return redirect(f"/users/{user.id}")
 
         flash("Wrong password, please try again.", 'danger')
@@ -286,8 +544,10 @@ def delete_user():
 
     do_logout()
 
+    user_id = g.user.id
     db.session.delete(g.user)
     db.session.commit()
+    user_cache.invalidate(user_id)
 
     return redirect("/signup")
 
@@ -311,6 +571,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        timeline.fan_out(msg)
+        search.index_message(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -322,8 +585,28 @@ def messages_add():
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.query.get_or_404(message_id)
+
+    etag = http_cache.etag('message', msg.id, msg.version, msg.user.version)
+    if http_cache.is_fresh(etag):
+        return http_cache.not_modified(etag)
+
+    return http_cache.cacheable(
+        render_template('messages/show.html', message=msg), etag)
+
+
+@app.route('/messages/search')
+def messages_search():
+    """Full-text search over messages, most relevant first."""
+
+    q = request.args.get('q', '')
+    messages = search.search_messages(
+        q,
+        before=decode_cursor(request.args.get('before')),
+        per_page=app.config['MESSAGES_PER_PAGE'])
+
+    return render_template('messages/search.html', q=q, messages=messages,
+                           next_cursor=messages.next_cursor)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -339,6 +622,8 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    timeline.remove_message(msg.id)
+    search.unindex_message(msg)
     db.session.delete(msg)
     db.session.commit()
 
@@ -354,22 +639,20 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
 
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-        
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages = timeline.home_messages(
+            g.user,
+            before=decode_cursor(request.args.get('before')),
+            per_page=app.config['MESSAGES_PER_PAGE'])
 
-        liked_msg_ids = [msg.id for msg in g.user.likes]
+        likes = g.user.liked_among(msg.id for msg in messages)
 
-        return render_template('home.html', messages=messages, likes=liked_msg_ids)
+        return render_template('home.html', messages=messages,
+                               likes=likes,
+                               next_cursor=messages.next_cursor)
 
     else:
         return render_template('home-anon.html')
@@ -381,19 +664,137 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@app.errorhandler(HashingPoolSaturated)
+def hashing_busy(e):
+    """Too many logins/signups in flight: shed load instead of queueing."""
+
+    return ("We're very busy right now; please try again in a moment.",
+            503, {"Retry-After": "1"})
+
+
+@app.errorhandler(OperationalError)
+def database_timeout(e):
+    """A query ran past its statement timeout: answer 503, not 500."""
+
+    if not database.is_statement_timeout(e):
+        raise e
+    db.session.rollback()
+    return ("That took too long; please try again in a moment.",
+            503, {"Retry-After": "1"})
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands
+
+
+@app.cli.command()
+def recount():
+    """Reconcile the denormalized counters on users and messages."""
+
+    User.recount()
+    Message.recount()
+    db.session.commit()
+
+
+@app.cli.command('reindex-messages')
+def reindex_messages():
+    """Rebuild the full-text index over all messages."""
+
+    search.reindex_messages()
+    db.session.commit()
+
+
+@app.cli.command('trim-timelines')
+def trim_timelines():
+    """Cut home timelines back to their length (run from cron)."""
+
+    click.echo(f"removed {timeline.trim_all():,} timeline entries")
+
+
+@app.cli.command('load-data')
+@click.option('--data-dir', default='generator',
+              help='Directory holding users.csv, messages.csv, ...')
+@click.option('--chunk-rows', default=loader.CHUNK_ROWS,
+              help='Rows per COPY/insert batch (and per commit).')
+@click.option('--fresh', is_flag=True,
+              help='Ignore earlier progress and load everything again.')
+def load_data(data_dir, chunk_rows, fresh):
+    """Bulk-load CSV data, resuming an interrupted load by default."""
+
+    loader.load(data_dir, chunk_rows=chunk_rows, fresh=fresh)
+
+
+@app.cli.command('explain')
+@click.option('--min-rows', default=explain.MIN_ROWS,
+              help="Ignore sequential scans of tables smaller than this.")
+def explain_routes(min_rows):
+    """EXPLAIN each page's queries and flag sequential scans."""
+
+    if explain.check(app, CURR_USER_KEY, min_rows=min_rows):
+        raise SystemExit(1)
+
+
+@app.cli.command('flush-writes')
+def flush_writes():
+    """Write every queued follow and like to the database now."""
+
+    click.echo(f"applied {write_queue.flush():,} queued writes")
+
+
+@app.cli.command('pool-status')
+def pool_status():
+    """Show pool capacity against the server's max_connections."""
+
+    for key, value in database.pool_status(db.engine).items():
+        click.echo(f"{key}: {value}")
+
+
+@app.cli.command('partition-messages')
+@click.option('--months-ahead', default=partitions.MONTHS_AHEAD,
+              help='Future months to create partitions for.')
+def partition_messages(months_ahead):
+    """Convert messages to a table partitioned by month (Postgres)."""
+
+    partitions.partition_messages(months_ahead)
+    db.session.commit()
+    click.echo(f"{len(partitions.partition_names())} monthly partitions")
+
+
+@app.cli.command('add-partitions')
+@click.option('--months-ahead', default=partitions.MONTHS_AHEAD,
+              help='Future months to create partitions for.')
+def add_partitions(months_ahead):
+    """Create the coming months' message partitions; run monthly."""
+
+    if not partitions.is_partitioned():
+        raise click.ClickException("messages isn't partitioned; "
+                                   "see `flask partition-messages`")
+
+    now = datetime.utcnow()
+    for name in partitions.ensure_partitions(now, now, months_ahead):
+        click.echo(f"created {name}")
+    db.session.commit()
+
+
+@app.cli.command('drop-partitions')
+@click.option('--before', required=True, type=click.DateTime(['%Y-%m']),
+              help='Remove the months before this one (YYYY-MM).')
+@click.option('--archive', is_flag=True,
+              help='Detach the partitions but keep their tables.')
+def drop_partitions(before, archive):
+    """Remove old months of messages, a partition at a time."""
+
+    for name in partitions.drop_partitions(before, archive):
+        click.echo(f"{'detached' if archive else 'dropped'} {name}")
+    db.session.commit()
+
+
+@app.cli.command('recommend')
+@click.option('--top-k', default=recommendations.TOP_K,
+              help='Suggestions to keep per user.')
+@click.option('--workers', type=int, default=None,
+              help='Scoring processes (default: one per CPU).')
+def recommend(top_k, workers):
+    """Recompute "who to follow" recommendations from the follow graph."""
+
+    recommendations.rebuild(top_k=top_k, workers=workers)
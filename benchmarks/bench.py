@@ -0,0 +1,447 @@
+"""Load-test Warbler's main routes and keep the numbers.
+
+Run from the project root:
+
+    # build a dataset (generator CSVs -> loader) in a throwaway database
+    python benchmarks/bench.py seed --database postgresql:///warbler-bench \\
+        --users 10000 --messages 100000 --follows 500000
+
+    # drive it with 16 concurrent clients for 60s; writes a JSON result
+    python benchmarks/bench.py run --database postgresql:///warbler-bench \\
+        --concurrency 16 --duration 60
+
+    # what changed between two runs?
+    python benchmarks/bench.py compare benchmarks/results/a.json \\
+        benchmarks/results/b.json
+
+The app is served by a threaded werkzeug server on localhost and each
+client thread logs in as its own user (by signing a session cookie, so
+bcrypt doesn't skew the numbers). Every request's latency is measured
+at the client; the query count comes from the `Server-Timing` header
+the app adds. Redirects aren't followed, so each route is timed alone.
+
+`seed` and `run` use the same `--seed`, so two runs against the same
+dataset send the same sequence of requests.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+# Relative weight of each scenario in the request mix.
+MIX = {
+    'home': 30,
+    'user_show': 20,
+    'user_search': 15,
+    'message_new': 10,
+    'follow_unfollow': 10,
+    'like_toggle': 15,
+}
+
+# A route whose p95 grows by more than this fraction counts as a regression.
+REGRESSION_THRESHOLD = 0.10
+
+# Averages wobble when a route's branches mix differently between runs.
+QUERY_TOLERANCE = 0.5
+
+QUERIES_RE = re.compile(r'desc="(\d+) queries"')
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+
+    if not sorted_values:
+        return None
+    rank = math.ceil(p / 100 * len(sorted_values)) - 1
+    return sorted_values[max(0, rank)]
+
+
+def load_app(database):
+    """Import the app against `database`, set up for benchmarking."""
+
+    os.environ['DATABASE_URL'] = database
+    sys.path.insert(0, ROOT)
+
+    from app import app
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['SERVER_TIMING_HEADER'] = True
+    app.debug = False
+    return app
+
+
+##############################################################################
+# Dataset
+
+
+def seed(args):
+    """Generate CSVs of the requested size and bulk-load them."""
+
+    app = load_app(args.database)
+    sys.path.insert(0, os.path.join(ROOT, 'generator'))
+
+    import create_csvs
+    import loader
+    from models import db
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        jobs = [
+            (create_csvs.write_users, 'users.csv', args.users),
+            (create_csvs.write_messages, 'messages.csv', args.messages,
+             args.users),
+            (create_csvs.write_follows, 'follows.csv', args.follows,
+             args.users),
+        ]
+        if args.likes:
+            jobs.append((create_csvs.write_likes, 'likes.csv', args.likes,
+                         args.users, args.messages))
+
+        for fn, filename, *fn_args in jobs:
+            fn(os.path.join(data_dir, filename), *fn_args, args.seed)
+
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            loader.load(data_dir, fresh=True)
+
+
+##############################################################################
+# Load generation
+
+
+class Client:
+    """One simulated user, with its own connection and session cookie."""
+
+    def __init__(self, host, port, cookie, user_id, plan, rng):
+        self.conn = HTTPConnection(host, port)
+        self.cookie = cookie
+        self.user_id = user_id
+        self.plan = plan
+        self.rng = rng
+
+    def request(self, method, path, form=None):
+        headers = {'Cookie': f'session={self.cookie}'}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        started = time.perf_counter()
+        self.conn.request(method, path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        response.read()
+        elapsed = time.perf_counter() - started
+
+        match = QUERIES_RE.search(response.getheader('Server-Timing') or '')
+        queries = int(match.group(1)) if match else None
+        return response.status, elapsed, queries
+
+    def home(self):
+        yield 'GET /', self.request('GET', '/')
+
+    def user_show(self):
+        user_id = self.rng.choice(self.plan['user_ids'])
+        yield 'GET /users/<id>', self.request('GET', f'/users/{user_id}')
+
+    def user_search(self):
+        q = self.rng.choice(self.plan['search_terms'])
+        yield 'GET /users?q=', self.request('GET', '/users?' + urlencode({'q': q}))
+
+    def message_new(self):
+        text = f"benchmark warble {self.rng.getrandbits(32):08x}"
+        yield 'POST /messages/new', self.request('POST', '/messages/new',
+                                                 {'text': text})
+
+    def follow_unfollow(self):
+        targets = self.plan['follow_targets'][self.user_id]
+        if not targets:
+            return
+        target = self.rng.choice(targets)
+        yield ('POST /users/follow/<id>',
+               self.request('POST', f'/users/follow/{target}', {}))
+        yield ('POST /users/stop-following/<id>',
+               self.request('POST', f'/users/stop-following/{target}', {}))
+
+    def like_toggle(self):
+        message_id = self.rng.choice(self.plan['like_targets'][self.user_id])
+        yield ('POST /messages/<id>/like',
+               self.request('POST', f'/messages/{message_id}/like', {}))
+
+
+def plan_run(app, concurrency, rng):
+    """Pick the users to act as, and safe targets for each of them."""
+
+    from models import db, User, Message, Follows
+
+    with app.app_context():
+        user_ids = [id for id, in db.session.query(User.id).order_by(User.id)]
+        if len(user_ids) < concurrency + 1:
+            raise SystemExit("Need more seeded users than --concurrency.")
+
+        actors = rng.sample(user_ids, concurrency)
+        sample_ids = rng.sample(user_ids, min(len(user_ids), 1000))
+
+        search_terms = [username[:3] for username, in
+                        db.session.query(User.username)
+                        .filter(User.id.in_(sample_ids[:100]))]
+
+        messages = (db.session.query(Message.id, Message.user_id)
+                    .order_by(Message.id.desc())
+                    .limit(5000)
+                    .all())
+
+        follow_targets, like_targets = {}, {}
+        for actor in actors:
+            following = {id for id, in db.session
+                         .query(Follows.user_being_followed_id)
+                         .filter(Follows.user_following_id == actor)}
+            follow_targets[actor] = [id for id in sample_ids
+                                     if id != actor and id not in following]
+            like_targets[actor] = [id for id, author in messages
+                                   if author != actor]
+
+    return {
+        'actors': actors,
+        'user_ids': sample_ids,
+        'search_terms': search_terms,
+        'follow_targets': follow_targets,
+        'like_targets': like_targets,
+    }
+
+
+def session_cookie(app, user_id):
+    from app import CURR_USER_KEY
+
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({CURR_USER_KEY: user_id})
+
+
+def drive(client, deadline, samples, lock):
+    scenarios = list(MIX)
+    weights = [MIX[name] for name in scenarios]
+    local = []
+
+    while time.perf_counter() < deadline:
+        scenario = client.rng.choices(scenarios, weights)[0]
+        local.extend(getattr(client, scenario)())
+
+    with lock:
+        samples.extend(local)
+
+
+def summarize(samples, elapsed):
+    by_route = defaultdict(list)
+    for route, result in samples:
+        by_route[route].append(result)
+
+    routes = {}
+    for route, results in sorted(by_route.items()):
+        latencies = sorted(seconds * 1000 for _, seconds, _ in results)
+        queries = [count for _, _, count in results if count is not None]
+        routes[route] = {
+            'requests': len(results),
+            'errors': sum(1 for status, _, _ in results if status >= 400),
+            'throughput_rps': round(len(results) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'p99_ms': round(percentile(latencies, 99), 2),
+            'queries_per_request': (round(sum(queries) / len(queries), 2)
+                                    if queries else None),
+        }
+
+    return {
+        'requests': len(samples),
+        'throughput_rps': round(len(samples) / elapsed, 2),
+        'routes': routes,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Serve the app, drive it for `--duration` seconds, save the results."""
+
+    from werkzeug.serving import make_server
+
+    app = load_app(args.database)
+    rng = random.Random(args.seed)
+    plan = plan_run(app, args.concurrency, rng)
+
+    from models import db, User, Message, Follows
+    with app.app_context():
+        dataset = {
+            'users': User.query.count(),
+            'messages': Message.query.count(),
+            'follows': Follows.query.count(),
+        }
+        dialect = db.engine.dialect.name
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    clients = [Client('127.0.0.1', server.server_port,
+                      session_cookie(app, actor), actor, plan,
+                      random.Random(f'{args.seed}:{actor}'))
+               for actor in plan['actors']]
+
+    if args.warmup:
+        drive_all(clients, args.warmup)
+    samples, elapsed = drive_all(clients, args.duration)
+    server.shutdown()
+
+    result = {
+        'started_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'database': dialect,
+        'dataset': dataset,
+        'concurrency': args.concurrency,
+        'duration_s': round(elapsed, 2),
+        'seed': args.seed,
+        **summarize(samples, elapsed),
+    }
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{result['started_at'].replace(':', '')}"
+                     f"-{result['revision'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    print_summary(result)
+    print(f"\nSaved {output}")
+
+
+def drive_all(clients, duration):
+    samples, lock = [], threading.Lock()
+    started = time.perf_counter()
+    deadline = started + duration
+
+    threads = [threading.Thread(target=drive,
+                                args=(client, deadline, samples, lock))
+               for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return samples, time.perf_counter() - started
+
+
+##############################################################################
+# Reporting
+
+
+def print_summary(result):
+    print(f"{result['requests']:,} requests in {result['duration_s']}s "
+          f"({result['throughput_rps']} req/s), "
+          f"{result['concurrency']} clients, {result['database']}")
+    print(f"{'route':34} {'reqs':>7} {'err':>5} {'p50':>8} {'p95':>8} "
+          f"{'p99':>8} {'queries':>8}")
+    for route, stats in result['routes'].items():
+        print(f"{route:34} {stats['requests']:>7} {stats['errors']:>5} "
+              f"{stats['p50_ms']:>8} {stats['p95_ms']:>8} {stats['p99_ms']:>8} "
+              f"{stats['queries_per_request'] if stats['queries_per_request'] is not None else '-':>8}")
+
+
+def compare(args):
+    """Diff two result files; exit 1 if any route regressed."""
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    regressions = []
+    print(f"{'route':34} {'p95 before':>11} {'p95 after':>10} {'change':>8} "
+          f"{'queries':>9}")
+
+    for route, after in candidate['routes'].items():
+        before = baseline['routes'].get(route)
+        if before is None:
+            print(f"{route:34} {'-':>11} {after['p95_ms']:>10} {'new':>8}")
+            continue
+
+        # A p95 that rounded to 0 has no relative change to speak of.
+        change = None
+        if before['p95_ms']:
+            change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms']
+        queries = f"{before['queries_per_request']}->{after['queries_per_request']}"
+        flag = ''
+        extra_queries = ((after['queries_per_request'] or 0)
+                         - (before['queries_per_request'] or 0))
+        if ((change is not None and change > args.threshold)
+                or extra_queries > QUERY_TOLERANCE):
+            regressions.append(route)
+            flag = '  REGRESSED'
+
+        shown = 'n/a' if change is None else f"{change:+.1%}"
+        print(f"{route:34} {before['p95_ms']:>11} {after['p95_ms']:>10} "
+              f"{shown:>8} {queries:>9}{flag}")
+
+    if regressions:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    database = os.environ.get('DATABASE_URL', 'postgresql:///warbler-bench')
+
+    seed_parser = commands.add_parser('seed', help=seed.__doc__)
+    seed_parser.add_argument('--database', default=database)
+    seed_parser.add_argument('--users', type=int, default=1000)
+    seed_parser.add_argument('--messages', type=int, default=10000)
+    seed_parser.add_argument('--follows', type=int, default=20000)
+    seed_parser.add_argument('--likes', type=int, default=20000)
+    seed_parser.add_argument('--seed', type=int, default=0)
+    seed_parser.set_defaults(fn=seed)
+
+    run_parser = commands.add_parser('run', help=run.__doc__)
+    run_parser.add_argument('--database', default=database)
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--duration', type=float, default=30)
+    run_parser.add_argument('--warmup', type=float, default=5)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output')
+    run_parser.set_defaults(fn=run)
+
+    compare_parser = commands.add_parser('compare', help=compare.__doc__)
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--threshold', type=float,
+                                default=REGRESSION_THRESHOLD)
+    compare_parser.set_defaults(fn=compare)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""Small key/value caches for Warbler.
+
+Anything that quacks like a cache here has `get(key)`, `set(key, value,
+ttl=None)`, `delete(key)` and `clear()`. `LRUCache` is the in-process
+implementation; a shared store (memcached, redis, ...) can be plugged in
+behind it with `TieredCache` by wrapping its client in the same four
+methods.
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache:
+    """Thread-safe in-process cache with LRU eviction and optional TTL."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = monotonic() + ttl if ttl else None
+
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TieredCache:
+    """An in-process cache in front of a shared one.
+
+    Reads try `local` first and fill it from `shared` on a miss; writes
+    and deletes go to both.
+    """
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key, default=None):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        value = self.shared.get(key)
+        if value is None:
+            return default
+
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.shared.set(key, value, ttl=ttl)
+        self.local.set(key, value, ttl=ttl)
+
+    def delete(self, key):
+        self.shared.delete(key)
+        self.local.delete(key)
+
+    def clear(self):
+        self.shared.clear()
+        self.local.clear()
@@ -0,0 +1,387 @@
+"""Connection pool settings and health for Warbler's database engine.
+
+`configure(app)` (called by `models.connect_db`) turns the `DB_*`
+config keys into SQLAlchemy engine options:
+
+- `DB_POOL_SIZE` / `DB_MAX_OVERFLOW`: connections kept open, and how
+  many more may be opened under load. Each worker process has its own
+  pool, so `workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)` has to stay
+  under Postgres' `max_connections` (`flask pool-status` does the sum).
+- `DB_POOL_TIMEOUT`: seconds to wait for a free connection before
+  giving up with a `TimeoutError`.
+- `DB_POOL_RECYCLE`: replace connections older than this many seconds,
+  so a proxy or firewall never cuts one off under us.
+- `DB_POOL_PRE_PING`: test each connection as it's checked out and
+  transparently replace dead ones (after a failover, say).
+- `DB_STATEMENT_TIMEOUT`: milliseconds any statement may run (0: no
+  limit).
+- `DB_READ_STATEMENT_TIMEOUT`: a tighter limit for GET and HEAD
+  requests, set with `SET LOCAL` at the start of each of their
+  transactions. Page views shouldn't run long queries; if one does,
+  it's cancelled and the user gets a 503 instead of tying up a
+  connection.
+
+Pool utilization and checkout wait time are published on /metrics.
+
+Read replicas
+-------------
+
+With `SQLALCHEMY_REPLICA_URIS` set, `RoutingSession` sends the SELECTs
+of GET and HEAD requests to a replica, picked per request by
+`REPLICA_POLICY` (`round_robin` or `least_connections`). Everything
+else -- writes, flushes, `SELECT ... FOR UPDATE`, raw SQL, anything
+outside a request -- goes to the primary.
+
+After a user's own POST (or any other write method), their requests
+stick to the primary for `REPLICA_STICKY_SECONDS`, so they see what
+they just did even if the replicas are behind.
+
+Replicas are probed at most every `REPLICA_CHECK_INTERVAL` seconds. One
+that can't be reached, or is more than `REPLICA_MAX_LAG` seconds
+behind, is left out until a later probe passes; a connection error on
+a replica takes it out straight away. With no healthy replica, reads go
+to the primary. Keep `REPLICA_MAX_LAG` below `REPLICA_STICKY_SECONDS`,
+or the sticky window can end before the replicas have caught up.
+"""
+
+import itertools
+import threading
+import weakref
+from time import monotonic, perf_counter, time
+
+from flask import current_app, has_request_context, request
+from flask import session as flask_session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
+
+from metrics import REGISTRY
+
+READ_METHODS = ('GET', 'HEAD')
+
+# Flask session key: reads go to the primary until this time.
+STICKY_KEY = '_primary_until'
+
+# Seconds a replica is behind; 0 when it has replayed all it has received.
+REPLICA_LAG_SQL = """
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+       END
+"""
+
+# Postgres' SQLSTATE for a statement cancelled by statement_timeout.
+QUERY_CANCELED = '57014'
+
+checkout_wait_seconds = REGISTRY.histogram(
+    'warbler_db_pool_wait_seconds',
+    'Time spent waiting for a database connection from the pool.',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+
+checkout_timeouts = REGISTRY.counter(
+    'warbler_db_pool_timeouts_total',
+    'Requests for a connection that gave up waiting.')
+
+_pools = weakref.WeakSet()
+
+
+class TimedQueuePool(QueuePool):
+    """A `QueuePool` that records how long checkouts wait."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _pools.add(self)
+
+    def _do_get(self):
+        started = perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            checkout_timeouts.inc()
+            raise
+        finally:
+            checkout_wait_seconds.observe(perf_counter() - started)
+
+    def dispose(self):
+        super().dispose()
+        # Engine.dispose() replaces us with a fresh pool.
+        _pools.discard(self)
+
+    def capacity(self):
+        """Most connections this pool will open at once."""
+
+        return self.size() + max(self._max_overflow, 0)
+
+
+def _pool_connections():
+    in_use = idle = capacity = 0
+    for pool in list(_pools):
+        in_use += pool.checkedout()
+        idle += pool.checkedin()
+        capacity += pool.capacity()
+    return {('in_use',): in_use, ('idle',): idle, ('capacity',): capacity}
+
+
+routed_statements = REGISTRY.counter(
+    'warbler_db_routed_statements_total',
+    'Statements by the database they were sent to.',
+    labels=('target',))
+
+replica_healthy = REGISTRY.gauge(
+    'warbler_db_replica_healthy',
+    'Whether a replica is currently taking reads (1) or not (0).',
+    labels=('replica',))
+
+REGISTRY.gauge('warbler_db_pool_connections',
+               'Pooled database connections, by state; in_use / capacity '
+               'is utilization.',
+               labels=('state',),
+               function=_pool_connections)
+
+
+def configure(app):
+    """Set pool defaults and build `SQLALCHEMY_ENGINE_OPTIONS` from them."""
+
+    app.config.setdefault('DB_POOL_SIZE', 5)
+    app.config.setdefault('DB_MAX_OVERFLOW', 10)
+    app.config.setdefault('DB_POOL_TIMEOUT', 30)
+    app.config.setdefault('DB_POOL_RECYCLE', 1800)
+    app.config.setdefault('DB_POOL_PRE_PING', True)
+    app.config.setdefault('DB_STATEMENT_TIMEOUT', 0)
+    app.config.setdefault('DB_READ_STATEMENT_TIMEOUT', 5000)
+    app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+    app.config.setdefault('REPLICA_POLICY', 'round_robin')
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+    app.config.setdefault('REPLICA_MAX_LAG', 2)
+    app.config.setdefault('REPLICA_CHECK_INTERVAL', 5)
+
+    # Anything set in SQLALCHEMY_ENGINE_OPTIONS directly wins.
+    options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    for key, value in engine_options(app.config).items():
+        options.setdefault(key, value)
+
+    if not event.contains(Session, 'after_begin', _read_statement_timeout):
+        event.listen(Session, 'after_begin', _read_statement_timeout)
+
+    replicas.init_app(app)
+    app.after_request(_stick_to_primary)
+
+
+def engine_options(config, url=None):
+    """`create_engine` options for the database at `url` (by default
+    SQLALCHEMY_DATABASE_URI) from the `DB_*` settings in `config`."""
+
+    url = make_url(url or config['SQLALCHEMY_DATABASE_URI'])
+    options = {'pool_pre_ping': config['DB_POOL_PRE_PING']}
+
+    # SQLite uses its own pools, which take none of these.
+    if url.get_backend_name() == 'sqlite':
+        return options
+
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+        pool_recycle=config['DB_POOL_RECYCLE'],
+    )
+
+    if (url.get_backend_name() == 'postgresql'
+            and config['DB_STATEMENT_TIMEOUT']):
+        options['connect_args'] = {
+            'options': f"-c statement_timeout={int(config['DB_STATEMENT_TIMEOUT'])}",
+        }
+
+    return options
+
+
+def _read_statement_timeout(session, transaction, connection):
+    """Cap statement time for the rest of a read request's transaction."""
+
+    if not (has_request_context() and request.method in READ_METHODS):
+        return
+    if connection.dialect.name != 'postgresql':
+        return
+
+    timeout = current_app.config.get('DB_READ_STATEMENT_TIMEOUT')
+    if timeout:
+        connection.exec_driver_sql(
+            f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+def is_statement_timeout(error):
+    """Was this DBAPIError caused by a statement timeout?"""
+
+    return getattr(error.orig, 'pgcode', None) == QUERY_CANCELED
+
+
+def pool_status(engine):
+    """Pool capacity against what the server allows, for sizing workers."""
+
+    pool = engine.pool
+    status = {
+        'pool_capacity': (pool.capacity() if isinstance(pool, TimedQueuePool)
+                          else None),
+        'checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+    }
+
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            status['max_connections'] = int(
+                conn.exec_driver_sql("SHOW max_connections").scalar())
+            status['reserved_connections'] = int(
+                conn.exec_driver_sql(
+                    "SHOW superuser_reserved_connections").scalar())
+            status['server_connections'] = conn.exec_driver_sql(
+                "SELECT count(*) FROM pg_stat_activity "
+                "WHERE datname = current_database()").scalar()
+
+        if status['pool_capacity']:
+            available = (status['max_connections']
+                         - status['reserved_connections'])
+            status['max_workers'] = available // status['pool_capacity']
+
+    return status
+
+
+##############################################################################
+# Read replicas
+
+
+class ReplicaSet:
+    """The replica engines, and which of them are fit to take reads."""
+
+    POLICIES = ('round_robin', 'least_connections')
+
+    def __init__(self):
+        self.engines = []
+        self.policy = 'round_robin'
+        self.max_lag = 2
+        self.check_interval = 5
+        self._next = itertools.count()
+        self._healthy = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        if app.config['REPLICA_POLICY'] not in self.POLICIES:
+            raise ValueError(f"REPLICA_POLICY must be one of {self.POLICIES}")
+
+        for engine in self.engines:
+            engine.dispose()
+            _pools.discard(engine.pool)
+
+        self.policy = app.config['REPLICA_POLICY']
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_CHECK_INTERVAL']
+        self.engines = [create_engine(url, **engine_options(app.config, url))
+                        for url in app.config['SQLALCHEMY_REPLICA_URIS']]
+        self._next = itertools.count()
+        self._healthy = {}
+        self._checked = {}
+
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._on_error)
+
+    def choose(self):
+        """A healthy replica engine, or None to use the primary."""
+
+        self._check_due()
+
+        healthy = [engine for engine in self.engines if self._healthy.get(engine)]
+        if not healthy:
+            return None
+        if self.policy == 'least_connections':
+            return min(healthy, key=lambda engine: engine.pool.checkedout())
+        return healthy[next(self._next) % len(healthy)]
+
+    def mark_down(self, engine):
+        self._healthy[engine] = False
+        replica_healthy.set(0, self.name(engine))
+
+    @staticmethod
+    def name(engine):
+        return engine.url.render_as_string(hide_password=True)
+
+    def _check_due(self):
+        now = monotonic()
+        due = [engine for engine in self.engines
+               if now - self._checked.get(engine, float('-inf')) >= self.check_interval]
+        if not due or not self._lock.acquire(blocking=False):
+            return
+        try:
+            for engine in due:
+                self._checked[engine] = now
+                healthy = self._probe(engine)
+                self._healthy[engine] = healthy
+                replica_healthy.set(int(healthy), self.name(engine))
+        finally:
+            self._lock.release()
+
+    def _probe(self, engine):
+        """Reachable and not too far behind?"""
+
+        try:
+            with engine.connect() as conn:
+                if conn.dialect.name != 'postgresql':
+                    return True
+                lag = conn.exec_driver_sql(REPLICA_LAG_SQL).scalar()
+        except Exception:
+            return False
+        return (lag or 0) <= self.max_lag
+
+    def _on_error(self, context):
+        # A failed connect, or a connection that died under us.
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+
+replicas = ReplicaSet()
+
+
+class RoutingSession(SignallingSession):
+    """Sends a read request's SELECTs to a replica; see above."""
+
+    _replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing and _is_read(clause) and _may_use_replica():
+            if self._replica is None:
+                # One replica per session, so a page reads one snapshot.
+                self._replica = replicas.choose() or False
+            if self._replica:
+                routed_statements.inc(1, 'replica')
+                return self._replica
+
+        routed_statements.inc(1, 'primary')
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with `RoutingSession` as its session class."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _is_read(clause):
+    return (getattr(clause, 'is_select', False)
+            and getattr(clause, '_for_update_arg', None) is None)
+
+
+def _may_use_replica():
+    return (replicas.engines
+            and has_request_context()
+            and request.method in READ_METHODS
+            and flask_session.get(STICKY_KEY, 0) < time())
+
+
+def _stick_to_primary(response):
+    """After a write, keep this client's reads on the primary a while."""
+
+    if request.method not in READ_METHODS and replicas.engines:
+        window = current_app.config['REPLICA_STICKY_SECONDS']
+        flask_session[STICKY_KEY] = time() + window
+    return response
@@ -0,0 +1,171 @@
+"""Check that Warbler's pages are served by index scans.
+
+`check()` requests each page in ROUTES as the most-followed user in the
+database, captures every SELECT the page runs once it's warmed up, and
+asks Postgres for its plan with `EXPLAIN`. Sequential scans over tables
+with at least `min_rows` rows are reported: on a seeded database, each
+is a query that will get slower as the table grows. Small tables are
+left alone, since scanning them is often the planner's best choice.
+
+Run it with `flask explain` after seeding (and ANALYZE-ing) a database;
+it exits non-zero if it finds anything, so it can gate CI.
+"""
+
+import sys
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db, User, Message
+
+MIN_ROWS = 10000
+
+# (endpoint, URL); URLs are filled in from `_sample()`.
+ROUTES = (
+    ('homepage', '/'),
+    ('list_users', '/users'),
+    ('user_search', '/users?q={username}'),
+    ('users_show', '/users/{user_id}'),
+    ('show_following', '/users/{user_id}/following'),
+    ('users_followers', '/users/{user_id}/followers'),
+    ('show_likes', '/users/{user_id}/likes'),
+    ('messages_show', '/messages/{message_id}'),
+    ('messages_search', '/messages/search?q={word}'),
+)
+
+
+class Finding:
+    """A sequential scan over a big table, and the query that did it."""
+
+    def __init__(self, endpoint, table, rows, statement):
+        self.endpoint = endpoint
+        self.table = table
+        self.rows = rows
+        self.statement = statement
+
+    def __repr__(self):
+        return f"<Finding {self.endpoint}: seq scan on {self.table}>"
+
+
+def check(app, login_key, min_rows=MIN_ROWS, out=sys.stdout):
+    """EXPLAIN every route's queries; returns a list of `Finding`s.
+
+    Requests are made logged in, by putting the user's id in the session
+    under `login_key`.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        print("explain: needs Postgres", file=out)
+        return []
+
+    sample = _sample()
+    if sample is None:
+        print("explain: no data; seed the database first", file=out)
+        return []
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[login_key] = sample['user_id']
+
+    findings = []
+    for endpoint, url in ROUTES:
+        url = url.format(**sample)
+        queries = _capture(client, url)
+
+        found = []
+        for engine, statement, parameters in queries:
+            for table in _seq_scans(engine, statement, parameters):
+                rows = _table_rows(engine, table)
+                if rows >= min_rows:
+                    found.append(Finding(endpoint, table, rows, statement))
+
+        status = 'ok' if not found else f'{len(found)} seq scan(s)'
+        print(f"{endpoint:<16} {url:<32} {len(queries):>3} queries  {status}",
+              file=out)
+        for finding in found:
+            print(f"    seq scan on {finding.table} (~{finding.rows:,} rows):",
+                  file=out)
+            print(f"    {' '.join(finding.statement.split())[:300]}", file=out)
+        findings += found
+
+    return findings
+
+
+def _sample():
+    """Ids to fill ROUTES with: the most-followed user, and their newest
+    message."""
+
+    user = (db.session.query(User.id, User.username)
+            .order_by(User.follower_count.desc(), User.id)
+            .first())
+    if user is None:
+        return None
+
+    message = (db.session.query(Message.id, Message.text)
+               .order_by(Message.user_id != user.id, Message.id.desc())
+               .first())
+    words = message.text.split() if message else []
+
+    return {
+        'user_id': user.id,
+        'username': user.username[:3],
+        'message_id': message.id if message else 0,
+        'word': words[0] if words else 'hello',
+    }
+
+
+def _capture(client, url):
+    """Request `url`; returns the SELECTs it ran, with their parameters.
+
+    The page is requested once beforehand, so one-off work (filling the
+    caches, building the user search index) doesn't count against it.
+    """
+
+    client.get(url)
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() in ('SELECT', 'WITH R', 'WITH '):
+            queries.append((conn.engine, statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', record)
+    try:
+        client.get(url)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record)
+    return queries
+
+
+def _seq_scans(engine, statement, parameters):
+    """Tables `statement` reads with a sequential scan."""
+
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+        plan = cursor.fetchone()[0]
+        raw.rollback()
+    finally:
+        raw.close()
+
+    tables = []
+    nodes = [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan':
+            tables.append(node['Relation Name'])
+        nodes.extend(node.get('Plans', ()))
+    return tables
+
+
+def _table_rows(engine, table):
+    """The planner's row count for `table` (exact if it's never been
+    ANALYZEd)."""
+
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(
+            "SELECT reltuples FROM pg_class WHERE relname = %(table)s",
+            {'table': table}).scalar()
+        if rows is None or rows < 0:
+            rows = conn.exec_driver_sql(f'SELECT count(*) FROM "{table}"').scalar()
+    return int(rows)
@@ -0,0 +1,94 @@
+"""Cache of rendered message cards.
+
+Feeds render the same `<li>` card for a popular warble in thousands of
+timelines. Each card's HTML is cached under its message id, stamped with
+what it was rendered from: the templates, the message's version and its
+author's version. A card whose stamp no longer matches (the author
+changed their username or picture in `profile()`, say) is simply
+re-rendered. Deleting a message drops its card.
+
+The like button (its state differs per viewer, and its count changes
+all the time) is never part of the cached HTML; it's spliced into a
+placeholder on the way out.
+
+Cards live in an in-process LRU (`FRAGMENT_CACHE_SIZE` entries),
+optionally in front of a shared store (`FRAGMENT_CACHE_BACKEND`, anything
+with the `cache.py` interface).
+"""
+
+from flask import render_template
+from markupsafe import Markup
+from sqlalchemy import event
+
+import http_cache
+from cache import LRUCache, TieredCache
+from models import Message
+
+LIKE_SLOT = Markup('<!--like-button-->')
+
+LIKE_BUTTON = Markup(
+    '<form method="POST" action="/messages/{id}/like" id="messages-form"'
+    ' class="like-form" data-message-id="{id}">'
+    '<input type="hidden" name="liked" value="{want}">'
+    '<button class="btn btn-sm {style}">'
+    '<i class="fa fa-thumbs-up"></i> <span class="like-count">{count}</span>'
+    '</button>'
+    '</form>')
+
+
+class FragmentCache:
+    """Rendered message cards keyed by message id."""
+
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 50000)
+        app.config.setdefault('FRAGMENT_CACHE_BACKEND', None)
+
+        if app.config['FRAGMENT_CACHE_SIZE']:
+            self.backend = LRUCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'])
+            if app.config['FRAGMENT_CACHE_BACKEND'] is not None:
+                self.backend = TieredCache(self.backend,
+                                           app.config['FRAGMENT_CACHE_BACKEND'])
+
+        app.jinja_env.globals['message_card'] = self.message_card
+
+        event.listen(Message, 'after_delete',
+                     lambda mapper, connection, msg: self.invalidate(msg.id))
+
+    @staticmethod
+    def key(message_id):
+        return f'card:{message_id}'
+
+    def message_card(self, message, liked=None):
+        """The card for `message`; with a like button unless `liked` is None."""
+
+        stamp = (http_cache.build_id(), message.version, message.user.version)
+
+        entry = self.backend.get(self.key(message.id)) if self.backend else None
+        if entry is None or entry[0] != stamp:
+            entry = (stamp, render_template('messages/card.html', msg=message,
+                                            like_slot=LIKE_SLOT))
+            if self.backend is not None:
+                self.backend.set(self.key(message.id), entry)
+
+        button = ''
+        if liked is not None:
+            button = LIKE_BUTTON.format(
+                id=message.id, count=message.likes_count,
+                want='0' if liked else '1',
+                style='btn-primary' if liked else 'btn-secondary')
+
+        return Markup(entry[1].replace(LIKE_SLOT, button))
+
+    def invalidate(self, message_id):
+        if self.backend is not None:
+            self.backend.delete(self.key(message_id))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+fragment_cache = FragmentCache()
@@ -3,75 +3,223 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Run it from the project root, e.g. for a load-test dataset:
+
+    python generator/create_csvs.py --users 10000000 --messages 50000000 \\
+        --follows 200000000 --likes 100000000
+
+Everything is generated offline from `--seed`, so the same arguments always
+give the same files (bar timestamps, which are relative to today). Rows are
+streamed straight to disk and each file is written by its own process, so
+memory use stays flat however big the dataset gets.
+
+Follow and like targets are drawn from a power law: a few users (and
+warbles) are very popular and most aren't, like on a real network. Nobody
+follows themselves or likes their own warbles; a warble's author is a
+function of its id, so the likes process can tell whose it is.
+
+users.csv and messages.csv carry each row's id, which follows.csv and
+likes.csv refer to, so loading them never depends on the database
+handing out ids in row order (see loader.py).
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import (BLOCK_ROWS, PowerLaw, TextCorpus, blocks, format_datetimes,
+                     make_rng, random_datetimes, write_block)
 
 MAX_WARBLER_LENGTH = 140
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
+USERS_CSV_HEADERS = ['id', 'email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
+MESSAGES_CSV_HEADERS = ['id', 'text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+NUM_LIKES = 3000
 
-fake = Faker()
+# Skew of follower/like counts; around 1 is typical of social graphs.
+POPULARITY_EXPONENT = 1.1
 
-# Generate random profile image URLs to use for users
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
+HEADER_IMAGE_URLS = [
+    f"https://picsum.photos/seed/warbler{i}/1280/400"
     for i in range(1, 46)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def out_degrees(total, n):
+    """Split `total` edges over `n` sources, as evenly as possible."""
+
+    base, extra = divmod(total, n)
+    for i in range(n):
+        yield base + (i < extra)
+
+
+def edge_blocks(num_edges, num_sources, targets, reject=None):
+    """`(sources, targets)` array pairs, about BLOCK_ROWS edges each.
+
+    Each source gets an even share of the edges; `targets` is a PowerLaw
+    over whatever is being followed or liked. `reject(source, ids)`, if
+    given, masks out the targets a source mustn't get.
+    """
+
+    sources, chosen, buffered = [], [], 0
+
+    for source, degree in enumerate(out_degrees(num_edges, num_sources), 1):
+        picked = targets.distinct(
+            degree,
+            reject=(lambda ids: reject(source, ids)) if reject else None)
+        sources.append(np.full(len(picked), source))
+        chosen.append(picked)
+        buffered += len(picked)
+
+        if buffered >= BLOCK_ROWS:
+            yield np.concatenate(sources), np.concatenate(chosen)
+            sources, chosen, buffered = [], [], 0
+
+    if buffered:
+        yield np.concatenate(sources), np.concatenate(chosen)
+
+
+def write_users(path, num_users, seed):
+    rng = make_rng(seed, 0)
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        users_writer.writeheader()
+
+        for i in range(1, num_users + 1):
+            # the row number keeps usernames and emails unique
+            username = f"{fake.user_name()}{i}"
+            users_writer.writerow(dict(
+                id=i,
+                email=f"{username}@{fake.free_email_domain()}",
+                username=username,
+                image_url=IMAGE_URLS[rng.integers(len(IMAGE_URLS))],
+                password=PASSWORD,
+                bio=fake.sentence(),
+                header_image_url=HEADER_IMAGE_URLS[rng.integers(len(HEADER_IMAGE_URLS))],
+                location=fake.city()
+            ))
+
+    return path, num_users
+
+
+def message_authors(num_users, seed):
+    """Who wrote each warble: `.at(message_ids)` gives their user ids."""
+
+    return PowerLaw(num_users, POPULARITY_EXPONENT, make_rng(seed, 4))
+
+
+def write_messages(path, num_messages, num_users, seed):
+    rng = make_rng(seed, 1)
+    fake = Faker()
+    fake.seed_instance(seed + 1)
+    corpus = TextCorpus(fake, lambda fake: fake.paragraph()[:MAX_WARBLER_LENGTH])
+    authors = message_authors(num_users, seed)
+    now = datetime.now()
+    next_id = 1
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_csv.write(','.join(MESSAGES_CSV_HEADERS) + '\n')
+
+        for size in blocks(num_messages):
+            write_block(messages_csv,
+                        np.arange(next_id, next_id + size),
+                        corpus.sample(size, rng),
+                        format_datetimes(random_datetimes(size, rng, now=now)),
+                        authors.at(np.arange(next_id, next_id + size)))
+            next_id += size
+
+    return path, num_messages
+
+
+def write_follows(path, num_follows, num_users, seed):
+    rng = make_rng(seed, 2)
+    followed = PowerLaw(num_users, POPULARITY_EXPONENT, rng)
+    written = 0
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_csv.write(','.join(FOLLOWS_CSV_HEADERS) + '\n')
+
+        for followers, followed_users in edge_blocks(
+                num_follows, num_users, followed,
+                reject=lambda user, ids: ids == user):
+            write_block(follows_csv, followed_users, followers)
+            written += len(followers)
+
+    return path, written
+
+
+def write_likes(path, num_likes, num_users, num_messages, seed):
+    rng = make_rng(seed, 3)
+    liked = PowerLaw(num_messages, POPULARITY_EXPONENT, rng)
+    authors = message_authors(num_users, seed)
+    written = 0
+
+    with open(path, 'w', newline='') as likes_csv:
+        likes_csv.write(','.join(LIKES_CSV_HEADERS) + '\n')
+
+        for user_ids, message_ids in edge_blocks(
+                num_likes, num_users, liked,
+                reject=lambda user, ids: authors.at(ids) == user):
+            write_block(likes_csv, user_ids, message_ids)
+            written += len(user_ids)
+
+    return path, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    def path(name):
+        return os.path.join(args.out, name)
+
+    # one process per output file
+    jobs = [
+        (write_users, path('users.csv'), args.users, args.seed),
+        (write_messages, path('messages.csv'), args.messages, args.users,
+         args.seed),
+        (write_follows, path('follows.csv'), args.follows, args.users,
+         args.seed),
+    ]
+    if args.likes and args.messages:
+        jobs.append((write_likes, path('likes.csv'), args.likes, args.users,
+                     args.messages, args.seed))
+
+    with ProcessPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = [pool.submit(fn, *fn_args) for fn, *fn_args in jobs]
+        for future in futures:
+            written_path, rows = future.result()
+            print(f"{written_path}: {rows:,} rows")
+
+
+if __name__ == '__main__':
+    main()
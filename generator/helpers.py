@@ -1,14 +1,170 @@
-"""Support functions for CSV generation."""
+"""Support functions for CSV generation.
 
+The batched helpers build whole columns at once with NumPy, which is what
+big datasets need; the row-at-a-time ones are thin wrappers over them.
+"""
+
+import csv
+import io
 from datetime import datetime
-from random import uniform
 
+import numpy as np
+
+# Rows per CSV block written by the batched generators.
+BLOCK_ROWS = 100000
+
+
+def make_rng(seed, stream):
+    """Independent NumPy generator for one output file (`stream`)."""
+
+    return np.random.default_rng([seed, stream])
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
+def random_datetimes(size, rng, year_gap=2, now=None):
+    """`size` random datetimes within the last few years, as datetime64[us]."""
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
 
-    return datetime.fromtimestamp(random_timestamp)
+    start = np.datetime64(then, 'us').astype(np.int64)
+    end = np.datetime64(now, 'us').astype(np.int64)
+    return rng.integers(start, end, size=size).astype('datetime64[us]')
+
+
+def format_datetimes(timestamps):
+    """Render datetime64 values the way `str(datetime)` does."""
+
+    return np.char.replace(np.datetime_as_string(timestamps, unit='us'),
+                           'T', ' ')
+
+
+def get_random_datetime(year_gap=2, rng=None, now=None):
+    """Get a random datetime within the last few years."""
+
+    rng = rng or np.random.default_rng()
+    timestamp = random_datetimes(1, rng, year_gap, now)[0]
+    return timestamp.astype(datetime)
+
+
+def unit_hash(keys, salt):
+    """A fixed pseudo-random float in [0, 1) for each int in `keys`
+    (SplitMix64)."""
+
+    z = np.asarray(keys, dtype=np.uint64) + np.uint64(salt)
+    z += np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    return (z >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+class PowerLaw:
+    """Draws ids 1..n where id popularity follows a power law.
+
+    Ranks come from the inverse CDF of a truncated Pareto distribution,
+    and are then scattered over the ids with a fixed permutation, so the
+    popular ids aren't simply the lowest ones. Needs O(1) memory.
+    """
+
+    def __init__(self, n, exponent, rng):
+        self.n = n
+        self.exponent = exponent
+        self.rng = rng
+        self.stride = self._coprime_stride(n, rng)
+        self.offset = int(rng.integers(n))
+
+    @staticmethod
+    def _coprime_stride(n, rng):
+        if n == 1:
+            return 1
+        while True:
+            stride = int(rng.integers(1, n))
+            if np.gcd(stride, n) == 1:
+                return stride
+
+    def batch(self, size):
+        """`size` ids as an int64 array (repeats allowed)."""
+
+        return self._ids(self.rng.random(size))
+
+    def at(self, keys):
+        """One id for each of `keys` (an int array). The same key always
+        gets the same id, so another process can work them out again."""
+
+        return self._ids(unit_hash(keys, self.offset))
+
+    def _ids(self, u):
+        """Ids for uniform draws `u` in [0, 1)."""
+
+        if self.exponent == 1:
+            rank = (self.n + 1.0) ** u
+        else:
+            k = 1 - self.exponent
+            rank = (((self.n + 1.0) ** k - 1) * u + 1) ** (1 / k)
+
+        rank = np.minimum(rank.astype(np.int64), self.n) - 1
+        return (rank * self.stride + self.offset) % self.n + 1
+
+    def __call__(self):
+        return int(self.batch(1)[0])
+
+    def distinct(self, count, reject=None):
+        """`count` different ids as an array, leaving out any that
+        `reject(ids)` (a function returning a boolean mask) picks out."""
+
+        if count * 2 > self.n:
+            ids = np.arange(1, self.n + 1)
+            if reject is not None:
+                ids = ids[~reject(ids)]
+            return self.rng.choice(ids, min(count, len(ids)), replace=False)
+
+        chosen = np.empty(0, dtype=np.int64)
+        while len(chosen) < count:
+            draw = self.batch(2 * (count - len(chosen)) + 8)
+            if reject is not None:
+                draw = draw[~reject(draw)]
+            # keep first-drawn order so popular ids win ties
+            chosen = np.concatenate([chosen, draw])
+            _, first = np.unique(chosen, return_index=True)
+            chosen = chosen[np.sort(first)]
+        return chosen[:count]
+
+
+class TextCorpus:
+    """A fixed pool of Faker texts, already escaped as CSV fields.
+
+    Faker is slow per call, so we build `size` texts once and sample from
+    them; at benchmark volumes nobody can tell the repeats apart.
+    """
+
+    def __init__(self, fake, make_text, size=10000):
+        self.fields = np.array([self._csv_field(make_text(fake))
+                                for _ in range(size)], dtype=object)
+
+    @staticmethod
+    def _csv_field(value):
+        buf = io.StringIO()
+        csv.writer(buf).writerow([value])
+        return buf.getvalue().rstrip('\r\n')
+
+    def sample(self, size, rng):
+        return self.fields[rng.integers(len(self.fields), size=size)]
+
+
+def write_block(out, *columns):
+    """Write equal-length columns of pre-escaped strings as CSV rows."""
+
+    columns = [np.asarray(column).astype(str) for column in columns]
+    rows = columns[0].astype(object)
+    for column in columns[1:]:
+        rows = rows + ',' + column.astype(object)
+    out.write('\n'.join(rows))
+    out.write('\n')
+
+
+def blocks(total, size=BLOCK_ROWS):
+    """Sizes of the blocks that make up `total` rows."""
+
+    while total > 0:
+        yield min(size, total)
+        total -= size
@@ -0,0 +1,124 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow (~250ms at cost 12), so hashing on the
+request thread lets a burst of logins occupy every worker. Instead,
+hashes run on a small dedicated thread pool (bcrypt releases the GIL
+while it works) with a cap on how many may be waiting. When the cap is
+hit we refuse straight away with `HashingPoolSaturated`, which the app
+turns into a 503, rather than letting the backlog grow.
+
+The bcrypt cost comes from `BCRYPT_LOG_ROUNDS`; hashes made at another
+cost are upgraded the next time their owner logs in.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from flask_bcrypt import Bcrypt
+
+from metrics import REGISTRY
+
+bcrypt = Bcrypt()
+
+
+class HashingPoolSaturated(Exception):
+    """Too many password hashes are already queued."""
+
+
+hash_seconds = REGISTRY.histogram(
+    'warbler_password_hash_seconds',
+    'Time spent computing a password hash.',
+    labels=('operation',),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+hash_wait_seconds = REGISTRY.histogram(
+    'warbler_password_hash_wait_seconds',
+    'Time a password hash waited in the queue before starting.',
+    labels=('operation',),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded worker pool."""
+
+    def __init__(self):
+        self.rounds = 12
+        self.queue_limit = 0
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+        REGISTRY.gauge('warbler_password_hash_queue_depth',
+                       'Password hashes queued or running.',
+                       function=lambda: self._pending)
+        self._rejected = REGISTRY.counter(
+            'warbler_password_hash_rejected_total',
+            'Password hashes refused because the pool was full.')
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', os.cpu_count() or 2)
+        app.config.setdefault('PASSWORD_HASH_QUEUE_LIMIT',
+                              4 * app.config['PASSWORD_HASH_WORKERS'])
+
+        bcrypt.init_app(app)
+
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.queue_limit = app.config['PASSWORD_HASH_QUEUE_LIMIT']
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config['PASSWORD_HASH_WORKERS'],
+            thread_name_prefix='password-hash')
+
+    def generate(self, password):
+        """Hash `password` at the configured cost."""
+
+        return self._run('generate', self._generate, password)
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run('check', bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made at a different cost than we use now?"""
+
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def _generate(self, password):
+        return (bcrypt
+                .generate_password_hash(password, self.rounds)
+                .decode('UTF-8'))
+
+    def _run(self, operation, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+
+        with self._lock:
+            if self._pending >= self.queue_limit:
+                self._rejected.inc()
+                raise HashingPoolSaturated()
+            self._pending += 1
+
+        queued = perf_counter()
+
+        def timed():
+            started = perf_counter()
+            hash_wait_seconds.observe(started - queued, operation)
+            try:
+                return fn(*args)
+            finally:
+                hash_seconds.observe(perf_counter() - started, operation)
+
+        try:
+            return self._executor.submit(timed).result()
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,169 @@
+"""HTTP caching policy for Warbler.
+
+Pages a logged-in user sees are personalized (follow buttons, likes,
+the nav bar), and so is any page rendered once the session holds a
+CSRF token (the login and signup forms embed it), so they're sent
+`no-store`. Everyone else gets pages that
+only depend on the rows they show, and views whose rows carry a
+`version` can answer a repeat visit with `304 Not Modified`:
+
+    etag = http_cache.etag('message', msg.id, msg.version, msg.user.version)
+    if http_cache.is_fresh(etag):
+        return http_cache.not_modified(etag)
+    ...
+    return http_cache.cacheable(render_template(...), etag)
+
+Static files are served with fingerprinted URLs (`static_url()` in
+templates appends a hash of the file), so they can be cached for a
+year. A URL without the fingerprint, or with one that isn't the file's
+current hash (an old page asking after a deploy), gets a short max-age
+instead, so a cache never pins the wrong contents under a URL.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, make_response, request, session, url_for
+from werkzeug.security import safe_join
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+UNVERSIONED_STATIC_MAX_AGE = 60 * 60
+
+_fingerprints = {}
+_build_id = None
+
+
+def init_app(app, session_key):
+    """Install the caching policy; `session_key` marks a logged-in session."""
+
+    global _build_id
+
+    app.config.setdefault('STATIC_MAX_AGE', STATIC_MAX_AGE)
+    app.config.setdefault('UNVERSIONED_STATIC_MAX_AGE',
+                          UNVERSIONED_STATIC_MAX_AGE)
+    app.config['HTTP_CACHE_SESSION_KEY'] = session_key
+
+    # ETags must change when the markup does, not just the data --
+    # including the static URLs in it, which carry the files' hashes.
+    _build_id = _digest_trees(os.path.join(app.root_path, app.template_folder),
+                              app.static_folder)
+
+    app.jinja_env.globals['static_url'] = static_url
+    app.after_request(apply_policy)
+
+
+def _digest_trees(*roots):
+    digest = hashlib.sha1()
+    for root in roots:
+        for dirpath, dirnames, filenames in sorted(os.walk(root)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                digest.update(os.path.relpath(path, root).encode('utf-8'))
+                with open(path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def build_id():
+    """Digest of the templates and static files this process serves."""
+
+    return _build_id
+
+
+def static_url(filename):
+    """URL for a static file, fingerprinted with a hash of its contents."""
+
+    return url_for('static', filename=filename, v=fingerprint(filename))
+
+
+def fingerprint(filename):
+    """Hash of a static file's current contents, or None if there's no
+    such file."""
+
+    path = safe_join(current_app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except (TypeError, OSError):
+        return None
+
+    cached = _fingerprints.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, hashlib.sha1(f.read()).hexdigest()[:12])
+        _fingerprints[path] = cached
+    return cached[1]
+
+
+def is_personalized():
+    """Will this request's page differ per visitor?"""
+
+    config = current_app.config
+    return (config['HTTP_CACHE_SESSION_KEY'] in session
+            or '_flashes' in session
+            or config.get('WTF_CSRF_FIELD_NAME', 'csrf_token') in session)
+
+
+def etag(*parts):
+    """A strong ETag for a page built from `parts` (ids and row versions)."""
+
+    key = '/'.join(str(part) for part in (_build_id,) + parts)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def is_fresh(tag):
+    """Does the client already hold the page tagged `tag`?
+
+    Always False for personalized requests, which we never tag.
+    """
+
+    return not is_personalized() and tag in request.if_none_match
+
+
+def not_modified(tag):
+    response = make_response('', 304)
+    response.set_etag(tag)
+    _revalidate(response)
+    return response
+
+
+def cacheable(response, tag):
+    """Tag `response`, unless the page is personalized."""
+
+    response = make_response(response)
+    if not is_personalized():
+        response.set_etag(tag)
+        _revalidate(response)
+    return response
+
+
+def _revalidate(response):
+    # Shared caches may keep it, but must check the ETag before reuse.
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+
+
+def apply_policy(response):
+    """Default Cache-Control for responses whose view didn't pick one."""
+
+    if request.endpoint == 'static':
+        version = request.args.get('v')
+        if version and version == fingerprint(request.view_args['filename']):
+            response.headers['Cache-Control'] = (
+                f"public, max-age={current_app.config['STATIC_MAX_AGE']}, "
+                "immutable")
+        else:
+            response.headers['Cache-Control'] = (
+                "public, "
+                f"max-age={current_app.config['UNVERSIONED_STATIC_MAX_AGE']}")
+        return response
+
+    if 'Cache-Control' in response.headers:
+        return response
+
+    if is_personalized():
+        response.headers['Cache-Control'] = 'no-store'
+        response.headers['Pragma'] = 'no-cache'
+    else:
+        response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,307 @@
+"""Streaming bulk loader for Warbler's CSV datasets.
+
+Each CSV is read in chunks of `chunk_rows` rows, so memory use doesn't
+depend on file size. On Postgres every chunk goes in with `COPY ... FROM
+STDIN`; elsewhere with a DB-API `executemany`. Each chunk is its own
+transaction, and the running row count for its file is updated inside
+that same transaction (in `bulk_load_progress`), so a load that dies
+part-way resumes exactly where the last committed chunk ended.
+
+Rows that others refer to -- users and messages -- carry their own ids
+in an `id` column (generator/create_csvs.py writes one). Serial ids
+wouldn't survive a resume: a chunk that fails still uses up sequence
+values, so every later row would get a different id than the ones
+follows and likes were written against. Once a file with ids is in,
+its table's sequence is moved past them.
+
+Secondary indexes on a table -- models.py's, and the search indexes
+search.py makes with DDL -- are dropped before its rows go in and
+rebuilt once they're all there, which is much cheaper than maintaining
+them row by row.
+
+The finishing steps (counters, timelines) work through a range of ids
+at a time and commit each one, so none of them is a single transaction
+over whole tables.
+
+If `messages` is partitioned (see partitions.py), the months each chunk
+covers get their partitions before it's written, so rows go straight
+into them rather than the default partition.
+
+Run it with `flask load-data`; seed.py uses it for a fresh load.
+"""
+
+import csv
+import io
+import os
+import sys
+from datetime import datetime
+from itertools import islice
+from time import perf_counter
+
+from sqlalchemy import BigInteger, Column, MetaData, Table, Text, inspect
+
+from models import db, Message, User
+from pagination import id_ranges
+import partitions
+import search
+import timeline
+
+CHUNK_ROWS = 50000
+
+# Ids per transaction in the finishing steps.
+BATCH_IDS = 10000
+
+# Load order matters: rows must come after the rows they reference.
+FILES = (
+    ('users', 'users.csv'),
+    ('messages', 'messages.csv'),
+    ('follows', 'follows.csv'),
+    ('likes', 'likes.csv'),
+)
+
+# Kept out of db.metadata so create_all/drop_all leave it alone.
+progress_metadata = MetaData()
+
+progress = Table(
+    'bulk_load_progress', progress_metadata,
+    Column('filename', Text, primary_key=True),
+    Column('rows', BigInteger, nullable=False),
+)
+
+# Rows value marking a file (or a finishing step) as done.
+COMPLETE = -1
+
+
+def load(data_dir='generator', chunk_rows=CHUNK_ROWS, fresh=False,
+         out=sys.stdout):
+    """Load every CSV in `data_dir` that we know about.
+
+    With `fresh`, forget earlier progress and start over (the caller is
+    expected to have emptied the tables). Otherwise pick up where the
+    last run stopped.
+    """
+
+    engine = db.engine
+    progress_metadata.create_all(engine)
+
+    if fresh:
+        with engine.begin() as conn:
+            conn.execute(progress.delete())
+
+    for table_name, filename in FILES:
+        path = os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            load_file(db.metadata.tables[table_name], path, chunk_rows, out)
+
+    # Bulk rows bypass fan-out, counters and the search index. Counters
+    # first: the rebuild reads them to leave out the biggest accounts.
+    _finish('counters', _recount, out)
+    _finish('timelines', lambda: timeline.rebuild(BATCH_IDS), out)
+    if engine.dialect.name != 'postgresql':
+        # Postgres rebuilt its full-text index along with the others.
+        _finish('search', search.reindex_messages, out)
+
+
+def load_file(table, path, chunk_rows=CHUNK_ROWS, out=sys.stdout):
+    """Stream one CSV into `table`, resuming if it was part-loaded."""
+
+    filename = os.path.basename(path)
+    done = _rows_done(filename)
+    if done == COMPLETE:
+        print(f"{table.name}: already loaded", file=out)
+        return
+
+    dropped = _drop_secondary_indexes(table)
+    write = _copy_chunk if db.engine.dialect.name == 'postgresql' else _insert_chunk
+
+    started = perf_counter()
+    loaded = 0
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        rows = islice(reader, done, None)
+
+        partitioned = table.name == 'messages' and partitions.is_partitioned()
+
+        while True:
+            chunk = list(islice(rows, chunk_rows))
+            if not chunk:
+                break
+
+            if partitioned:
+                _add_partitions(columns, chunk)
+
+            done += len(chunk)
+            loaded += len(chunk)
+            write(table, columns, chunk, filename, done)
+
+            elapsed = perf_counter() - started
+            print(f"{table.name}: {done:,} rows "
+                  f"({loaded / elapsed:,.0f} rows/sec)", file=out, flush=True)
+
+    if 'id' in columns:
+        _advance_sequence(table)
+    _rebuild_indexes(table, dropped, out)
+    _set_rows_done(filename, COMPLETE)
+
+
+def _copy_chunk(table, columns, chunk, filename, done):
+    """Postgres: COPY the chunk in, and record progress, in one transaction."""
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(chunk)
+    buf.seek(0)
+
+    raw = db.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            buf)
+        cursor.execute(
+            "UPDATE bulk_load_progress SET rows = %s WHERE filename = %s",
+            (done, filename))
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def _insert_chunk(table, columns, chunk, filename, done):
+    """Anything else: executemany the chunk, and record progress, in one
+    transaction."""
+
+    engine = db.engine
+    marks = _placeholders(engine.dialect.paramstyle, len(columns) + 2)
+    row_marks, (rows_mark, filename_mark) = marks[:-2], marks[-2:]
+
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.executemany(
+            f"INSERT INTO {table.name} ({', '.join(columns)}) "
+            f"VALUES ({', '.join(row_marks)})",
+            chunk)
+        cursor.execute(
+            f"UPDATE bulk_load_progress SET rows = {rows_mark} "
+            f"WHERE filename = {filename_mark}",
+            (done, filename))
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def _add_partitions(columns, chunk):
+    """Create the monthly partitions `chunk`'s messages fall in."""
+
+    at = columns.index('timestamp')
+    stamps = [datetime.fromisoformat(row[at]) for row in chunk]
+    partitions.ensure_partitions(min(stamps), max(stamps))
+    db.session.commit()
+
+
+def _advance_sequence(table):
+    """Postgres: start `table`'s id sequence after the ids loaded into it.
+    Elsewhere new rows already get the next id after the highest."""
+
+    if db.engine.dialect.name != 'postgresql':
+        return
+
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"coalesce(max(id), 0) + 1, false) FROM {table.name}")
+
+
+def _placeholders(paramstyle, count):
+    """`count` positional DB-API placeholders in the driver's style."""
+
+    if paramstyle == 'qmark':
+        return ['?'] * count
+    if paramstyle == 'numeric':
+        return [f':{i}' for i in range(1, count + 1)]
+    return ['%s'] * count
+
+
+def _rows_done(filename):
+    with db.engine.begin() as conn:
+        rows = conn.execute(
+            progress.select().where(progress.c.filename == filename)
+        ).fetchone()
+        if rows is None:
+            conn.execute(progress.insert().values(filename=filename, rows=0))
+            return 0
+        return rows.rows
+
+
+def _set_rows_done(filename, rows):
+    with db.engine.begin() as conn:
+        conn.execute(progress.update()
+                     .where(progress.c.filename == filename)
+                     .values(rows=rows))
+
+
+def _drop_secondary_indexes(table):
+    """Drop `table`'s non-unique indexes, if present: the ones in our
+    metadata, and on Postgres the ones search.py makes."""
+
+    existing = {index['name'] for index in inspect(db.engine).get_indexes(table.name)}
+    dropped = [index for index in table.indexes
+               if not index.unique and index.name in existing]
+
+    for index in dropped:
+        index.drop(bind=db.engine)
+
+    made = []
+    if db.engine.dialect.name == 'postgresql':
+        made = search.POSTGRES_INDEXES.get(table.name, [])
+        with db.engine.begin() as conn:
+            for names, ddl in made:
+                for name in names:
+                    conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+
+    # Ones dropped by an earlier, interrupted run need rebuilding too.
+    return [index for index in table.indexes if not index.unique], made
+
+
+def _rebuild_indexes(table, indexes, out):
+    existing = {index['name'] for index in inspect(db.engine).get_indexes(table.name)}
+    declared, made = indexes
+
+    for index in declared:
+        if index.name not in existing:
+            started = perf_counter()
+            index.create(bind=db.engine)
+            print(f"{table.name}: rebuilt {index.name} "
+                  f"in {perf_counter() - started:.1f}s", file=out, flush=True)
+
+    for names, ddl in made:
+        started = perf_counter()
+        with db.engine.begin() as conn:
+            conn.execute(ddl)
+        print(f"{table.name}: rebuilt {', '.join(names)} "
+              f"in {perf_counter() - started:.1f}s", file=out, flush=True)
+
+
+def _recount():
+    for start, end in id_ranges(User.id, BATCH_IDS):
+        User.recount(start, end)
+        db.session.commit()
+    for start, end in id_ranges(Message.id, BATCH_IDS):
+        Message.recount(start, end)
+        db.session.commit()
+
+
+def _finish(step, fn, out):
+    """Run a post-load step once, even across resumed runs."""
+
+    key = f'step:{step}'
+    if _rows_done(key) == COMPLETE:
+        return
+
+    started = perf_counter()
+    fn()
+    db.session.commit()
+    _set_rows_done(key, COMPLETE)
+    print(f"{step}: rebuilt in {perf_counter() - started:.1f}s", file=out,
+          flush=True)
@@ -0,0 +1,326 @@
+"""Lightweight request instrumentation for Warbler.
+
+For every request we count SQL statements, total time spent in the
+database, the slowest statement, and time spent rendering templates.
+Those numbers go out on the response as a `Server-Timing` header and
+into per-endpoint histograms served in Prometheus text format at
+`/metrics`.
+
+Everything here is a few `perf_counter()` calls and a dict update per
+query, so it's meant to stay on in production.
+"""
+
+import threading
+from time import perf_counter
+
+from flask import Response, before_render_template, current_app, g
+from flask import has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Statements per request.
+QUERY_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144)
+
+
+def _format_labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+
+    def escape(value):
+        return (str(value)
+                .replace('\\', '\\\\')
+                .replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    return '{' + ','.join(f'{name}="{escape(value)}"'
+                          for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    """A Prometheus-style cumulative histogram, optionally labelled."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {
+                    'buckets': [0] * len(self.buckets),
+                    'sum': 0.0,
+                    'count': 0,
+                }
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {key: {'buckets': list(val['buckets']),
+                            'sum': val['sum'],
+                            'count': val['count']}
+                      for key, val in self._series.items()}
+
+        for label_values, val in sorted(series.items()):
+            for bound, count in zip(self.buckets, val['buckets']):
+                labels = _format_labels(self.labels, label_values,
+                                        le=_format_number(bound))
+                yield f'{self.name}_bucket{labels} {count}'
+            labels = _format_labels(self.labels, label_values, le='+Inf')
+            yield f'{self.name}_bucket{labels} {val["count"]}'
+
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}_sum{labels} {_format_number(val["sum"])}'
+            yield f'{self.name}_count{labels} {val["count"]}'
+
+
+class Gauge:
+    """A value that goes up and down, or is read from a callback."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, amount=1, *label_values):
+        self.inc(-amount, *label_values)
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+
+        for label_values, value in sorted(values.items()):
+            labels = _format_labels(self.labels, label_values)
+            yield f'{self.name}{labels} {_format_number(value)}'
+
+
+class Counter(Gauge):
+    """A value that only goes up."""
+
+    kind = 'counter'
+
+
+class Registry:
+    """The set of metrics served at `/metrics`."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge(name, help, labels, function))
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+request_seconds = REGISTRY.histogram(
+    'warbler_request_duration_seconds',
+    'Time to handle a request.',
+    labels=('endpoint',))
+
+request_queries = REGISTRY.histogram(
+    'warbler_request_queries',
+    'SQL statements run per request.',
+    labels=('endpoint',),
+    buckets=QUERY_BUCKETS)
+
+request_db_seconds = REGISTRY.histogram(
+    'warbler_request_db_seconds',
+    'Time spent in the database per request.',
+    labels=('endpoint',))
+
+request_render_seconds = REGISTRY.histogram(
+    'warbler_request_render_seconds',
+    'Time spent rendering templates per request.',
+    labels=('endpoint',))
+
+
+class RequestStats:
+    """What one request has cost so far."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        self.render_seconds = 0.0
+        self._render_started = []
+
+
+def current_stats():
+    """The stats for the request being handled, or None outside one."""
+
+    if has_request_context():
+        return g.get('_request_stats')
+    return None
+
+
+##############################################################################
+# Hooks
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_started', []).append(
+            (cursor, perf_counter()))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = current_stats()
+    started = conn.info.get('query_started')
+    if stats is None or not started:
+        return
+
+    elapsed = perf_counter() - started.pop()[1]
+    stats.queries += 1
+    stats.db_seconds += elapsed
+    if elapsed > stats.slowest_seconds:
+        stats.slowest_seconds = elapsed
+        stats.slowest_statement = statement
+
+
+def _handle_error(context):
+    # A statement that raised never reaches after_cursor_execute; drop
+    # its start time, or later statements on this pooled connection
+    # would be timed against it.
+    conn, execution = context.connection, context.execution_context
+    if conn is None or execution is None:
+        return
+    started = conn.info.get('query_started')
+    if started and started[-1][0] is execution.cursor:
+        started.pop()
+
+
+def _before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        stats._render_started.append(perf_counter())
+
+
+def _after_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None and stats._render_started:
+        stats.render_seconds += perf_counter() - stats._render_started.pop()
+
+
+def _start_request():
+    g._request_stats = RequestStats()
+
+
+def _finish_request(response):
+    stats = current_stats()
+    if stats is None:
+        return response
+
+    app = current_app
+    elapsed = perf_counter() - stats.started
+    endpoint = request.endpoint or 'unmatched'
+
+    request_seconds.observe(elapsed, endpoint)
+    request_queries.observe(stats.queries, endpoint)
+    request_db_seconds.observe(stats.db_seconds, endpoint)
+    request_render_seconds.observe(stats.render_seconds, endpoint)
+
+    if app.config['SERVER_TIMING_HEADER']:
+        response.headers.add('Server-Timing', ', '.join([
+            f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries"',
+            f'db-slowest;dur={stats.slowest_seconds * 1000:.1f}',
+            f'render;dur={stats.render_seconds * 1000:.1f}',
+            f'total;dur={elapsed * 1000:.1f}',
+        ]))
+
+    if stats.slowest_seconds > app.config['SLOW_QUERY_SECONDS']:
+        app.logger.warning("Slow query on %s (%.0fms): %s", endpoint,
+                           stats.slowest_seconds * 1000,
+                           stats.slowest_statement)
+
+    return response
+
+
+def metrics_view():
+    """Prometheus scrape endpoint."""
+
+    return Response(REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app):
+    """Instrument `app` and every SQLAlchemy engine it uses."""
+
+    app.config.setdefault('METRICS_ENABLED', True)
+    app.config.setdefault('SERVER_TIMING_HEADER', True)
+    app.config.setdefault('SLOW_QUERY_SECONDS', 0.5)
+
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    # Listening on the Engine class covers every engine, including ones
+    # created later (like read replicas).
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
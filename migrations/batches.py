@@ -0,0 +1,32 @@
+"""Backfills for migrations that don't hold one long transaction.
+
+A backfill over a big table in the migration's own transaction would
+keep every row it touches locked until the migration ends. These run a
+statement over one range of ids at a time, each range committed on its
+own, like the bulk loader's finishing steps.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+# Ids per committed range.
+BATCH_IDS = 10000
+
+
+def in_batches(statement, table):
+    """Run `statement` (SQL with :start and :end bind parameters) for
+    every `[start, end)` range of `table`'s ids.
+
+    Commits whatever the migration has done so far first.
+    """
+
+    conn = op.get_bind()
+    low, high = conn.execute(sa.text(
+        f"SELECT min(id), max(id) FROM {table}")).one()
+    if low is None:
+        return
+
+    with op.get_context().autocommit_block():
+        for start in range(low, high + 1, BATCH_IDS):
+            conn.execute(sa.text(statement),
+                         {'start': start, 'end': start + BATCH_IDS})
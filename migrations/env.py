@@ -0,0 +1,34 @@
+"""Alembic environment: migrate the app's database against `db.metadata`."""
+
+from alembic import context
+
+from app import app
+from models import db
+
+# Postgres can't build an index CONCURRENTLY inside a transaction, so
+# migrations that do use `op.get_context().autocommit_block()`.
+
+
+def run_migrations_offline():
+    """Emit SQL to stdout instead of running it (`alembic upgrade --sql`)."""
+
+    context.configure(url=app.config['SQLALCHEMY_DATABASE_URI'],
+                      target_metadata=db.metadata,
+                      literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    with app.app_context():
+        with db.engine.connect() as connection:
+            context.configure(connection=connection,
+                              target_metadata=db.metadata)
+            with context.begin_transaction():
+                context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
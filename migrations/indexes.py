@@ -0,0 +1,67 @@
+"""Index builds for migrations that don't block writes.
+
+On Postgres every index is built CONCURRENTLY, so writes carry on while
+it builds. That can't happen inside a transaction, and a build that's
+interrupted leaves an INVALID index behind; each one runs in its own
+autocommit block, and an invalid leftover is dropped and rebuilt, so a
+migration using these can be re-run. A partitioned table can't be
+indexed concurrently at all; it gets a plain build.
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def create_index(name, definition, unique=False):
+    """CREATE [UNIQUE] INDEX `name` ON `definition` ("table (columns)"),
+    unless it's already there."""
+
+    unique = 'UNIQUE ' if unique else ''
+
+    if op.get_bind().dialect.name != 'postgresql':
+        op.execute(f'CREATE {unique}INDEX IF NOT EXISTS {name} ON {definition}')
+        return
+
+    if _partitioned(definition.split()[0]):
+        op.execute(f'CREATE {unique}INDEX IF NOT EXISTS {name} ON {definition}')
+        return
+
+    with op.get_context().autocommit_block():
+        if _invalid(name):
+            op.execute(f'DROP INDEX CONCURRENTLY {name}')
+        op.execute(f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {name} '
+                   f'ON {definition}')
+
+
+def drop_index(name):
+    if op.get_bind().dialect.name != 'postgresql':
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+        return
+
+    if _partitioned_index(name):
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+        return
+
+    with op.get_context().autocommit_block():
+        op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+
+def _invalid(name):
+    """Is there an index `name` left INVALID by an interrupted build?"""
+
+    return bool(op.get_bind().execute(sa.text(
+        "SELECT NOT i.indisvalid FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name"), {'name': name}).scalar())
+
+
+def _partitioned(table):
+    return bool(op.get_bind().execute(sa.text(
+        "SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass(:table)"), {'table': table}).scalar())
+
+
+def _partitioned_index(name):
+    return bool(op.get_bind().execute(sa.text(
+        "SELECT 1 FROM pg_class WHERE oid = to_regclass(:name) "
+        "AND relkind = 'I'"), {'name': name}).scalar())
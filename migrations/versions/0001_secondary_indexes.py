@@ -0,0 +1,78 @@
+"""Secondary indexes for feeds, profiles, likes and follower lists
+
+Databases made by `db.create_all()` before this migration have no index
+to serve "messages by time", "likes of a message", or either direction
+of the follower lists, so those queries scan whole tables. This adds
+them (and `follows.created_at`, which the follower lists are ordered
+by).
+
+Every index is built CONCURRENTLY, so writes carry on while it builds
+(see migrations/indexes.py). Re-running the migration is safe.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.indexes import create_index, drop_index
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# name -> (unique?, "table (columns)"), matching models.py.
+INDEXES = {
+    'ix_messages_user_id_timestamp_id':
+        (False, 'messages (user_id, timestamp DESC, id DESC)'),
+    'ix_messages_timestamp_id':
+        (False, 'messages (timestamp DESC, id DESC)'),
+    # What UniqueConstraint('user_id', 'message_id') makes; it also
+    # serves lookups by likes.user_id.
+    'likes_user_id_message_id_key':
+        (True, 'likes (user_id, message_id)'),
+    'ix_likes_message_id':
+        (False, 'likes (message_id)'),
+    'ix_follows_following_created':
+        (False, 'follows (user_following_id, created_at, user_being_followed_id)'),
+    'ix_follows_followed_created':
+        (False, 'follows (user_being_followed_id, created_at, user_following_id)'),
+}
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    columns = {column['name'] for column in sa.inspect(conn).get_columns('follows')}
+    if 'created_at' not in columns:
+        # Existing follows get the migration time; there's nothing better.
+        # In UTC, like the ORM's datetime.utcnow().
+        op.add_column('follows', sa.Column(
+            'created_at', sa.DateTime, nullable=False,
+            server_default=sa.text("timezone('utc', now())")))
+
+    # A unique index can't be built over duplicate likes (possible before
+    # the like toggle became atomic). Run `flask recount` afterwards.
+    op.execute("""
+        DELETE FROM likes
+        WHERE id IN (SELECT id FROM (
+            SELECT id, row_number() OVER (PARTITION BY user_id, message_id
+                                          ORDER BY id) AS n
+            FROM likes) numbered
+        WHERE n > 1)
+    """)
+
+    for name, (unique, definition) in INDEXES.items():
+        create_index(name, definition, unique)
+
+
+def downgrade():
+    # Leaves follows.created_at and the likes uniqueness in place: the
+    # models rely on both.
+    for name, (unique, definition) in INDEXES.items():
+        if not unique:
+            drop_index(name)
+
@@ -0,0 +1,30 @@
+"""Give messages.timestamp a server-side default
+
+The model's default used to be `datetime.utcnow()` -- called once, at
+import -- so every message a process wrote got that process's start
+time. The model now calls it per row; this adds a server default too,
+so rows inserted around the ORM (bulk loads, SQL) get a real time, in
+UTC like the ORM's.
+Timestamps already written can't be recovered.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.alter_column('messages', 'timestamp',
+                    server_default=sa.text("timezone('utc', now())"))
+
+
+def downgrade():
+    op.alter_column('messages', 'timestamp', server_default=None)
@@ -0,0 +1,36 @@
+"""Add the recommendations table
+
+Filled by `flask recommend` (see recommendations.py).
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'recommendations',
+        sa.Column('user_id', sa.Integer,
+                  sa.ForeignKey('users.id', ondelete='cascade'),
+                  primary_key=True),
+        sa.Column('rank', sa.Integer, primary_key=True),
+        sa.Column('recommended_id', sa.Integer,
+                  sa.ForeignKey('users.id', ondelete='cascade'),
+                  nullable=False),
+        sa.Column('score', sa.Integer, nullable=False),
+    )
+    op.create_index('ix_recommendations_recommended_id', 'recommendations',
+                    ['recommended_id'])
+
+
+def downgrade():
+    op.drop_table('recommendations')
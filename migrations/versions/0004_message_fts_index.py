@@ -0,0 +1,30 @@
+"""Add the full-text index over messages
+
+Message search (search.py) reads `ix_messages_text_fts`, which only
+`db.create_all()` used to make. Postgres only: on SQLite,
+`flask reindex-messages` creates the FTS5 table.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+
+from migrations.indexes import create_index, drop_index
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        create_index('ix_messages_text_fts',
+                     "messages USING gin (to_tsvector('english', text))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        drop_index('ix_messages_text_fts')
@@ -0,0 +1,76 @@
+"""Add the denormalized counters and row versions
+
+`users` gets message, following, follower and like counts, `messages` a
+like count, and both a `version` the ORM bumps on every update (the
+profile and message pages build their ETags from it). Without them,
+every page that loads a user fails.
+
+The counts are filled in from the underlying tables, a range of ids at
+a time (see migrations/batches.py); it's `flask recount`, done here.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.batches import in_batches
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+# table -> (counters, their recount)
+COUNTERS = {
+    'users': (('message_count', 'following_count', 'follower_count',
+               'likes_count'), """
+        UPDATE users SET
+            message_count = (SELECT count(*) FROM messages
+                             WHERE messages.user_id = users.id),
+            following_count = (SELECT count(*) FROM follows
+                               WHERE follows.user_following_id = users.id),
+            follower_count = (SELECT count(*) FROM follows
+                              WHERE follows.user_being_followed_id = users.id),
+            likes_count = (SELECT count(*) FROM likes
+                           WHERE likes.user_id = users.id)
+        WHERE id >= :start AND id < :end
+    """),
+    'messages': (('likes_count',), """
+        UPDATE messages SET
+            likes_count = (SELECT count(*) FROM likes
+                           WHERE likes.message_id = messages.id)
+        WHERE id >= :start AND id < :end
+    """),
+}
+
+
+def upgrade():
+    conn = op.get_bind()
+    recounts = []
+
+    for table, (counters, recount) in COUNTERS.items():
+        columns = {column['name']
+                   for column in sa.inspect(conn).get_columns(table)}
+
+        added = [name for name in counters if name not in columns]
+        for name in added:
+            op.add_column(table, sa.Column(name, sa.Integer, nullable=False,
+                                           server_default='0'))
+        if added:
+            recounts.append((recount, table))
+
+        if 'version' not in columns:
+            op.add_column(table, sa.Column('version', sa.Integer,
+                                           nullable=False, server_default='1'))
+
+    for recount, table in recounts:
+        in_batches(recount, table)
+
+
+def downgrade():
+    for table, (counters, recount) in COUNTERS.items():
+        for name in counters + ('version',):
+            op.drop_column(table, name)
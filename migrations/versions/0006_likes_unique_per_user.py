@@ -0,0 +1,40 @@
+"""Make likes unique per user and message, not per message
+
+Databases made by the original `db.create_all()` have `likes.message_id`
+unique, so a message could only ever be liked once, by anybody. This
+drops that constraint and makes the (user_id, message_id) index 0001
+built the unique constraint the models declare; attaching an existing
+index takes no rebuild.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute("ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key")
+
+    attached = op.get_bind().execute(sa.text(
+        "SELECT 1 FROM pg_constraint "
+        "WHERE conname = 'likes_user_id_message_id_key'")).scalar()
+    if not attached:
+        op.execute("ALTER TABLE likes ADD CONSTRAINT likes_user_id_message_id_key "
+                   "UNIQUE USING INDEX likes_user_id_message_id_key")
+
+
+def downgrade():
+    # Nothing: several users liking one message is what likes are for,
+    # and the old constraint would no longer hold.
+    pass
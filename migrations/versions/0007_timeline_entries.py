@@ -0,0 +1,80 @@
+"""Add the materialized home timelines
+
+Creates `timeline_entries` (see timeline.py) and fills it the way
+`timeline.rebuild()` would, a range of readers at a time (see
+migrations/batches.py). If `messages` is already partitioned, there's
+no foreign key to it: see partitions.py.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.batches import in_batches
+from migrations.indexes import _partitioned
+from timeline import FANOUT_READ_THRESHOLD, FANOUT_WRITE_THRESHOLD
+from timeline import TIMELINE_LENGTH
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+# Each reader's newest messages from themselves and the accounts they
+# follow, leaving out who fan-out leaves out.
+BACKFILL = f"""
+    INSERT INTO timeline_entries (user_id, message_id, "timestamp")
+    SELECT user_id, message_id, "timestamp" FROM (
+        SELECT authors.user_id, messages.id AS message_id,
+               messages."timestamp",
+               row_number() OVER (PARTITION BY authors.user_id
+                                  ORDER BY messages."timestamp" DESC,
+                                           messages.id DESC) AS position
+        FROM (SELECT follows.user_following_id AS user_id,
+                     follows.user_being_followed_id AS author_id
+              FROM follows
+              JOIN users reader ON reader.id = follows.user_following_id
+              JOIN users author ON author.id = follows.user_being_followed_id
+              WHERE reader.following_count <= {FANOUT_READ_THRESHOLD}
+                AND author.follower_count <= {FANOUT_WRITE_THRESHOLD}
+                AND follows.user_following_id >= :start
+                AND follows.user_following_id < :end
+              UNION ALL
+              SELECT id, id FROM users
+              WHERE id >= :start AND id < :end) authors
+        JOIN messages ON messages.user_id = authors.author_id) ranked
+    WHERE position <= {TIMELINE_LENGTH}
+"""
+
+
+def upgrade():
+    if 'timeline_entries' in sa.inspect(op.get_bind()).get_table_names():
+        return
+
+    references = [sa.ForeignKey('messages.id', ondelete='cascade')]
+    if op.get_bind().dialect.name == 'postgresql' and _partitioned('messages'):
+        references = []
+
+    op.create_table(
+        'timeline_entries',
+        sa.Column('user_id', sa.Integer,
+                  sa.ForeignKey('users.id', ondelete='cascade'),
+                  primary_key=True),
+        sa.Column('message_id', sa.Integer, *references,
+                  primary_key=True),
+        sa.Column('timestamp', sa.DateTime, nullable=False),
+    )
+    op.create_index('ix_timeline_entries_message_id', 'timeline_entries',
+                    ['message_id'])
+    op.create_index('ix_timeline_entries_user_id_timestamp', 'timeline_entries',
+                    ['user_id', sa.text('timestamp DESC'),
+                     sa.text('message_id DESC')])
+
+    in_batches(BACKFILL, 'users')
+
+
+def downgrade():
+    op.drop_table('timeline_entries')
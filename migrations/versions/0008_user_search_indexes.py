@@ -0,0 +1,57 @@
+"""Add the indexes behind user search
+
+Username prefix matches read `ix_users_username_prefix`; substring
+matches read the trigram GIN indexes, when the `pg_trgm` extension can
+be installed (see search.py). Without it those two are skipped and
+search ranks by length instead. Postgres only.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.indexes import create_index, drop_index
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+PREFIX_INDEX = ('ix_users_username_prefix',
+                'users ((lower(username) COLLATE "C"))')
+
+TRIGRAM_INDEXES = {
+    'ix_users_username_trgm': 'users USING gin (username gin_trgm_ops)',
+    'ix_users_location_trgm': 'users USING gin (location gin_trgm_ops)',
+}
+
+
+def upgrade():
+    conn = op.get_bind()
+    if conn.dialect.name != 'postgresql':
+        return
+
+    create_index(*PREFIX_INDEX)
+
+    available = conn.execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions "
+        "WHERE name = 'pg_trgm'")).scalar()
+    if not available:
+        return
+
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    for name, definition in TRIGRAM_INDEXES.items():
+        create_index(name, definition)
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    # The extension stays: other things may use it.
+    for name in TRIGRAM_INDEXES:
+        drop_index(name)
+    drop_index(PREFIX_INDEX[0])
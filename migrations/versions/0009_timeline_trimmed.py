@@ -0,0 +1,38 @@
+"""Mark home timelines that are missing older entries
+
+Adds `users.timeline_trimmed` (see timeline.py). Which existing
+timelines were trimmed and then shrank through unfollows or deletes
+can't be told from what's left, so every user with a timeline starts
+out marked: reading past its end checks `messages` for more.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-17
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+from migrations.batches import in_batches
+
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('timeline_trimmed', sa.Boolean,
+                                     nullable=False,
+                                     server_default=sa.false()))
+
+    in_batches("""
+        UPDATE users SET timeline_trimmed = true
+        WHERE id >= :start AND id < :end
+          AND EXISTS (SELECT 1 FROM timeline_entries
+                      WHERE timeline_entries.user_id = users.id)
+    """, 'users')
+
+
+def downgrade():
+    op.drop_column('users', 'timeline_trimmed')
@@ -2,11 +2,39 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.functions import FunctionElement
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import database
+from hashing import hasher
+from write_behind import write_queue
+
+db = database.RoutingSQLAlchemy()
+
+
+class utcnow(FunctionElement):
+    """The database's current time in UTC, as a naive timestamp.
+
+    The server-side twin of `datetime.utcnow`: plain `now()` would give
+    rows written around the ORM the server's local time instead.
+    """
+
+    type = db.DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "timezone('utc', now())"
+
+
+@compiles(utcnow)
+def _utcnow(element, compiler, **kw):
+    # SQLite's CURRENT_TIMESTAMP is already UTC.
+    return "CURRENT_TIMESTAMP"
 
 
 class Follows(db.Model):
@@ -14,6 +42,16 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key serves "who follows X?" lookups; these serve the
+    # follower and following lists, newest follow first, in both
+    # directions.
+    __table_args__ = (
+        db.Index('ix_follows_following_created',
+                 'user_following_id', 'created_at', 'user_being_followed_id'),
+        db.Index('ix_follows_followed_created',
+                 'user_being_followed_id', 'created_at', 'user_following_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -26,12 +64,36 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The server default covers bulk-loaded rows.
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    @classmethod
+    def exists(cls, followed_id, follower_id):
+        """Does `follower_id` follow `followed_id`? One primary-key probe."""
+
+        query = cls.query.filter_by(user_being_followed_id=followed_id,
+                                    user_following_id=follower_id)
+        return db.session.query(query.exists()).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
 
+    # A user likes a message at most once; many users may like it. The
+    # unique index also serves lookups by user; the other one serves
+    # lookups (and cascaded deletes) by message.
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True
@@ -45,9 +107,77 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Unlike the message if `user_id` likes it, otherwise like it."""
+
+        if cls._delete(user_id, message_id):
+            return False, cls._count(message_id)
+        return cls.set(user_id, message_id, True)
+
+    @classmethod
+    def set(cls, user_id, message_id, liked):
+        """Make `user_id` like (or not like) the message.
+
+        Setting the state it's already in changes nothing, so a retried
+        or doubled request is harmless. Both directions are single
+        statements against `likes`, and the counters move in the same
+        transaction; the caller commits. Returns `(liked, likes_count)`.
+        """
+
+        if liked:
+            cls._insert(user_id, message_id)
+        else:
+            cls._delete(user_id, message_id)
+        return liked, cls._count(message_id)
+
+    # These go around the unit of work, so they keep the counters
+    # themselves rather than relying on the mapper events below.
+
+    @classmethod
+    def _insert(cls, user_id, message_id):
+        likes = cls.__table__
+        dialect = db.session().get_bind().dialect.name
+
+        if dialect == 'postgresql':
+            insert = (postgresql.insert(likes)
+                      .on_conflict_do_nothing(
+                          index_elements=[likes.c.user_id, likes.c.message_id]))
+        elif dialect == 'sqlite':
+            insert = likes.insert().prefix_with('OR IGNORE')
+        else:
+            insert = likes.insert()
+
+        inserted = db.session.execute(
+            insert.values(user_id=user_id, message_id=message_id)).rowcount
+        if inserted:
+            connection = db.session.connection()
+            _bump(connection, User, user_id, 'likes_count', 1)
+            _bump(connection, Message, message_id, 'likes_count', 1)
+        return inserted
+
+    @classmethod
+    def _delete(cls, user_id, message_id):
+        likes = cls.__table__
+        deleted = db.session.execute(
+            likes.delete()
+            .where(likes.c.user_id == user_id)
+            .where(likes.c.message_id == message_id)).rowcount
+        if deleted:
+            connection = db.session.connection()
+            _bump(connection, User, user_id, 'likes_count', -1)
+            _bump(connection, Message, message_id, 'likes_count', -1)
+        return deleted
+
+    @staticmethod
+    def _count(message_id):
+        return (db.session
+                .query(Message.likes_count)
+                .filter(Message.id == message_id)
+                .scalar())
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,41 +224,142 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counters, kept in step by the mapper events at the
+    # bottom of this module; `User.recount()` repairs any drift.
+
+    message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Set once older entries have been cut from the user's home timeline
+    # (see timeline.py); reading past its end then goes to `messages`.
+    timeline_trimmed = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # Bumped by every ORM update of the profile; pages showing the user
+    # build their ETags from it.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default='1',
+    )
+
+    __mapper_args__ = {'version_id_col': version}
+
+    # The database cascades messages, follows and likes away when a user
+    # is deleted (after the before_delete hook below has uncounted them),
+    # so the ORM needn't load and delete them row by row -- or, for
+    # messages it has loaded, try to null out their user_id.
+
+    messages = db.relationship('Message', passive_deletes='all')
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        passive_deletes=True,
     )
 
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    # The lookups below include writes still in the write-behind queue
+    # (see write_behind.py), so people always see their own follows and
+    # likes.
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        pending = write_queue.pending('follow', self.id, [other_user.id])
+        if pending:
+            return pending[other_user.id]
+        return Follows.exists(followed_id=other_user.id, follower_id=self.id)
+
+    def following_status(self, user_ids):
+        """Which of `user_ids` is this user following?
+
+        Returns a set of ids, found with one query -- use this on list
+        pages rather than calling `is_following` per row.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+        return write_queue.overlay('follow', self.id,
+                                   {followed_id for (followed_id,) in rows},
+                                   user_ids)
+
+    def liked_among(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Returns a set of ids, found with one query over just those
+        messages -- pass it the ids on the page being shown.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids)))
+        return write_queue.overlay('like', self.id,
+                                   {message_id for (message_id,) in rows},
+                                   message_ids)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +368,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.generate(password)
 
         user = User(
             username=username,
@@ -158,17 +389,46 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made at a different bcrypt cost than we're
+        configured for, it's replaced; the caller commits.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.generate(password)
                 return user
 
         return False
 
+    @classmethod
+    def recount(cls, start=None, end=None):
+        """Recompute users' counters from the underlying tables.
+
+        This is one set-based UPDATE over users with ids in `[start,
+        end)` (by default, all of them). After a bulk load, go a range
+        at a time so no one transaction rewrites the whole table.
+        """
+
+        users = cls.__table__
+
+        def count(table, column):
+            return (select([func.count()])
+                    .where(column == users.c.id)
+                    .as_scalar())
+
+        update = _id_range(users.update(), users.c.id, start, end)
+        db.session.execute(update.values(
+            message_count=count(Message.__table__, Message.user_id),
+            following_count=count(Follows.__table__, Follows.user_following_id),
+            follower_count=count(Follows.__table__, Follows.user_being_followed_id),
+            likes_count=count(Likes.__table__, Likes.user_id),
+        ))
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
@@ -188,7 +448,8 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -197,14 +458,283 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized like count, kept like the User counters.
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        server_default='1',
+    )
+
+    __mapper_args__ = {'version_id_col': version}
+
     user = db.relationship('User')
 
+    @classmethod
+    def recount(cls, start=None, end=None):
+        """Recompute like counts from `likes`, for messages with ids in
+        `[start, end)` (by default, all of them)."""
+
+        messages = cls.__table__
+        update = _id_range(messages.update(), messages.c.id, start, end)
+        db.session.execute(update.values(
+            likes_count=(select([func.count()])
+                         .where(Likes.message_id == messages.c.id)
+                         .as_scalar())))
+
+
+# Profile pages (and keyset pagination over them) walk one user's
+# messages newest-first; this serves both as one index seek.
+db.Index(
+    'ix_messages_user_id_timestamp_id',
+    Message.user_id,
+    Message.timestamp.desc(),
+    Message.id.desc(),
+)
+
+# Newest messages across many authors: the fan-out-on-read feed for
+# users who follow a great many accounts walks this backwards.
+db.Index(
+    'ix_messages_timestamp_id',
+    Message.timestamp.desc(),
+    Message.id.desc(),
+)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+# Home page reads are a single range scan over one user's newest entries.
+db.Index(
+    'ix_timeline_entries_user_id_timestamp',
+    TimelineEntry.user_id,
+    TimelineEntry.timestamp.desc(),
+    TimelineEntry.message_id.desc(),
+)
+
+
+class Recommendation(db.Model):
+    """An account suggested to a user, precomputed by recommendations.py."""
+
+    __tablename__ = 'recommendations'
+
+    # The key is also the serving index: one user's suggestions, in order.
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recommended_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+        index=True,
+    )
+
+    # How many of the accounts `user_id` follows also follow this one.
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+##############################################################################
+# Counter maintenance
+#
+# These run on the flush's own connection, so the counters change in the
+# same transaction as the rows they count. Writes that go around the ORM
+# unit of work (bulk inserts, COPY) don't fire them -- run `flask
+# recount` after those.
+
+
+def _id_range(statement, column, start, end):
+    if start is not None:
+        statement = statement.where(column >= start)
+    if end is not None:
+        statement = statement.where(column < end)
+    return statement
+
+
+def _bump(connection, model, id, counter, delta):
+    """Add `delta` to the `counter` column of `model` row `id`."""
+
+    table = model.__table__
+    connection.execute(
+        table.update()
+        .where(table.c.id == id)
+        .values({counter: table.c[counter] + delta}))
+
+
+@event.listens_for(Message, 'after_insert')
+def _message_inserted(mapper, connection, message):
+    _bump(connection, User, message.user_id, 'message_count', 1)
+
+
+@event.listens_for(Message, 'before_delete')
+def _message_deleted(mapper, connection, message):
+    _bump(connection, User, message.user_id, 'message_count', -1)
+
+    # Uncount the message's likes, then delete them: a partitioned
+    # `messages` (see partitions.py) has no foreign key to cascade them.
+    users = User.__table__
+    likers = select([Likes.user_id]).where(Likes.message_id == message.id)
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(likers))
+        .values(likes_count=users.c.likes_count - 1))
+    connection.execute(
+        Likes.__table__.delete().where(Likes.message_id == message.id))
+
+
+@event.listens_for(Follows, 'after_insert')
+def _follow_inserted(mapper, connection, follow):
+    _bump(connection, User, follow.user_following_id, 'following_count', 1)
+    _bump(connection, User, follow.user_being_followed_id, 'follower_count', 1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def _follow_deleted(mapper, connection, follow):
+    _bump(connection, User, follow.user_following_id, 'following_count', -1)
+    _bump(connection, User, follow.user_being_followed_id, 'follower_count', -1)
+
+
+@event.listens_for(Likes, 'after_insert')
+def _like_inserted(mapper, connection, like):
+    _bump(connection, User, like.user_id, 'likes_count', 1)
+    _bump(connection, Message, like.message_id, 'likes_count', 1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def _like_deleted(mapper, connection, like):
+    _bump(connection, User, like.user_id, 'likes_count', -1)
+    _bump(connection, Message, like.message_id, 'likes_count', -1)
+
+
+# The `following`, `followers` and `likes` collections write their rows
+# straight into the association tables, with no Follows or Likes object
+# for the events above to see. Their history still holds what was added
+# and removed until the flush ends: collection -> (the user's counter,
+# the other side's model and counter).
+COLLECTION_COUNTERS = {
+    'following': ('following_count', User, 'follower_count'),
+    'followers': ('follower_count', User, 'following_count'),
+    'likes': ('likes_count', Message, 'likes_count'),
+}
+
+
+@event.listens_for(Session, 'after_flush')
+def _collections_flushed(session, context):
+    for user in list(session.new) + list(session.dirty):
+        if not isinstance(user, User):
+            continue
+
+        attrs = inspect(user).attrs
+        for name, (counter, model, other) in COLLECTION_COUNTERS.items():
+            added, _, removed = attrs[name].history
+            if not added and not removed:
+                continue
+
+            connection = session.connection()
+            _bump(connection, User, user.id, counter, len(added) - len(removed))
+            for target in added:
+                _bump(connection, model, target.id, other, 1)
+            for target in removed:
+                _bump(connection, model, target.id, other, -1)
+
+
+@event.listens_for(User, 'before_delete')
+def _user_deleted(mapper, connection, user):
+    # The database cascades away this user's follows and messages;
+    # uncount them on the other side first.
+    users = User.__table__
+
+    followed = (select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user.id))
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(followed))
+        .values(follower_count=users.c.follower_count - 1))
+
+    followers = (select([Follows.user_following_id])
+                 .where(Follows.user_being_followed_id == user.id))
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(followers))
+        .values(following_count=users.c.following_count - 1))
+
+    liked_here = (select([func.count()])
+                  .select_from(Likes.__table__.join(
+                      Message.__table__, Likes.message_id == Message.id))
+                  .where(Likes.user_id == users.c.id)
+                  .where(Message.user_id == user.id)
+                  .as_scalar())
+    likers = (select([Likes.user_id])
+              .select_from(Likes.__table__.join(
+                  Message.__table__, Likes.message_id == Message.id))
+              .where(Message.user_id == user.id))
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(likers))
+        .values(likes_count=users.c.likes_count - liked_here))
+
+    # Nothing cascades from a partitioned `messages`; clear out what
+    # points at this user's messages ourselves.
+    authored = select([Message.id]).where(Message.user_id == user.id)
+    connection.execute(
+        Likes.__table__.delete().where(Likes.message_id.in_(authored)))
+    connection.execute(
+        TimelineEntry.__table__.delete()
+        .where(TimelineEntry.message_id.in_(authored)))
+
+    # ...and this user's own likes on everyone else's messages.
+    messages = Message.__table__
+    connection.execute(
+        messages.update()
+        .where(messages.c.id.in_(
+            select([Likes.message_id]).where(Likes.user_id == user.id)))
+        .values(likes_count=messages.c.likes_count - 1))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. Pool and timeout settings
+    come from the `DB_*` config keys (see database.py).
     """
 
+    database.configure(app)
     db.app = app
     db.init_app(app)
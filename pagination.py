@@ -0,0 +1,106 @@
+"""Keyset (cursor) pagination for Warbler.
+
+Lists are ordered newest-first on a `(timestamp, id)` key. Instead of an
+OFFSET, the next page starts strictly after the last row we showed, so
+any page -- however deep -- costs one index seek.
+
+The position is handed to the client as an opaque `?before=` token.
+Other orderings (like search relevance) reuse the same tokens with a
+number in place of the timestamp.
+
+Batch jobs walk whole tables the same way, a range of ids at a time:
+see `id_ranges()`.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import func, tuple_
+from werkzeug.exceptions import BadRequest
+
+from models import db
+
+
+class Page:
+    """One page of results, plus the token for the page after it."""
+
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque token from a `(timestamp, id)` key.
+
+    `timestamp` may also be a plain number.
+    """
+
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+
+    raw = json.dumps([timestamp, id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Turn a token from `encode_cursor` back into `(timestamp, id)`.
+
+    A missing token means "start from the top" and gives None. A token
+    that wasn't made by us is a 400.
+    """
+
+    if not token:
+        return None
+
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        timestamp, id = json.loads(raw.decode('utf-8'))
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        elif not isinstance(timestamp, (int, float)):
+            raise TypeError(timestamp)
+        return timestamp, int(id)
+    except (ValueError, TypeError):
+        raise BadRequest("Invalid page cursor.")
+
+
+def paginate(query, timestamp_col, id_col, before=None, per_page=100,
+             key=None):
+    """Get one newest-first page of `query`, keyed on `(timestamp_col, id_col)`.
+
+    `before` is a decoded cursor (or None for the first page). `key` pulls
+    the `(timestamp, id)` pair out of a result row; by default the row's
+    own `timestamp` and `id` attributes are used.
+    """
+
+    if before is not None:
+        query = query.filter(tuple_(timestamp_col, id_col) < tuple_(*before))
+
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) <= per_page:
+        return Page(rows)
+
+    rows = rows[:per_page]
+    key = key or (lambda row: (row.timestamp, row.id))
+    return Page(rows, encode_cursor(*key(rows[-1])))
+
+
+def id_ranges(column, size):
+    """`[start, end)` bounds covering every value of the integer primary
+    key `column`, `size` ids apiece."""
+
+    low, high = db.session.query(func.min(column), func.max(column)).one()
+    if low is None:
+        return []
+    return [(start, start + size) for start in range(low, high + 1, size)]
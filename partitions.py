@@ -0,0 +1,211 @@
+"""Monthly range partitioning of Warbler's messages (Postgres only).
+
+`partition_messages()` turns `messages` into a table partitioned by
+month on `timestamp`: one child table per month (`messages_y2020m01`)
+plus a default partition that catches anything outside them. Then:
+
+- Newest-first reads (`ORDER BY timestamp DESC LIMIT n`) walk the
+  newest partition first and stop, and reads bounded by time skip the
+  partitions outside the bounds.
+- Retention is `drop_partitions()`: each old month is detached and
+  dropped (or kept as an archive table) instead of deleted row by row.
+- The bulk loader creates the months it's about to load into, so a
+  seed goes straight into the right partitions.
+
+Postgres requires a partitioned table's primary key to include the
+partition column, so the key becomes `(id, timestamp)`. Nothing can
+then reference `messages.id` alone, so the foreign keys from `likes` and
+`timeline_entries` are dropped. Their rows are cleaned up by the
+application instead: see `_message_deleted`/`_user_deleted` in
+models.py, and `drop_partitions()` here.
+
+Partitions don't appear in db.metadata; `db.create_all()` still makes a
+plain table. Run `flask add-partitions` monthly (from cron) so new
+messages land in their own month rather than the default partition.
+"""
+
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models import db
+
+# Months created past the current one, so inserts always have a home.
+MONTHS_AHEAD = 3
+
+DEFAULT_PARTITION = 'messages_default'
+
+NAME = re.compile(r'^messages_y(\d{4})m(\d{2})$')
+
+
+def month_of(when):
+    """The first moment of `when`'s month."""
+
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'messages_y{month.year:04d}m{month.month:02d}'
+
+
+def is_partitioned():
+    """Is `messages` a partitioned table?"""
+
+    if db.engine.dialect.name != 'postgresql':
+        return False
+
+    return bool(db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass('messages')")).scalar())
+
+
+def partition_messages(months_ahead=MONTHS_AHEAD):
+    """Convert `messages` to a partitioned table, keeping its rows.
+
+    Everything happens in the session's transaction, under an exclusive
+    lock on `messages`; run it in a maintenance window. The caller
+    commits.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        raise RuntimeError("partitioning needs Postgres")
+    if is_partitioned():
+        return
+
+    execute = db.session.execute
+
+    # Rebuilt as-is on the new table: models.py's, and search's GIN index.
+    index_definitions = execute(text(
+        "SELECT indexdef FROM pg_indexes "
+        "WHERE tablename = 'messages' AND indexname != 'messages_pkey'"
+    )).scalars().all()
+
+    execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+    execute(text(
+        "CREATE TABLE messages "
+        "(LIKE messages_unpartitioned INCLUDING DEFAULTS) "
+        'PARTITION BY RANGE ("timestamp")'))
+    # Otherwise the id sequence goes when the old table does.
+    execute(text("ALTER SEQUENCE messages_id_seq OWNED BY messages.id"))
+    execute(text(f"CREATE TABLE {DEFAULT_PARTITION} "
+                 "PARTITION OF messages DEFAULT"))
+
+    oldest, newest = execute(text(
+        'SELECT min("timestamp"), max("timestamp") '
+        "FROM messages_unpartitioned")).one()
+    now = datetime.utcnow()
+    ensure_partitions(min(oldest or now, now), max(newest or now, now),
+                      months_ahead)
+
+    execute(text("INSERT INTO messages SELECT * FROM messages_unpartitioned"))
+    # CASCADE takes the foreign keys from likes and timeline_entries.
+    execute(text("DROP TABLE messages_unpartitioned CASCADE"))
+
+    execute(text('ALTER TABLE messages ADD CONSTRAINT messages_pkey '
+                 'PRIMARY KEY (id, "timestamp")'))
+    execute(text("ALTER TABLE messages ADD CONSTRAINT messages_user_id_fkey "
+                  "FOREIGN KEY (user_id) REFERENCES users (id) "
+                  "ON DELETE CASCADE"))
+    for definition in index_definitions:
+        execute(text(definition))
+
+
+def ensure_partitions(start, end, months_ahead=0):
+    """Make sure every month from `start`'s to `end`'s (plus
+    `months_ahead` more) has its own partition.
+
+    Returns the names of the partitions created.
+    """
+
+    month = month_of(start)
+    last = month_of(end)
+    for _ in range(months_ahead):
+        last = next_month(last)
+
+    existing = set(partition_names())
+    created = []
+    while month <= last:
+        if partition_name(month) not in existing:
+            created.append(_create_partition(month))
+        month = next_month(month)
+    return created
+
+
+def partition_names():
+    """Names of the monthly partitions, oldest first."""
+
+    names = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('messages')")).scalars().all()
+    return sorted(name for name in names if NAME.match(name))
+
+
+def _create_partition(month):
+    """Add `month`'s partition, moving its rows out of the default one.
+
+    Attaching checks the default partition holds nothing in the new
+    range, so its rows move first.
+    """
+
+    name = partition_name(month)
+    bounds = {'start': month, 'end': next_month(month)}
+    execute = db.session.execute
+
+    execute(text(f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS)"))
+    execute(text(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+        '                WHERE "timestamp" >= :start AND "timestamp" < :end '
+        "                RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"), bounds)
+    execute(text(f"ALTER TABLE messages ATTACH PARTITION {name} "
+                 "FOR VALUES FROM (:start) TO (:end)"), bounds)
+    return name
+
+
+def drop_partitions(before, archive=False):
+    """Remove every monthly partition that ends on or before `before`.
+
+    Each one is detached, then the likes and timeline entries of its
+    messages are deleted and the users' counters adjusted to match.
+    With `archive`, the detached table is kept (to dump or move
+    elsewhere) instead of dropped. Returns the partitions' names.
+    The caller commits.
+    """
+
+    execute = db.session.execute
+    removed = []
+
+    for name in partition_names():
+        year, month = map(int, NAME.match(name).groups())
+        if next_month(datetime(year, month, 1)) > before:
+            continue
+
+        execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+
+        execute(text(
+            "UPDATE users SET message_count = users.message_count - gone.n "
+            f"FROM (SELECT user_id, count(*) AS n FROM {name} "
+            "      GROUP BY user_id) gone "
+            "WHERE users.id = gone.user_id"))
+        execute(text(
+            "UPDATE users SET likes_count = users.likes_count - gone.n "
+            "FROM (SELECT likes.user_id, count(*) AS n FROM likes "
+            f"      JOIN {name} m ON m.id = likes.message_id "
+            "      GROUP BY likes.user_id) gone "
+            "WHERE users.id = gone.user_id"))
+        execute(text(f"DELETE FROM likes USING {name} m "
+                     "WHERE likes.message_id = m.id"))
+        execute(text(f"DELETE FROM timeline_entries USING {name} m "
+                     "WHERE timeline_entries.message_id = m.id"))
+
+        if not archive:
+            execute(text(f"DROP TABLE {name}"))
+        removed.append(name)
+
+    return removed
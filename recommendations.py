@@ -0,0 +1,291 @@
+""""Who to follow" recommendations for Warbler.
+
+An account is suggested to a user when accounts that user follows also
+follow it; its score is how many of them do (friends-of-friends). Scores
+are computed offline by `rebuild()` (`flask recommend`, run from cron)
+and stored in `recommendations`, so serving them is a single index range
+read: see `for_user()`.
+
+The batch job never goes through the ORM. It streams `follows` into
+NumPy integer arrays, renumbers user ids densely, and builds a CSR
+adjacency (row `u` of `indices[indptr[u]:indptr[u + 1]]` is who user `u`
+follows). Users are scored in slices across a process pool that shares
+those arrays (copy-on-write where the platform forks), and each slice's
+top K goes into the table with COPY as it arrives. The old
+recommendations stay visible until the new set commits.
+"""
+
+import io
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+
+import numpy as np
+from sqlalchemy import and_, exists
+
+from models import db, Follows, Recommendation, User
+
+# Suggestions kept per user.
+TOP_K = 20
+
+# Users following more accounts than this are scored from a random
+# sample of them (seeded by user, so reruns agree): the work is the sum
+# of the followed accounts' own follow counts.
+MAX_FOLLOWED = 1000
+
+# Edges fetched per round trip while reading `follows`.
+FETCH_ROWS = 1000000
+
+# Users per task handed to a worker.
+SLICE_USERS = 5000
+
+recommendations = Recommendation.__table__
+
+
+def for_user(user_id, limit=TOP_K):
+    """The accounts suggested to `user_id`, best first: rows of `id`,
+    `username`, `image_url`, `bio` and `score`.
+
+    Accounts followed since the last rebuild are left out.
+    """
+
+    followed = exists().where(and_(
+        Follows.user_following_id == user_id,
+        Follows.user_being_followed_id == Recommendation.recommended_id))
+
+    return (db.session
+            .query(User.id, User.username, User.image_url, User.bio,
+                   Recommendation.score)
+            .join(Recommendation, Recommendation.recommended_id == User.id)
+            .filter(Recommendation.user_id == user_id, ~followed)
+            .order_by(Recommendation.rank)
+            .limit(limit)
+            .all())
+
+
+def rebuild(top_k=TOP_K, workers=None, out=sys.stdout):
+    """Recompute every user's recommendations; returns the rows written.
+
+    `workers` defaults to one process per CPU; with 1, everything runs
+    in this process.
+    """
+
+    started = perf_counter()
+    ids, indptr, indices = read_graph()
+    print(f"recommend: read {len(indices):,} follows between "
+          f"{len(ids):,} users in {perf_counter() - started:.1f}s",
+          file=out, flush=True)
+
+    slices = [(start, min(start + SLICE_USERS, len(ids)))
+              for start in range(0, len(ids), SLICE_USERS)]
+
+    # Workers start before the write connection opens, so none of them
+    # inherits it.
+    with _scorer(indptr, indices, top_k, workers) as score:
+        raw = db.engine.raw_connection()
+        try:
+            cursor = raw.cursor()
+            cursor.execute(str(recommendations.delete()))
+            written = 0
+
+            for users, ranks, candidates, scores in score(slices):
+                rows = np.column_stack(
+                    (ids[users], ranks, ids[candidates], scores))
+                _write(cursor, rows)
+                written += len(rows)
+
+            raw.commit()
+        finally:
+            raw.close()
+
+    print(f"recommend: wrote {written:,} recommendations in "
+          f"{perf_counter() - started:.1f}s", file=out, flush=True)
+    return written
+
+
+def read_graph():
+    """Load `follows` as a CSR adjacency over dense user numbers.
+
+    Returns `(ids, indptr, indices)`: `ids[n]` is user number `n`'s id,
+    and user `n` follows user numbers `indices[indptr[n]:indptr[n + 1]]`.
+    """
+
+    if db.engine.dialect.name == 'postgresql':
+        src, dst = _copy_edges()
+    else:
+        src, dst = _fetch_edges()
+
+    ids = np.unique(np.concatenate((src, dst)))
+    src = np.searchsorted(ids, src).astype(np.int32)
+    dst = np.searchsorted(ids, dst).astype(np.int32)
+
+    indices = dst[np.argsort(src, kind='stable')]
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(ids)), out=indptr[1:])
+    return ids, indptr, indices
+
+
+def _fetch_edges():
+    """(followers, followed) arrays, a chunk of rows at a time."""
+
+    followers, followed = [], []
+    with db.engine.connect() as conn:
+        result = (conn.execution_options(stream_results=True)
+                  .execute(db.select([Follows.user_following_id,
+                                      Follows.user_being_followed_id])))
+        for chunk in result.partitions(FETCH_ROWS):
+            edges = np.array(chunk, dtype=np.int64).reshape(-1, 2)
+            followers.append(edges[:, 0])
+            followed.append(edges[:, 1])
+
+    if not followers:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    return np.concatenate(followers), np.concatenate(followed)
+
+
+def _copy_edges():
+    """Postgres: (followers, followed) arrays, parsed straight out of a
+    binary COPY."""
+
+    buf = io.BytesIO()
+    raw = db.engine.raw_connection()
+    try:
+        raw.cursor().copy_expert(
+            "COPY (SELECT user_following_id, user_being_followed_id "
+            "FROM follows) TO STDOUT WITH (FORMAT binary)", buf)
+        raw.rollback()
+    finally:
+        raw.close()
+
+    dtype = _row_dtype(2)
+    size = buf.tell() - len(PGCOPY_HEADER) - len(PGCOPY_TRAILER)
+    edges = np.frombuffer(buf.getbuffer(), dtype, count=size // dtype.itemsize,
+                          offset=len(PGCOPY_HEADER))
+    return edges['f0'].astype(np.int64), edges['f1'].astype(np.int64)
+
+
+def top_k(user, indptr, indices, k=TOP_K):
+    """Score user number `user`'s friends-of-friends.
+
+    Returns `(candidates, scores)` for the best `k`, by score and then
+    lowest user number.
+    """
+
+    followed = indices[indptr[user]:indptr[user + 1]]
+    if len(followed) > MAX_FOLLOWED:
+        rng = np.random.default_rng(user)
+        via = rng.choice(followed, MAX_FOLLOWED, replace=False)
+    else:
+        via = followed
+
+    # Concatenate the rows of everyone in `via` without a Python loop.
+    starts = indptr[via]
+    lengths = indptr[via + 1] - starts
+    reached = indices[np.repeat(starts - np.cumsum(lengths) + lengths,
+                                lengths) + np.arange(lengths.sum())]
+
+    candidates, scores = np.unique(reached, return_counts=True)
+    fresh = ~np.isin(candidates, followed) & (candidates != user)
+    candidates, scores = candidates[fresh], scores[fresh]
+
+    best = np.argsort(-scores, kind='stable')[:k]
+    return candidates[best], scores[best]
+
+
+##############################################################################
+# Process pool
+#
+# Workers get the graph once, when they start, rather than with every
+# slice they score.
+
+_graph = None
+
+
+def _init_worker(indptr, indices, k):
+    global _graph
+    _graph = (indptr, indices, k)
+
+
+def _score_slice(bounds):
+    """Top K for user numbers in `range(*bounds)`, as flat arrays of
+    (user, rank, candidate, score)."""
+
+    indptr, indices, k = _graph
+    users, ranks, candidates, scores = [], [], [], []
+
+    for user in range(*bounds):
+        found, score = top_k(user, indptr, indices, k)
+        users.append(np.full(len(found), user, dtype=np.int32))
+        ranks.append(np.arange(1, len(found) + 1, dtype=np.int32))
+        candidates.append(found)
+        scores.append(score)
+
+    if not users:
+        return (np.empty(0, np.int32),) * 4
+    return tuple(np.concatenate(column)
+                 for column in (users, ranks, candidates, scores))
+
+
+@contextmanager
+def _scorer(indptr, indices, k, workers):
+    """A function scoring a list of slices, yielding each one's results
+    in order as they finish."""
+
+    if workers == 1:
+        _init_worker(indptr, indices, k)
+        yield lambda slices: map(_score_slice, slices)
+        return
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+    with ProcessPoolExecutor(workers, mp_context=context,
+                             initializer=_init_worker,
+                             initargs=(indptr, indices, k)) as pool:
+        # Forked workers all start on the first submission; make it now.
+        pool.submit(int).result()
+        yield lambda slices: pool.map(_score_slice, slices)
+
+
+def _write(cursor, rows):
+    """Add `rows` of (user_id, rank, recommended_id, score)."""
+
+    if not len(rows):
+        return
+
+    if db.engine.dialect.name == 'postgresql':
+        binary = np.zeros(len(rows), _row_dtype(4))
+        binary['fields'] = 4
+        for n in range(4):
+            binary[f'length{n}'] = 4
+            binary[f'f{n}'] = rows[:, n]
+
+        buf = io.BytesIO(PGCOPY_HEADER + binary.tobytes() + PGCOPY_TRAILER)
+        cursor.copy_expert(
+            "COPY recommendations (user_id, rank, recommended_id, score) "
+            "FROM STDIN WITH (FORMAT binary)", buf)
+    else:
+        cursor.executemany(
+            str(recommendations.insert().compile(
+                dialect=db.engine.dialect,
+                column_keys=['user_id', 'rank', 'recommended_id', 'score'])),
+            rows.tolist())
+
+
+##############################################################################
+# Postgres binary COPY
+#
+# Every column we copy is a non-null int4, so each row is a fixed-size
+# record: a field count, then a length and a big-endian value per field.
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + bytes(8)
+PGCOPY_TRAILER = b'\xff\xff'
+
+
+def _row_dtype(fields):
+    columns = [('fields', '>i2')]
+    for n in range(fields):
+        columns += [(f'length{n}', '>i4'), (f'f{n}', '>i4')]
+    return np.dtype(columns)
@@ -0,0 +1,376 @@
+"""Search for Warbler.
+
+Users
+-----
+
+Username/location search matches substrings and ranks prefix matches on
+the username first, then by trigram similarity. On Postgres, at most
+MAX_CANDIDATES matches are ranked per search: prefix matches come off
+an index on `lower(username)`, substring matches off GIN trigram
+indexes when `pg_trgm` and both indexes are there, so the cost tracks
+the cap rather than the size of `users`. Without them, substring matches
+are a plain ILIKE scan that stops at the cap, ranked by length instead
+of similarity. Queries too short to have a trigram only match username
+prefixes, straight off the prefix index.
+
+On SQLite (test runs) we keep an equivalent trigram index in process
+memory, built on first use and kept up to date by mapper events.
+Candidates it finds are always re-checked against the database, so a
+stale entry can't surface a wrong user.
+
+Messages
+--------
+
+Full-text search over warbles is ranked by relevance and paged with the
+same opaque cursors as the feeds. On Postgres it uses a GIN index over
+`to_tsvector('english', text)`, which Postgres maintains as rows change.
+On SQLite it uses an FTS5 shadow table, `messages_fts`, which
+`index_message()`/`unindex_message()` keep in step with `messages_add()`
+and `messages_destroy()`. `reindex_messages()` rebuilds either from
+scratch after a bulk load.
+"""
+
+import threading
+from collections import defaultdict
+
+from sqlalchemy import DDL, case, column, event, func, literal_column, or_
+from sqlalchemy import bindparam, table, text
+from sqlalchemy.orm import joinedload
+
+from models import db, Message, User
+from pagination import Page, paginate
+
+# Postgres only; wrapped so a server without contrib still gets its tables.
+TRIGRAM_DDL = DDL("""
+DO $$
+BEGIN
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+    CREATE INDEX IF NOT EXISTS ix_users_username_trgm
+        ON users USING gin (username gin_trgm_ops);
+    CREATE INDEX IF NOT EXISTS ix_users_location_trgm
+        ON users USING gin (location gin_trgm_ops);
+EXCEPTION WHEN OTHERS THEN
+    RAISE NOTICE 'pg_trgm unavailable: %', SQLERRM;
+END
+$$;
+""".replace('%', '%%'))
+
+# Anchored prefix matches and their order, with one index range scan.
+PREFIX_DDL = DDL("""
+    CREATE INDEX IF NOT EXISTS ix_users_username_prefix
+        ON users ((lower(username) COLLATE "C"))
+""")
+
+TRIGRAM_INDEXES = ('ix_users_username_trgm', 'ix_users_location_trgm')
+
+for ddl in (TRIGRAM_DDL, PREFIX_DDL):
+    event.listen(User.__table__, 'after_create',
+                 ddl.execute_if(dialect='postgresql'))
+
+# Most matches ranked by one Postgres search.
+MAX_CANDIDATES = 1000
+
+MESSAGE_FTS_DDL = {
+    'postgresql': DDL("""
+        CREATE INDEX IF NOT EXISTS ix_messages_text_fts
+            ON messages USING gin (to_tsvector('english', text))
+    """),
+    'sqlite': DDL("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(text, content='messages', content_rowid='id')
+    """),
+}
+
+for dialect, ddl in MESSAGE_FTS_DDL.items():
+    event.listen(Message.__table__, 'after_create',
+                 ddl.execute_if(dialect=dialect))
+
+event.listen(Message.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS messages_fts")
+             .execute_if(dialect='sqlite'))
+
+# The Postgres indexes above, which db.metadata doesn't know about, by
+# table: [(index names, DDL that makes them)]. The bulk loader drops
+# them before a load and runs the DDL again after it.
+POSTGRES_INDEXES = {
+    'users': [(TRIGRAM_INDEXES, TRIGRAM_DDL),
+              (('ix_users_username_prefix',), PREFIX_DDL)],
+    'messages': [(('ix_messages_text_fts',), MESSAGE_FTS_DDL['postgresql'])],
+}
+
+messages_fts = table('messages_fts', column('rowid'), column('messages_fts'),
+                     column('text'))
+
+
+def trigrams(text):
+    """The set of 3-character substrings of lowercased `text`."""
+
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def similarity(a, b):
+    """Trigram similarity of two strings, as pg_trgm computes it."""
+
+    a, b = trigrams(f'  {a} '), trigrams(f'  {b} ')
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class TrigramIndex:
+    """In-memory substring index over users' usernames and locations."""
+
+    def __init__(self):
+        self._fields = {}
+        self._postings = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._fields)
+
+    def add(self, user_id, *fields):
+        fields = tuple(field or '' for field in fields)
+        with self._lock:
+            self._remove(user_id)
+            self._fields[user_id] = fields
+            for field in fields:
+                for gram in trigrams(field):
+                    self._postings[gram].add(user_id)
+
+    def remove(self, user_id):
+        with self._lock:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        for field in self._fields.pop(user_id, ()):
+            for gram in trigrams(field):
+                self._postings[gram].discard(user_id)
+
+    def search(self, q, limit):
+        """Ids of up to `limit` users whose fields contain `q`, best first."""
+
+        q = q.lower()
+        grams = trigrams(q)
+
+        with self._lock:
+            if grams:
+                candidates = set.intersection(
+                    *(self._postings.get(gram, set()) for gram in grams))
+            else:
+                candidates = set(self._fields)
+
+            matches = [(user_id, self._fields[user_id])
+                       for user_id in candidates
+                       if any(q in field.lower()
+                              for field in self._fields[user_id])]
+
+        matches.sort(key=lambda match: (
+            not match[1][0].lower().startswith(q),
+            -similarity(match[1][0], q),
+            match[0],
+        ))
+        return [user_id for user_id, _ in matches[:limit]]
+
+
+class UserSearch:
+    """Picks the SQL path or the in-process path per database."""
+
+    def __init__(self):
+        self._index = None
+        self._has_trigram = {}
+        self._lock = threading.Lock()
+
+        event.listen(User, 'after_insert', self._user_changed)
+        event.listen(User, 'after_update', self._user_changed)
+        event.listen(User, 'after_delete', self._user_deleted)
+        event.listen(db.metadata, 'after_drop', self._reset)
+
+    def search(self, q, limit):
+        """Up to `limit` users matching `q`, best match first."""
+
+        if db.session().get_bind().dialect.name != 'sqlite':
+            return self._search_sql(q, limit)
+
+        ids = self._local_index().search(q, limit)
+        users = {user.id: user
+                 for user in User.query.filter(User.id.in_(ids))} if ids else {}
+
+        q = q.lower()
+        return [users[user_id] for user_id in ids
+                if user_id in users
+                and (q in users[user_id].username.lower()
+                     or q in (users[user_id].location or '').lower())]
+
+    def _search_sql(self, q, limit):
+        escaped = (q.replace('\\', '\\\\')
+                    .replace('%', '\\%')
+                    .replace('_', '\\_'))
+        pattern = '%' + escaped + '%'
+
+        # Matches lower(username) COLLATE "C", so it runs on the prefix
+        # index (LIKE's default escape is the backslash too).
+        name = func.lower(User.username).collate('C')
+        prefixed = (db.session.query(User.id)
+                    .filter(name.like(escaped.lower() + '%'))
+                    .order_by(name)
+                    .limit(MAX_CANDIDATES))
+
+        if not trigrams(q):
+            return (User.query
+                    .filter(User.id.in_(prefixed.limit(limit)))
+                    .order_by(name)
+                    .all())
+
+        # On the trigram indexes if there are any; otherwise a scan that
+        # stops once it has enough.
+        contained = (db.session.query(User.id)
+                     .filter(or_(User.username.ilike(pattern, escape='\\'),
+                                 User.location.ilike(pattern, escape='\\')))
+                     .limit(MAX_CANDIDATES))
+
+        if self._uses_trigram_index():
+            closeness = (func.similarity(User.username, q).desc(),)
+        else:
+            # Username matches before location-only ones, shortest first.
+            closeness = (case([(User.username.ilike(pattern, escape='\\'), 0)],
+                              else_=1),
+                         func.length(User.username))
+
+        candidates = prefixed.union(contained)
+        return (User
+                .query
+                .filter(User.id.in_(candidates))
+                .order_by(case([(name.like(escaped.lower() + '%'), 0)],
+                               else_=1),
+                          *closeness,
+                          User.id)
+                .limit(limit)
+                .all())
+
+    def _uses_trigram_index(self):
+        """Are pg_trgm and both GIN trigram indexes there to use?"""
+
+        engine = db.session().get_bind()
+        key = str(engine.url)
+        if key not in self._has_trigram:
+            ready = db.session.execute(text(
+                "SELECT count(*) FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname IN :names AND i.indisvalid "
+                "AND EXISTS (SELECT 1 FROM pg_extension "
+                "            WHERE extname = 'pg_trgm')"
+            ).bindparams(bindparam('names', expanding=True)),
+                {'names': list(TRIGRAM_INDEXES)}).scalar()
+            self._has_trigram[key] = ready == len(TRIGRAM_INDEXES)
+        return self._has_trigram[key]
+
+    def _local_index(self):
+        with self._lock:
+            if self._index is None:
+                index = TrigramIndex()
+                rows = db.session.query(User.id, User.username, User.location)
+                for user_id, username, location in rows.yield_per(10000):
+                    index.add(user_id, username, location)
+                self._index = index
+            return self._index
+
+    def _user_changed(self, mapper, connection, user):
+        if self._index is not None:
+            self._index.add(user.id, user.username, user.location)
+
+    def _user_deleted(self, mapper, connection, user):
+        if self._index is not None:
+            self._index.remove(user.id)
+
+    def _reset(self, *args, **kwargs):
+        with self._lock:
+            self._index = None
+            self._has_trigram.clear()
+
+
+user_search = UserSearch()
+
+
+##############################################################################
+# Messages
+
+
+def _dialect():
+    return db.session().get_bind().dialect.name
+
+
+def _fts5_query(q):
+    """Quote every word of `q`, so FTS5 treats none of it as syntax."""
+
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in q.split())
+
+
+def search_messages(q, before=None, per_page=100):
+    """One page of messages matching `q`, most relevant first.
+
+    `before` is a decoded cursor from a previous page.
+    """
+
+    if not q.split():
+        return Page([])
+
+    query = Message.query.options(joinedload(Message.user))
+
+    if _dialect() == 'sqlite':
+        score = -func.bm25(literal_column('messages_fts'))
+        query = (query
+                 .join(messages_fts, messages_fts.c.rowid == Message.id)
+                 .filter(messages_fts.c.messages_fts.op('MATCH')(_fts5_query(q))))
+    else:
+        document = func.to_tsvector(literal_column("'english'"), Message.text)
+        terms = func.plainto_tsquery(literal_column("'english'"), q)
+        score = func.ts_rank(document, terms)
+        query = query.filter(document.op('@@')(terms))
+
+    page = paginate(query.add_columns(score.label('score')), score, Message.id,
+                    before=before, per_page=per_page,
+                    key=lambda row: (row.score, row.Message.id))
+    return Page([row.Message for row in page.items], page.next_cursor)
+
+
+def index_message(message):
+    """Add a (flushed) message to the full-text index."""
+
+    if _dialect() == 'sqlite':
+        db.session.execute(messages_fts.insert().values(
+            rowid=message.id, text=message.text))
+
+
+def unindex_message(message):
+    """Remove a message from the full-text index, before it's deleted."""
+
+    if _dialect() == 'sqlite':
+        db.session.execute(messages_fts.insert().values(
+            messages_fts='delete', rowid=message.id, text=message.text))
+
+
+def reindex_messages():
+    """Rebuild the full-text index over every message.
+
+    Creates the index first if the database doesn't have one yet.
+    """
+
+    if _dialect() == 'sqlite':
+        db.session.execute(MESSAGE_FTS_DDL['sqlite'])
+        db.session.execute(messages_fts.insert().values(messages_fts='rebuild'))
+    else:
+        if not db.session.execute(text(
+                "SELECT to_regclass('ix_messages_text_fts')")).scalar():
+            # Building it is the reindex.
+            db.session.execute(MESSAGE_FTS_DDL['postgresql'])
+            return
+
+        # A partitioned index can only be reindexed outside a transaction;
+        # its partitions' indexes can be, one at a time.
+        leaves = db.session.execute(text(
+            "SELECT relid::regclass::text "
+            "FROM pg_partition_tree('ix_messages_text_fts') WHERE isleaf"
+        )).scalars().all()
+        for index in leaves:
+            db.session.execute(text(f"REINDEX INDEX {index}"))
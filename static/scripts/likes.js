@@ -0,0 +1,35 @@
+// Like buttons update in place through the JSON endpoint instead of
+// reloading the page. Without JavaScript the plain form still works.
+//
+// Both send the state the button asks for rather than "toggle", so a
+// retried request or a double click can't undo the user's action.
+
+document.addEventListener('submit', function (evt) {
+  var form = evt.target;
+  if (!form.classList.contains('like-form')) return;
+
+  evt.preventDefault();
+  var button = form.querySelector('button');
+  var want = form.elements.liked;
+
+  fetch('/api/messages/' + form.dataset.messageId + '/like', {
+    method: 'POST',
+    credentials: 'same-origin',
+    headers: {'Accept': 'application/json',
+              'Content-Type': 'application/json'},
+    body: JSON.stringify({liked: want.value === '1'})
+  })
+    .then(function (resp) {
+      if (!resp.ok) throw new Error(resp.status);
+      return resp.json();
+    })
+    .then(function (data) {
+      button.classList.toggle('btn-primary', data.liked);
+      button.classList.toggle('btn-secondary', !data.liked);
+      form.querySelector('.like-count').textContent = data.likes_count;
+      want.value = data.liked ? '0' : '1';
+    })
+    .catch(function () {
+      form.submit();
+    });
+});
@@ -0,0 +1,88 @@
+"""Connection pool and statement timeout tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_database.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy.exc import OperationalError
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import database
+
+db.create_all()
+
+
+class DatabaseTestCase(TestCase):
+    """Test engine options, read timeouts and pool metrics."""
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_engine_options(self):
+        pool = db.engine.pool
+        self.assertIsInstance(pool, database.TimedQueuePool)
+        self.assertEqual(pool.capacity(),
+                         app.config['DB_POOL_SIZE'] + app.config['DB_MAX_OVERFLOW'])
+        self.assertTrue(pool._pre_ping)
+
+        options = database.engine_options(app.config, 'sqlite:///warbler.db')
+        self.assertEqual(options, {'pool_pre_ping': True})
+
+        config = dict(app.config, DB_STATEMENT_TIMEOUT=250)
+        options = database.engine_options(config)
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=250'})
+
+    def statement_timeout(self):
+        return db.session.execute(db.text("SHOW statement_timeout")).scalar()
+
+    def test_read_requests_get_timeout(self):
+        with app.test_request_context(method='GET'):
+            self.assertEqual(self.statement_timeout(), '5s')
+            db.session.rollback()
+            db.session.remove()
+
+        with app.test_request_context(method='POST'):
+            self.assertEqual(self.statement_timeout(), '0')
+            db.session.rollback()
+            db.session.remove()
+
+    def test_slow_read_cancelled(self):
+        app.config['DB_READ_STATEMENT_TIMEOUT'] = 10
+        try:
+            with app.test_request_context(method='GET'):
+                with self.assertRaises(OperationalError) as cm:
+                    db.session.execute(db.text("SELECT pg_sleep(1)"))
+                self.assertTrue(database.is_statement_timeout(cm.exception))
+                db.session.rollback()
+                db.session.remove()
+        finally:
+            app.config['DB_READ_STATEMENT_TIMEOUT'] = 5000
+
+    def test_pool_metrics(self):
+        db.session.execute(db.text("SELECT 1"))
+
+        body = app.test_client().get("/metrics").data.decode()
+        capacity = db.engine.pool.capacity()
+        self.assertIn(f'warbler_db_pool_connections{{state="capacity"}} {capacity}',
+                      body)
+        self.assertIn('warbler_db_pool_connections{state="in_use"}', body)
+        self.assertIn('warbler_db_pool_wait_seconds_count', body)
+
+    def test_pool_status(self):
+        status = database.pool_status(db.engine)
+
+        self.assertGreater(status['max_connections'], 0)
+        self.assertEqual(status['max_workers'],
+                         (status['max_connections']
+                          - status['reserved_connections'])
+                         // status['pool_capacity'])
@@ -0,0 +1,63 @@
+"""Query plan check tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_explain.py
+
+
+import io
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+import explain
+
+db.create_all()
+
+
+class ExplainTestCase(TestCase):
+    """Test finding sequential scans behind the app's pages."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        for i in range(3):
+            user = User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+            user.messages.append(Message(text=f"hello from {i}"))
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=User.query.first().id,
+                               user_following_id=User.query.all()[-1].id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_every_route_checked(self):
+        out = io.StringIO()
+        explain.check(app, CURR_USER_KEY, out=out)
+
+        lines = out.getvalue().splitlines()
+        for endpoint, url in explain.ROUTES:
+            self.assertTrue(any(line.startswith(endpoint) for line in lines),
+                            endpoint)
+
+    def test_small_tables_ignored(self):
+        self.assertEqual(explain.check(app, CURR_USER_KEY, out=io.StringIO()), [])
+
+    def test_seq_scans_reported(self):
+        # A handful of rows: the planner scans them, which we flag when
+        # asked to look at tables of any size.
+        findings = explain.check(app, CURR_USER_KEY, min_rows=0,
+                                 out=io.StringIO())
+
+        self.assertTrue(findings)
+        self.assertTrue(all(finding.statement.lstrip().upper().startswith('SELECT')
+                            for finding in findings))
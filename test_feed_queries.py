@@ -0,0 +1,107 @@
+"""Query-budget tests for feed pages."""
+
+# run these tests like:
+#
+#    python -m unittest test_feed_queries.py
+
+
+import os
+from contextlib import contextmanager
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+import timeline
+
+db.create_all()
+
+# A feed page should cost a fixed handful of queries no matter how many
+# messages (or distinct authors) are on it.
+FEED_QUERY_BUDGET = 8
+
+
+@contextmanager
+def count_queries():
+    """Count the SQL statements run inside the `with` block."""
+
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+class FeedQueryBudgetTestCase(TestCase):
+    """Feed pages must not lazy-load each message's author."""
+
+    def setUp(self):
+        """Create a reader following many authors, each with messages."""
+
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        self.reader_id = 1
+        db.session.add(User(id=1, username="reader", email="reader@test.com",
+                            password="HASHED_PASSWORD"))
+
+        for author_id in range(2, 32):
+            db.session.add(User(id=author_id, username=f"author{author_id}",
+                                email=f"author{author_id}@test.com",
+                                password="HASHED_PASSWORD"))
+        db.session.flush()
+
+        for author_id in range(2, 32):
+            db.session.add(Follows(user_being_followed_id=author_id,
+                                   user_following_id=self.reader_id))
+            for n in range(3):
+                msg = Message(text=f"warble {n} by {author_id}",
+                              user_id=author_id)
+                db.session.add(msg)
+                db.session.flush()
+                db.session.add(Likes(user_id=self.reader_id, message_id=msg.id))
+
+        timeline.rebuild()
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader_id
+
+    def tearDown(self):
+        """Rollback session after each test"""
+
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def assert_within_budget(self, url):
+        db.session.remove()
+
+        with count_queries() as statements:
+            resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertLessEqual(len(statements), FEED_QUERY_BUDGET,
+                             "\n\n".join(statements))
+
+    def test_homepage_budget(self):
+        self.assert_within_budget("/")
+
+    def test_user_show_budget(self):
+        self.assert_within_budget("/users/2")
+
+    def test_likes_budget(self):
+        self.assert_within_budget(f"/users/{self.reader_id}/likes")
@@ -0,0 +1,110 @@
+"""Follower and following list tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_lists.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event, text
+
+from models import db, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+
+db.create_all()
+
+
+class FollowListsTestCase(TestCase):
+    """Test paging through followers and followed users."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        star = User.signup("star", "star@test.com", "password", None)
+        star.id = 1000
+        for i in range(1, 6):
+            fan = User.signup(f"fan{i}", f"fan{i}@test.com", "password", None)
+            fan.id = 1000 + i
+        db.session.commit()
+
+        # fan1 followed first, fan5 last; the star follows them all back
+        started = datetime(2020, 1, 1)
+        for i in range(1, 6):
+            at = started + timedelta(days=i)
+            db.session.add(Follows(user_being_followed_id=1000,
+                                   user_following_id=1000 + i, created_at=at))
+            db.session.add(Follows(user_being_followed_id=1000 + i,
+                                   user_following_id=1000, created_at=at))
+        db.session.commit()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1001
+
+        self.per_page = app.config['USERS_PER_PAGE']
+        app.config['USERS_PER_PAGE'] = 2
+
+    def tearDown(self):
+        app.config['USERS_PER_PAGE'] = self.per_page
+        db.session.rollback()
+
+    def walk(self, path):
+        """Follow the "More" links; returns the usernames on each page."""
+
+        pages = []
+        url = path
+        while url:
+            html = self.client.get(url).data.decode()
+            pages.append([f"fan{i}" for i in range(5, 0, -1)
+                          if f"@fan{i}<" in html])
+            url = None
+            if 'href="?before=' in html:
+                cursor = html.split('href="?before=')[1].split('"')[0]
+                url = f"{path}?before={cursor}"
+        return pages
+
+    def test_followers_paged_newest_first(self):
+        self.assertEqual(self.walk("/users/1000/followers"),
+                         [["fan5", "fan4"], ["fan3", "fan2"], ["fan1"]])
+
+    def test_following_paged_newest_first(self):
+        self.assertEqual(self.walk("/users/1000/following"),
+                         [["fan5", "fan4"], ["fan3", "fan2"], ["fan1"]])
+
+    def test_only_card_columns_loaded(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.client.get("/users/1000/followers")
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        listing = [sql for sql in statements if 'JOIN follows' in sql]
+        self.assertEqual(len(listing), 1)
+        self.assertNotIn('users.password', listing[0])
+        self.assertIn('LIMIT', listing[0])
+
+    def test_created_at_server_default_is_utc(self):
+        # whatever the connection's time zone, like datetime.utcnow()
+        db.session.execute(text("SET LOCAL TIME ZONE 'Pacific/Auckland'"))
+        # (raw SQL: a Core insert would fill in the Python-side default)
+        db.session.execute(text(
+            "INSERT INTO follows (user_being_followed_id, user_following_id) "
+            "VALUES (1002, 1003)"))
+
+        created = Follows.query.get((1002, 1003)).created_at
+        self.assertLess(abs(created - datetime.utcnow()), timedelta(minutes=5))
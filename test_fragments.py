@@ -0,0 +1,94 @@
+"""Message card fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from fragments import fragment_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test caching and invalidation of rendered message cards."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        author.id = 4040
+        reader = User.signup("reader", "reader@test.com", "password", None)
+        reader.id = 5050
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=4040, user_following_id=5050))
+        msg = Message(text="cached warble", user_id=4040)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 5050
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def cached_card(self):
+        entry = fragment_cache.backend.get(fragment_cache.key(self.msg_id))
+        return entry and entry[1]
+
+    def test_card_cached_without_like_state(self):
+        resp = self.client.get("/")
+        self.assertIn(b"cached warble", resp.data)
+        self.assertIn(f'/messages/{self.msg_id}/like'.encode(), resp.data)
+
+        card = self.cached_card()
+        self.assertIn("cached warble", card)
+        self.assertNotIn("btn-secondary", card)
+        self.assertNotIn("btn-primary", card)
+
+    def test_cached_card_reused(self):
+        self.client.get("/")
+
+        # a changed cache entry shows up on the next render
+        stamp, html = fragment_cache.backend.get(fragment_cache.key(self.msg_id))
+        fragment_cache.backend.set(fragment_cache.key(self.msg_id),
+                                   (stamp, html.replace("cached warble", "from cache")))
+
+        self.assertIn(b"from cache", self.client.get("/").data)
+
+    def test_author_change_rerenders(self):
+        self.client.get("/")
+
+        author = User.query.get(4040)
+        author.username = "renamed"
+        db.session.commit()
+
+        resp = self.client.get("/")
+        self.assertIn(b"@renamed", resp.data)
+        self.assertIn("@renamed", self.cached_card())
+
+    def test_delete_invalidates(self):
+        self.client.get("/")
+        self.assertIsNotNone(self.cached_card())
+
+        db.session.delete(Message.query.get(self.msg_id))
+        db.session.commit()
+
+        self.assertIsNone(self.cached_card())
@@ -0,0 +1,77 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_hashing.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from testing import reset_caches
+from hashing import hasher
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HashingTestCase(TestCase):
+    """Test the bounded hashing pool and rehash-on-login."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+        self.rounds = hasher.rounds
+        self.queue_limit = hasher.queue_limit
+
+    def tearDown(self):
+        hasher.rounds = self.rounds
+        hasher.queue_limit = self.queue_limit
+
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_rehash_on_login(self):
+        hasher.rounds = 4
+        user = User.signup("rehash", "rehash@test.com", "password", None)
+        db.session.commit()
+        self.assertTrue(user.password.startswith("$2b$04$"))
+
+        hasher.rounds = 5
+        self.assertTrue(User.authenticate("rehash", "password"))
+        db.session.commit()
+
+        user = User.query.filter_by(username="rehash").one()
+        self.assertTrue(user.password.startswith("$2b$05$"))
+        self.assertTrue(User.authenticate("rehash", "password"))
+
+    def test_saturated_pool_returns_503(self):
+        hasher.queue_limit = 0
+
+        resp = self.client.post("/signup", data={
+            "username": "busy",
+            "email": "busy@test.com",
+            "password": "password",
+        })
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers["Retry-After"], "1")
+        self.assertIsNone(User.query.filter_by(username="busy").first())
+
+    def test_queue_metrics(self):
+        hasher.rounds = 4
+        hasher.generate("password")
+
+        body = self.client.get("/metrics").get_data(as_text=True)
+        self.assertIn("warbler_password_hash_queue_depth 0", body)
+        self.assertIn('warbler_password_hash_seconds_count{operation="generate"}', body)
@@ -0,0 +1,154 @@
+"""HTTP caching tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_http_cache.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+import http_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HttpCacheTestCase(TestCase):
+    """Test ETags, 304s and Cache-Control policy."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.author.id = 4040
+        db.session.commit()
+
+        msg = Message(text="hello", user_id=4040)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_message_conditional_get(self):
+        resp = self.client.get(f"/messages/{self.msg_id}")
+        self.assertEqual(resp.status_code, 200)
+        etag = resp.headers['ETag']
+        self.assertIn("no-cache", resp.headers['Cache-Control'])
+        self.assertIn("public", resp.headers['Cache-Control'])
+
+        resp = self.client.get(f"/messages/{self.msg_id}",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_etag_follows_author_version(self):
+        etag = self.client.get(f"/messages/{self.msg_id}").headers['ETag']
+
+        author = User.query.get(4040)
+        author.username = "renamed"
+        db.session.commit()
+
+        resp = self.client.get(f"/messages/{self.msg_id}",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"@renamed", resp.data)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_profile_etag_follows_counters(self):
+        etag = self.client.get("/users/4040").headers['ETag']
+        self.assertEqual(
+            self.client.get("/users/4040",
+                            headers={'If-None-Match': etag}).status_code,
+            304)
+
+        db.session.add(Message(text="another", user_id=4040))
+        db.session.commit()
+
+        resp = self.client.get("/users/4040", headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_profile_etag_after_delete_then_post(self):
+        etag = self.client.get("/users/4040").headers['ETag']
+
+        db.session.delete(Message.query.get(self.msg_id))
+        db.session.commit()
+        db.session.add(Message(text="replacement", user_id=4040))
+        db.session.commit()
+
+        resp = self.client.get("/users/4040", headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"replacement", resp.data)
+
+    def test_logged_in_pages_not_stored(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 4040
+
+        resp = self.client.get(f"/messages/{self.msg_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+        resp = self.client.get("/")
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+    def test_csrf_token_pages_not_stored(self):
+        app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            resp = self.client.get("/login")
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+        self.assertIn(b'name="csrf_token"', resp.data)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+    def test_static_fingerprints(self):
+        resp = self.client.get("/login")
+        self.assertIn(b"/static/stylesheets/style.css?v=", resp.data)
+
+        with app.test_request_context():
+            url = http_cache.static_url('stylesheets/style.css')
+        resp = self.client.get(url)
+        self.assertIn("max-age=31536000", resp.headers['Cache-Control'])
+        self.assertIn("immutable", resp.headers['Cache-Control'])
+        resp.close()
+
+        # not (or no longer) the file's hash
+        resp = self.client.get("/static/stylesheets/style.css?v=abc")
+        self.assertIn("max-age=3600", resp.headers['Cache-Control'])
+        self.assertNotIn("immutable", resp.headers['Cache-Control'])
+        resp.close()
+
+        resp = self.client.get("/static/stylesheets/style.css")
+        self.assertIn("max-age=3600", resp.headers['Cache-Control'])
+        resp.close()
+
+    def test_build_id_covers_static_files(self):
+        templates, static = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            with open(os.path.join(static, 'style.css'), 'w') as f:
+                f.write("body {}")
+            before = http_cache._digest_trees(templates, static)
+            with open(os.path.join(static, 'style.css'), 'w') as f:
+                f.write("body { color: red }")
+
+            self.assertNotEqual(http_cache._digest_trees(templates, static),
+                                before)
+        finally:
+            shutil.rmtree(templates)
+            shutil.rmtree(static)
@@ -0,0 +1,144 @@
+"""Like toggle tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikesTestCase(TestCase):
+    """Test liking through the form and the JSON endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        for id, name in ((4040, "author"), (5050, "reader"), (6060, "other")):
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = id
+        db.session.commit()
+
+        msg = Message(text="likeable", user_id=4040)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def counts(self):
+        db.session.expire_all()
+        return (Message.query.get(self.msg_id).likes_count,
+                User.query.get(5050).likes_count)
+
+    def test_form_toggle(self):
+        self.login(5050)
+
+        resp = self.client.post(f"/messages/{self.msg_id}/like")
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.counts(), (1, 1))
+
+        self.client.post(f"/messages/{self.msg_id}/like")
+        self.assertEqual(self.counts(), (0, 0))
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_form_sends_wanted_state(self):
+        self.login(5050)
+
+        # the button asks for the opposite of what it shows
+        resp = self.client.get("/users/4040")
+        self.assertIn(b'name="liked" value="1"', resp.data)
+
+        for _ in range(2):
+            self.client.post(f"/messages/{self.msg_id}/like",
+                             data={'liked': '1'})
+        self.assertEqual(self.counts(), (1, 1))
+
+        resp = self.client.get("/users/4040")
+        self.assertIn(b'name="liked" value="0"', resp.data)
+
+    def test_json_toggle(self):
+        self.login(5050)
+
+        resp = self.client.post(f"/api/messages/{self.msg_id}/like")
+        self.assertEqual(resp.json, {'message_id': self.msg_id, 'liked': True,
+                                     'likes_count': 1})
+
+        resp = self.client.post(f"/api/messages/{self.msg_id}/like")
+        self.assertEqual(resp.json['liked'], False)
+        self.assertEqual(resp.json['likes_count'], 0)
+
+    def test_json_set_is_idempotent(self):
+        self.login(5050)
+
+        for _ in range(3):
+            resp = self.client.post(f"/api/messages/{self.msg_id}/like",
+                                    json={'liked': True})
+            self.assertEqual(resp.json['likes_count'], 1)
+        self.assertEqual(self.counts(), (1, 1))
+
+        for _ in range(2):
+            resp = self.client.post(f"/api/messages/{self.msg_id}/like",
+                                    json={'liked': False})
+            self.assertEqual(resp.json['liked'], False)
+        self.assertEqual(self.counts(), (0, 0))
+
+    def test_many_users_like_one_message(self):
+        self.login(5050)
+        self.client.post(f"/api/messages/{self.msg_id}/like")
+        self.login(6060)
+        resp = self.client.post(f"/api/messages/{self.msg_id}/like")
+
+        self.assertEqual(resp.json['likes_count'], 2)
+        self.assertEqual(Likes.query.filter_by(message_id=self.msg_id).count(), 2)
+
+    def test_own_message(self):
+        self.login(4040)
+
+        resp = self.client.post(f"/api/messages/{self.msg_id}/like")
+        self.assertEqual(resp.status_code, 403)
+        resp = self.client.post(f"/messages/{self.msg_id}/like")
+        self.assertEqual(resp.status_code, 403)
+
+    def test_unauthorized(self):
+        resp = self.client.post(f"/api/messages/{self.msg_id}/like")
+        self.assertEqual(resp.status_code, 401)
+
+        resp = self.client.post("/api/messages/999999/like")
+        self.assertEqual(resp.status_code, 401)
+
+    def test_missing_message(self):
+        self.login(5050)
+
+        resp = self.client.post("/api/messages/999999/like")
+        self.assertEqual(resp.status_code, 404)
+
+    def test_user_delete_uncounts_likes(self):
+        self.login(5050)
+        self.client.post(f"/api/messages/{self.msg_id}/like")
+
+        db.session.delete(User.query.get(5050))
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 0)
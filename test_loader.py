@@ -0,0 +1,162 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from testing import reset_caches
+import loader
+
+db.create_all()
+
+USERS = """id,email,username,image_url,password,bio,header_image_url,location
+1,a@test.com,alice,/static/images/default-pic.png,HASHED,,/static/images/warbler-hero.jpg,Boston
+2,b@test.com,bob,/static/images/default-pic.png,HASHED,"Hi, I'm Bob",/static/images/warbler-hero.jpg,
+3,c@test.com,carol,/static/images/default-pic.png,HASHED,,/static/images/warbler-hero.jpg,Denver
+"""
+
+MESSAGES = """id,text,timestamp,user_id
+1,first,2020-01-01 10:00:00,1
+2,second,2020-01-02 10:00:00,1
+3,third,2020-01-03 10:00:00,2
+4,fourth,2020-01-04 10:00:00,3
+5,fifth,2020-01-05 10:00:00,1
+"""
+
+FOLLOWS = """user_being_followed_id,user_following_id
+1,2
+1,3
+2,1
+"""
+
+LIKES = """user_id,message_id
+2,1
+3,2
+"""
+
+
+class LoaderTestCase(TestCase):
+    """Test loading CSVs in chunks, and resuming."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.data_dir = tempfile.mkdtemp()
+        for name, body in (('users.csv', USERS), ('messages.csv', MESSAGES),
+                           ('follows.csv', FOLLOWS), ('likes.csv', LIKES)):
+            with open(os.path.join(self.data_dir, name), 'w') as f:
+                f.write(body)
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(self.data_dir)
+
+    def load(self, fresh=True):
+        out = io.StringIO()
+        loader.load(self.data_dir, chunk_rows=2, fresh=fresh, out=out)
+        return out.getvalue()
+
+    def test_load(self):
+        output = self.load()
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(Message.query.count(), 5)
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual(Likes.query.count(), 2)
+        self.assertIn("messages: 5 rows", output)
+        self.assertIn("rows/sec", output)
+
+        bob = User.query.filter_by(username="bob").one()
+        self.assertEqual(bob.bio, "Hi, I'm Bob")
+
+        # counters and timelines are rebuilt after the rows go in
+        alice = User.query.get(1)
+        self.assertEqual(alice.message_count, 3)
+        self.assertEqual(alice.follower_count, 2)
+        # bob sees alice's three warbles and bob's own
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=2).count(), 4)
+
+    def test_indexes_rebuilt(self):
+        output = self.load()
+
+        names = {index['name'] for index in
+                 db.inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_id_timestamp_id', names)
+
+        # search's own indexes too, dropped for the load like the rest
+        self.assertIn("messages: rebuilt ix_messages_text_fts", output)
+        self.assertNotIn("search: rebuilt", output)
+        for index in ('ix_messages_text_fts', 'ix_users_username_prefix'):
+            self.assertTrue(db.session.execute(db.text(
+                "SELECT to_regclass(:index)"), {'index': index}).scalar())
+
+    def test_finishing_steps_in_batches(self):
+        batch = loader.BATCH_IDS
+        loader.BATCH_IDS = 1
+        try:
+            self.load()
+        finally:
+            loader.BATCH_IDS = batch
+
+        self.assertEqual(User.query.get(1).message_count, 3)
+        self.assertEqual(User.query.get(3).following_count, 1)
+        self.assertEqual(Message.query.get(1).likes_count, 1)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=2).count(), 4)
+
+    def test_resume(self):
+        self.load()
+
+        # pretend we died after committing the first chunk of messages,
+        # and a failed chunk used up some of the id sequence
+        Likes.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.filter(Message.id > 2).delete()
+        db.session.commit()
+        with db.engine.begin() as conn:
+            conn.execute(loader.progress.update()
+                         .where(loader.progress.c.filename.in_(
+                             ['messages.csv', 'likes.csv', 'step:timelines',
+                              'step:counters']))
+                         .values(rows=0))
+            conn.execute(loader.progress.update()
+                         .where(loader.progress.c.filename == 'messages.csv')
+                         .values(rows=2))
+            conn.exec_driver_sql("SELECT nextval('messages_id_seq') "
+                                 "FROM generate_series(1, 2)")
+
+        output = self.load(fresh=False)
+
+        self.assertIn("users: already loaded", output)
+        self.assertEqual([m.text for m in Message.query.order_by(Message.id)],
+                         ["first", "second", "third", "fourth", "fifth"])
+        self.assertEqual(Likes.query.count(), 2)
+        self.assertEqual(User.query.get(1).message_count, 3)
+        # the likes still point at the messages they were written against
+        self.assertEqual(
+            sorted(m.text for m in Message.query.join(Likes)),
+            ["first", "second"])
+
+    def test_new_rows_after_loaded_ids(self):
+        self.load()
+
+        user = User.signup("dave", "d@test.com", "password", None)
+        db.session.commit()
+        msg = Message(text="sixth", user_id=user.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertEqual((user.id, msg.id), (4, 6))
@@ -14,6 +14,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 #import app
 from app import app
+from testing import reset_caches
 
 #create our tables
 db.create_all()
@@ -25,6 +26,7 @@ class UserModelTestCase(TestCase):
         """Set up the test client and add sample data"""
         db.drop_all()
         db.create_all()
+        reset_caches()
 
         self.uid = 112693
         user = User.signup("test", "testing@test.com", "password", None)
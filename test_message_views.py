@@ -21,6 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from testing import reset_caches
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,6 +42,7 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        reset_caches()
 
         self.client = app.test_client()
 
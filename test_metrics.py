@@ -0,0 +1,83 @@
+"""Request instrumentation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy.exc import DataError
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from testing import reset_caches
+from metrics import Histogram
+import metrics
+
+db.create_all()
+
+
+class MetricsTestCase(TestCase):
+    """Test Server-Timing headers and the /metrics endpoint."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        db.session.add(User(id=42, username="measured", email="m@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_server_timing_header(self):
+        resp = self.client.get("/users/42")
+
+        timing = resp.headers["Server-Timing"]
+        self.assertIn("db;dur=", timing)
+        self.assertIn("queries", timing)
+        self.assertIn("render;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+    def test_metrics_endpoint(self):
+        self.client.get("/users/42")
+        resp = self.client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        body = resp.get_data(as_text=True)
+        self.assertIn("# TYPE warbler_request_queries histogram", body)
+        self.assertIn('warbler_request_queries_count{endpoint="users_show"}', body)
+        self.assertIn('warbler_request_duration_seconds_bucket{endpoint="users_show",le="+Inf"}', body)
+
+    def test_histogram_buckets(self):
+        hist = Histogram("h", "help", labels=("kind",), buckets=(1, 5))
+        hist.observe(0.5, "a")
+        hist.observe(3, "a")
+        hist.observe(7, "a")
+
+        self.assertEqual(list(hist.samples()), [
+            'h_bucket{kind="a",le="1"} 1',
+            'h_bucket{kind="a",le="5"} 2',
+            'h_bucket{kind="a",le="+Inf"} 3',
+            'h_sum{kind="a"} 10.5',
+            'h_count{kind="a"} 3',
+        ])
+
+    def test_failed_statement_not_left_timing(self):
+        with app.test_request_context():
+            metrics._start_request()
+            with db.engine.connect() as conn:
+                with self.assertRaises(DataError):
+                    conn.exec_driver_sql("SELECT 1 / 0")
+                self.assertEqual(conn.info.get('query_started'), [])
@@ -0,0 +1,173 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from testing import reset_caches
+
+db.create_all()
+
+ALEMBIC_INI = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'alembic.ini')
+
+# What the original models.py's db.create_all() made, before any of the
+# migrations existed.
+BASELINE_DDL = """
+CREATE TABLE users (
+    id SERIAL NOT NULL,
+    email TEXT NOT NULL,
+    username TEXT NOT NULL,
+    image_url TEXT,
+    header_image_url TEXT,
+    bio TEXT,
+    location TEXT,
+    password TEXT NOT NULL,
+    PRIMARY KEY (id),
+    UNIQUE (email),
+    UNIQUE (username)
+);
+CREATE TABLE follows (
+    user_being_followed_id INTEGER NOT NULL,
+    user_following_id INTEGER NOT NULL,
+    PRIMARY KEY (user_being_followed_id, user_following_id),
+    FOREIGN KEY (user_being_followed_id) REFERENCES users (id) ON DELETE cascade,
+    FOREIGN KEY (user_following_id) REFERENCES users (id) ON DELETE cascade
+);
+CREATE TABLE messages (
+    id SERIAL NOT NULL,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+);
+CREATE TABLE likes (
+    id SERIAL NOT NULL,
+    user_id INTEGER,
+    message_id INTEGER,
+    PRIMARY KEY (id),
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE cascade,
+    UNIQUE (message_id),
+    FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE cascade
+);
+"""
+
+SEED = """
+INSERT INTO users (id, email, username, password) VALUES
+    (1, 'author@test.com', 'author', 'x'),
+    (2, 'reader@test.com', 'reader', 'x'),
+    (3, 'other@test.com', 'other', 'x');
+INSERT INTO follows (user_being_followed_id, user_following_id) VALUES (1, 2);
+INSERT INTO messages (id, text, timestamp, user_id) VALUES
+    (1, 'hello', '2020-01-01', 1);
+INSERT INTO likes (user_id, message_id) VALUES (2, 1);
+"""
+
+
+def schema():
+    """Every column, index and constraint in the database, by table."""
+
+    with db.engine.connect() as conn:
+        columns = conn.execute(text(
+            "SELECT table_name, column_name, data_type, is_nullable, "
+            "       column_default "
+            "FROM information_schema.columns WHERE table_schema = 'public' "
+            "AND table_name != 'alembic_version'")).all()
+        indexes = conn.execute(text(
+            "SELECT tablename, indexname, indexdef FROM pg_indexes "
+            "WHERE schemaname = 'public' "
+            "AND tablename != 'alembic_version'")).all()
+        constraints = conn.execute(text(
+            "SELECT conrelid::regclass::text, conname, "
+            "       pg_get_constraintdef(oid) "
+            "FROM pg_constraint WHERE connamespace = 'public'::regnamespace "
+            "AND conrelid != to_regclass('alembic_version')")).all()
+    return {'columns': set(columns), 'indexes': set(indexes),
+            'constraints': set(constraints)}
+
+
+class MigrationsTestCase(TestCase):
+    """Test upgrading a database made before the migrations existed."""
+
+    def setUp(self):
+        db.session.close()
+        db.drop_all()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("DROP TABLE IF EXISTS alembic_version")
+            conn.exec_driver_sql(BASELINE_DDL)
+            conn.exec_driver_sql(SEED)
+        reset_caches()
+
+        self.config = Config(ALEMBIC_INI)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.close()
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("DROP TABLE IF EXISTS alembic_version")
+        db.drop_all()
+        db.create_all()
+
+    def test_upgrade_matches_models(self):
+        command.upgrade(self.config, 'head')
+        upgraded = schema()
+
+        db.drop_all()
+        db.create_all()
+        self.assertEqual(upgraded, schema())
+
+    def test_upgrade_keeps_data(self):
+        command.upgrade(self.config, 'head')
+
+        author, reader = User.query.get(1), User.query.get(2)
+        self.assertEqual((author.message_count, author.follower_count),
+                         (1, 1))
+        self.assertEqual((reader.following_count, reader.likes_count), (1, 1))
+        self.assertEqual(Message.query.get(1).likes_count, 1)
+
+        entries = db.session.execute(text(
+            "SELECT message_id FROM timeline_entries WHERE user_id = 2"
+        )).scalars().all()
+        self.assertEqual(entries, [1])
+
+        resp = self.client.get("/users/1")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_likes_unique_per_user(self):
+        command.upgrade(self.config, 'head')
+
+        like = text("INSERT INTO likes (user_id, message_id) "
+                    "VALUES (:user_id, 1)")
+        db.session.execute(like, {'user_id': 3})
+        db.session.commit()
+
+        with self.assertRaises(IntegrityError):
+            db.session.execute(like, {'user_id': 3})
+
+    def test_rerun_and_downgrade(self):
+        command.upgrade(self.config, 'head')
+        upgraded = schema()
+
+        command.downgrade(self.config, 'base')
+        self.assertNotIn('message_count',
+                         {column for table, column, *rest
+                          in schema()['columns'] if table == 'users'})
+
+        command.upgrade(self.config, 'head')
+        self.assertEqual(schema(), upgraded)
@@ -0,0 +1,180 @@
+"""Message timestamp and partitioning tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from time import sleep
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from models import db, User, Message, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from testing import reset_caches
+import loader
+import partitions
+
+db.create_all()
+
+
+def partition_of(message_id):
+    """Which table holds message `message_id`?"""
+
+    return db.session.execute(text(
+        "SELECT tableoid::regclass::text FROM messages WHERE id = :id"),
+        {'id': message_id}).scalar()
+
+
+class MessageTimestampTestCase(TestCase):
+    """Test messages getting the time they were written."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.user = User.signup("writer", "writer@test.com", "password", None)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_each_message_stamped_when_written(self):
+        first = Message(text="first", user_id=self.user.id)
+        db.session.add(first)
+        db.session.commit()
+        sleep(0.01)
+        second = Message(text="second", user_id=self.user.id)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertLess(first.timestamp, second.timestamp)
+
+    def test_server_default_is_utc(self):
+        # raw SQL: a Core insert would fill in the Python-side default
+        db.session.execute(text("SET LOCAL TIME ZONE 'Pacific/Auckland'"))
+        db.session.execute(text(
+            "INSERT INTO messages (text, user_id) VALUES ('raw', :user_id)"),
+            {'user_id': self.user.id})
+
+        stamp = db.session.query(Message.timestamp).filter_by(text="raw").scalar()
+        self.assertLess(abs(stamp - datetime.utcnow()), timedelta(minutes=5))
+
+
+class PartitionTestCase(TestCase):
+    """Test partitioning messages by month."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        author = User.signup("author", "author@test.com", "password", None)
+        fan = User.signup("fan", "fan@test.com", "password", None)
+        db.session.commit()
+
+        old = Message(text="old", user_id=author.id,
+                      timestamp=datetime(2019, 5, 17))
+        new = Message(text="new", user_id=author.id)
+        db.session.add_all([old, new])
+        db.session.commit()
+        db.session.add(Likes(user_id=fan.id, message_id=old.id))
+        db.session.add(TimelineEntry(user_id=fan.id, message_id=old.id,
+                                     timestamp=old.timestamp))
+        db.session.commit()
+
+        self.author_id, self.fan_id = author.id, fan.id
+        self.old_id, self.new_id = old.id, new.id
+
+        partitions.partition_messages()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_rows_moved_into_months(self):
+        self.assertTrue(partitions.is_partitioned())
+        self.assertEqual(partition_of(self.old_id), 'messages_y2019m05')
+
+        now = datetime.utcnow()
+        self.assertEqual(partition_of(self.new_id),
+                         partitions.partition_name(now))
+
+    def test_new_messages_keep_ids_and_indexes(self):
+        msg = Message(text="after", user_id=self.author_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertGreater(msg.id, self.new_id)
+        indexes = db.session.execute(text(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'messages'"
+        )).scalars().all()
+        self.assertIn('ix_messages_user_id_timestamp_id', indexes)
+        self.assertIn('ix_messages_text_fts', indexes)
+
+    def test_month_added_takes_rows_from_default(self):
+        far = Message(text="far", user_id=self.author_id,
+                      timestamp=datetime(2100, 1, 5))
+        db.session.add(far)
+        db.session.commit()
+        self.assertEqual(partition_of(far.id), partitions.DEFAULT_PARTITION)
+
+        created = partitions.ensure_partitions(far.timestamp, far.timestamp)
+        db.session.commit()
+
+        self.assertEqual(created, ['messages_y2100m01'])
+        self.assertEqual(partition_of(far.id), 'messages_y2100m01')
+
+    def test_drop_partitions(self):
+        removed = partitions.drop_partitions(datetime(2020, 1, 1))
+        db.session.commit()
+
+        # and the empty months between it and the newest message
+        self.assertEqual(removed, [f'messages_y2019m{month:02d}'
+                                   for month in range(5, 13)])
+        self.assertEqual(partitions.partition_names()[0], 'messages_y2020m01')
+        self.assertIsNone(Message.query.get(self.old_id))
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        author = User.query.get(self.author_id)
+        fan = User.query.get(self.fan_id)
+        self.assertEqual(author.message_count, 1)
+        self.assertEqual(fan.likes_count, 0)
+
+    def test_deleting_message_deletes_likes(self):
+        db.session.delete(Message.query.get(self.old_id))
+        db.session.commit()
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.query.get(self.fan_id).likes_count, 0)
+
+    def test_deleting_user_clears_their_messages(self):
+        db.session.delete(User.query.get(self.author_id))
+        db.session.commit()
+
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_load_into_partitions(self):
+        data_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(data_dir, 'messages.csv'), 'w') as f:
+                f.write("text,timestamp,user_id\n"
+                        f"loaded,2018-03-02 10:00:00,{self.author_id}\n")
+            loader.load(data_dir, fresh=True)
+        finally:
+            shutil.rmtree(data_dir)
+
+        loaded = Message.query.filter_by(text="loaded").one()
+        self.assertEqual(partition_of(loaded.id), 'messages_y2018m03')
@@ -0,0 +1,136 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import io
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Follows, Recommendation
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+import recommendations
+
+db.create_all()
+
+# who follows whom, by user number: 1 -> 2 means 1 follows 2
+FOLLOWS = ((1, 2), (1, 3), (2, 4), (2, 5), (3, 4), (4, 1), (5, 4))
+
+
+class TopKTestCase(TestCase):
+    """Test scoring friends-of-friends over a CSR graph."""
+
+    def setUp(self):
+        # user numbers 0..5; row n is who n follows
+        rows = [[] for _ in range(6)]
+        for follower, followed in FOLLOWS:
+            rows[follower].append(followed)
+        self.indptr = np.cumsum([0] + [len(row) for row in rows])
+        self.indices = np.array([n for row in rows for n in row])
+
+    def test_scores(self):
+        candidates, scores = recommendations.top_k(1, self.indptr, self.indices)
+
+        # 2 and 3 both follow 4; 2 follows 5
+        self.assertEqual(candidates.tolist(), [4, 5])
+        self.assertEqual(scores.tolist(), [2, 1])
+
+    def test_excludes_self_and_followed(self):
+        candidates, scores = recommendations.top_k(2, self.indptr, self.indices)
+
+        # 4 follows 1 and 5 follows 4, whom 2 already follows
+        self.assertEqual(candidates.tolist(), [1])
+
+    def test_keeps_k(self):
+        candidates, scores = recommendations.top_k(1, self.indptr, self.indices,
+                                                   k=1)
+        self.assertEqual(candidates.tolist(), [4])
+
+
+class RecommendationsTestCase(TestCase):
+    """Test rebuilding and serving recommendations."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        for n in range(1, 6):
+            user = User.signup(f"user{n}", f"user{n}@test.com", "password", None)
+            user.id = 1000 + n
+        db.session.commit()
+
+        for follower, followed in FOLLOWS:
+            db.session.add(Follows(user_following_id=1000 + follower,
+                                   user_being_followed_id=1000 + followed))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def rebuild(self, workers):
+        return recommendations.rebuild(workers=workers, out=io.StringIO())
+
+    def stored(self):
+        return (db.session.query(Recommendation.user_id, Recommendation.rank,
+                                 Recommendation.recommended_id,
+                                 Recommendation.score)
+                .order_by(Recommendation.user_id, Recommendation.rank)
+                .all())
+
+    def test_rebuild(self):
+        self.assertEqual(self.rebuild(workers=1), len(self.stored()))
+
+        rows = [row.username for row in recommendations.for_user(1001)]
+        self.assertEqual(rows, ["user4", "user5"])
+
+    def test_process_pool_agrees(self):
+        self.rebuild(workers=1)
+        in_process = self.stored()
+        db.session.commit()
+
+        self.rebuild(workers=2)
+        self.assertEqual(self.stored(), in_process)
+
+    def test_rebuild_replaces(self):
+        self.rebuild(workers=1)
+        Follows.query.filter_by(user_following_id=1002).delete()
+        db.session.commit()
+        self.rebuild(workers=1)
+
+        self.assertEqual(recommendations.for_user(1002), [])
+
+    def test_followed_since_left_out(self):
+        self.rebuild(workers=1)
+        db.session.add(Follows(user_following_id=1001,
+                               user_being_followed_id=1004))
+        db.session.commit()
+
+        rows = [row.username for row in recommendations.for_user(1001)]
+        self.assertEqual(rows, ["user5"])
+
+    def test_api(self):
+        self.rebuild(workers=1)
+
+        resp = self.client.get("/api/users/recommendations")
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1001
+        resp = self.client.get("/api/users/recommendations?limit=1")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['recommendations'],
+                         [{'id': 1004, 'username': 'user4',
+                           'image_url': '/static/images/default-pic.png',
+                           'bio': None, 'score': 2}])
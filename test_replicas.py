@@ -0,0 +1,121 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+#
+# A second local database, warbler-test-replica, stands in for a
+# replica; it's created if it doesn't exist.
+
+
+import os
+from time import time
+from unittest import TestCase
+
+from sqlalchemy import select
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from testing import reset_caches
+from database import STICKY_KEY, replicas
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+REPLICA_URL = "postgresql:///warbler-test-replica"
+
+with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+    if not conn.exec_driver_sql(
+            "SELECT 1 FROM pg_database WHERE datname = 'warbler-test-replica'"
+    ).scalar():
+        conn.exec_driver_sql('CREATE DATABASE "warbler-test-replica"')
+
+
+class ReplicaTestCase(TestCase):
+    """Test which database reads and writes go to."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        user = User.signup("on-primary", "test@test.com", "password", None)
+        user.id = 1111
+        db.session.commit()
+
+        # Same user on the "replica", under a name we can tell apart.
+        row = dict(db.session.execute(User.__table__.select()).mappings().one())
+        row['username'] = "on-replica"
+
+        self.use_replicas([REPLICA_URL])
+        replica = replicas.engines[0]
+        db.metadata.drop_all(bind=replica)
+        db.metadata.create_all(bind=replica)
+        with replica.begin() as conn:
+            conn.execute(User.__table__.insert().values(**row))
+
+    def tearDown(self):
+        db.session.rollback()
+        self.use_replicas([])
+
+    def use_replicas(self, urls, policy='round_robin'):
+        app.config['SQLALCHEMY_REPLICA_URIS'] = urls
+        app.config['REPLICA_POLICY'] = policy
+        replicas.init_app(app)
+
+    def test_get_reads_replica(self):
+        resp = self.client.get("/users/1111")
+        self.assertIn(b"@on-replica", resp.data)
+
+    def test_sticky_after_post(self):
+        self.client.post("/login", data={"username": "on-primary",
+                                         "password": "wrong"})
+        self.assertIn(b"@on-primary", self.client.get("/users/1111").data)
+
+        with self.client.session_transaction() as sess:
+            sess[STICKY_KEY] = time() - 1
+        self.assertIn(b"@on-replica", self.client.get("/users/1111").data)
+
+    def test_unhealthy_replica_falls_back(self):
+        self.use_replicas(["postgresql:///warbler-no-such-database"])
+
+        resp = self.client.get("/users/1111")
+        self.assertIn(b"@on-primary", resp.data)
+        self.assertIsNone(replicas.choose())
+
+    def test_what_goes_where(self):
+        query = select(User.__table__)
+
+        with app.test_request_context(method='GET'):
+            session = db.session()
+            self.assertIs(session.get_bind(clause=query), replicas.engines[0])
+            self.assertIs(session.get_bind(clause=query.with_for_update()),
+                          db.engine)
+            self.assertIs(session.get_bind(clause=User.__table__.insert()),
+                          db.engine)
+            db.session.remove()
+
+        with app.test_request_context(method='POST'):
+            self.assertIs(db.session().get_bind(clause=query), db.engine)
+            db.session.remove()
+
+        # outside a request: CLI commands, the write-behind worker
+        self.assertIs(db.session().get_bind(clause=query), db.engine)
+
+    def test_policies(self):
+        self.use_replicas([REPLICA_URL, REPLICA_URL])
+        first, second = replicas.engines
+
+        self.assertEqual([replicas.choose() for _ in range(4)],
+                         [first, second, first, second])
+
+        self.use_replicas([REPLICA_URL, REPLICA_URL], 'least_connections')
+        first, second = replicas.engines
+        with first.connect():
+            self.assertIs(replicas.choose(), second)
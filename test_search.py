@@ -0,0 +1,194 @@
+"""Search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import text
+
+from models import db, User, Message
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from testing import reset_caches
+from pagination import decode_cursor
+from search import (TrigramIndex, user_search, search_messages,
+                    reindex_messages)
+
+db.create_all()
+
+
+class TrigramIndexTestCase(TestCase):
+    """Test the in-process fallback index."""
+
+    def setUp(self):
+        self.index = TrigramIndex()
+        self.index.add(1, "bobcat", "Boston")
+        self.index.add(2, "catherine", "Denver")
+        self.index.add(3, "tomcat", "Catskill")
+        self.index.add(4, "dog", "Austin")
+
+    def test_substring_match(self):
+        self.assertEqual(set(self.index.search("cat", 10)), {1, 2, 3})
+        self.assertEqual(self.index.search("austin", 10), [4])
+        self.assertEqual(self.index.search("zebra", 10), [])
+
+    def test_short_query(self):
+        self.assertEqual(set(self.index.search("do", 10)), {4})
+
+    def test_prefix_ranks_first(self):
+        self.assertEqual(self.index.search("cat", 10)[0], 2)
+
+    def test_remove_and_update(self):
+        self.index.remove(2)
+        self.index.add(3, "tomkitten", "Catskill")
+        self.assertEqual(set(self.index.search("cat", 10)), {1, 3})
+        self.assertEqual(self.index.search("kitten", 10), [3])
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.search("cat", 2)), 2)
+
+
+class UserSearchViewTestCase(TestCase):
+    """Test /users?q= against the database."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        for n in range(1, 8):
+            db.session.add(User(id=n, username=f"searchable{n}",
+                                email=f"s{n}@test.com",
+                                password="HASHED_PASSWORD"))
+        db.session.add(User(id=99, username="other", email="o@test.com",
+                            location="Searchable Springs",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_search_matches_location(self):
+        names = [u.username for u in user_search.search("springs", 10)]
+        self.assertEqual(names, ["other"])
+
+    def test_short_query_matches_prefixes(self):
+        names = [u.username for u in user_search.search("SE", 3)]
+        self.assertEqual(names, ["searchable1", "searchable2", "searchable3"])
+        self.assertEqual(user_search.search("pr", 10), [])
+
+    def test_prefix_then_closest(self):
+        db.session.add(User(id=50, username="unsearchable", email="u@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.add(User(id=51, username="searchables", email="x@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        names = [u.username for u in user_search.search("searchable", 20)]
+        self.assertEqual(names[:2], ["searchable1", "searchable2"])
+        self.assertEqual(names[-3:], ["searchables", "unsearchable", "other"])
+
+    def test_new_user_is_searchable(self):
+        user_search.search("searchable", 10)
+
+        db.session.add(User(id=100, username="latecomer", email="l@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        names = [u.username for u in user_search.search("latecomer", 10)]
+        self.assertEqual(names, ["latecomer"])
+
+    def test_search_pages(self):
+        app.config['USERS_PER_PAGE'] = 5
+        try:
+            resp = self.client.get("/users?q=searchable")
+            body = str(resp.data)
+            self.assertEqual(body.count("@searchable"), 5)
+            self.assertIn("page=2", body)
+
+            resp = self.client.get("/users?q=searchable&page=2")
+            body = str(resp.data)
+            self.assertEqual(body.count("@searchable"), 2)
+            self.assertIn("@other", body)
+            self.assertNotIn("More users", body)
+        finally:
+            app.config['USERS_PER_PAGE'] = 30
+
+    def test_list_pages(self):
+        app.config['USERS_PER_PAGE'] = 5
+        try:
+            resp = self.client.get("/users")
+            self.assertIn("after=5", str(resp.data))
+
+            resp = self.client.get("/users?after=5")
+            body = str(resp.data)
+            self.assertIn("@searchable6", body)
+            self.assertIn("@other", body)
+            self.assertNotIn("@searchable5", body)
+        finally:
+            app.config['USERS_PER_PAGE'] = 30
+
+
+class MessageSearchTestCase(TestCase):
+    """Test full-text search over messages."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        db.session.add(User(id=1, username="writer", email="w@test.com",
+                            password="HASHED_PASSWORD"))
+        db.session.add_all([
+            Message(id=1, text="The quick brown fox", user_id=1),
+            Message(id=2, text="Lazy dogs are sleeping", user_id=1),
+            Message(id=3, text="Quick, quick, quicker!", user_id=1),
+        ])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_ranked_results(self):
+        self.assertEqual([m.id for m in search_messages("quick")], [3, 1])
+        self.assertEqual([m.id for m in search_messages("sleep dog")], [2])
+        self.assertEqual(search_messages("   ").items, [])
+
+    def test_cursor_pages(self):
+        first = search_messages("quick", per_page=1)
+        self.assertEqual([m.id for m in first], [3])
+
+        second = search_messages("quick", before=decode_cursor(first.next_cursor),
+                                 per_page=1)
+        self.assertEqual([m.id for m in second], [1])
+        self.assertIsNone(second.next_cursor)
+
+    def test_search_view(self):
+        resp = self.client.get("/messages/search?q=lazy")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Lazy dogs are sleeping", str(resp.data))
+        self.assertNotIn("quick brown", str(resp.data))
+
+    def test_reindex_creates_missing_index(self):
+        db.session.execute(text("DROP INDEX ix_messages_text_fts"))
+        reindex_messages()
+        db.session.commit()
+
+        self.assertTrue(db.session.execute(text(
+            "SELECT to_regclass('ix_messages_text_fts')")).scalar())
+        reindex_messages()
+        self.assertEqual([m.id for m in search_messages("quick")], [3, 1])
@@ -0,0 +1,259 @@
+"""Home timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from pagination import decode_cursor
+import timeline
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TimelineTestCase(TestCase):
+    """Test the materialized home timeline."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        self.author = User.signup("author", "author@test.com", "password", None)
+        self.author.id = 4040
+        self.reader = User.signup("reader", "reader@test.com", "password", None)
+        self.reader.id = 5050
+
+        db.session.commit()
+
+    def tearDown(self):
+        """Rollback session after each test"""
+
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def timeline_ids(self, user_id):
+        return {e.message_id for e in
+                TimelineEntry.query.filter_by(user_id=user_id).all()}
+
+    def test_post_fans_out_to_followers(self):
+        db.session.add(Follows(user_being_followed_id=4040, user_following_id=5050))
+        db.session.commit()
+
+        self.login(4040)
+        self.client.post("/messages/new", data={"text": "fanned out"})
+
+        msg = Message.query.filter_by(text="fanned out").one()
+        self.assertEqual(self.timeline_ids(4040), {msg.id})
+        self.assertEqual(self.timeline_ids(5050), {msg.id})
+
+        self.login(5050)
+        resp = self.client.get("/")
+        self.assertIn("fanned out", str(resp.data))
+
+    def test_follow_backfills_and_unfollow_removes(self):
+        msg = Message(id=77, text="older warble", user_id=4040)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.login(5050)
+        self.client.post("/users/follow/4040")
+        self.assertEqual(self.timeline_ids(5050), {77})
+
+        self.client.post("/users/stop-following/4040")
+        self.assertEqual(self.timeline_ids(5050), set())
+
+    def test_delete_removes_entries(self):
+        db.session.add(Follows(user_being_followed_id=4040, user_following_id=5050))
+        db.session.add(Message(id=88, text="doomed", user_id=4040))
+        db.session.commit()
+        timeline.rebuild()
+        db.session.commit()
+
+        self.assertEqual(self.timeline_ids(5050), {88})
+
+        self.login(4040)
+        self.client.post("/messages/88/delete")
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_fan_out_on_read_matches(self):
+        db.session.add(Follows(user_being_followed_id=4040, user_following_id=5050))
+        db.session.add_all([
+            Message(id=1, text="one", user_id=4040),
+            Message(id=2, text="two", user_id=5050),
+        ])
+        db.session.commit()
+        timeline.rebuild()
+        db.session.commit()
+
+        reader = User.query.get(5050)
+        self.assertEqual(
+            [m.id for m in timeline.home_messages(reader)],
+            [m.id for m in timeline.fan_out_on_read(reader)])
+
+
+class FanOutLimitsTestCase(TestCase):
+    """Test who is left out of fan-out-on-write, and reading around it."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        for id, name in ((4040, "author"), (5050, "reader"), (6060, "other")):
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = id
+        db.session.commit()
+
+        for follower in (5050, 6060):
+            db.session.add(Follows(user_being_followed_id=4040,
+                                   user_following_id=follower))
+        db.session.commit()
+
+        self.thresholds = (timeline.FANOUT_READ_THRESHOLD,
+                           timeline.FANOUT_WRITE_THRESHOLD)
+
+    def tearDown(self):
+        (timeline.FANOUT_READ_THRESHOLD,
+         timeline.FANOUT_WRITE_THRESHOLD) = self.thresholds
+        timeline.large_authors.clear()
+        db.session.rollback()
+
+    def post(self, text, id):
+        msg = Message(id=id, text=text, user_id=4040)
+        db.session.add(msg)
+        db.session.flush()
+        timeline.fan_out(msg)
+        db.session.commit()
+        return msg
+
+    def entries_for(self, user_id):
+        return TimelineEntry.query.filter_by(user_id=user_id).count()
+
+    def test_read_side_readers_skipped(self):
+        db.session.add(Follows(user_being_followed_id=5050,
+                               user_following_id=6060))
+        db.session.commit()
+        timeline.FANOUT_READ_THRESHOLD = 1
+
+        self.post("hello", 1)
+
+        self.assertEqual(self.entries_for(5050), 1)
+        self.assertEqual(self.entries_for(6060), 0)
+        reader = User.query.get(6060)
+        self.assertEqual([m.id for m in timeline.home_messages(reader)], [1])
+
+    def test_large_author_pulled_at_read(self):
+        self.post("before", 1)
+        timeline.FANOUT_WRITE_THRESHOLD = 1
+
+        self.post("after", 2)
+
+        self.assertEqual(self.entries_for(4040), 2)
+        self.assertEqual(self.entries_for(5050), 1)
+        reader = User.query.get(5050)
+        page = timeline.home_messages(reader, per_page=1)
+        self.assertEqual([m.id for m in page], [2])
+        rest = timeline.home_messages(reader,
+                                      before=decode_cursor(page.next_cursor))
+        self.assertEqual([m.id for m in rest], [1])
+
+    def test_short_timeline_not_refilled(self):
+        self.post("only", 1)
+        reader = User.query.get(5050)
+
+        statements = []
+        record = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual([m.id for m in timeline.home_messages(reader)], [1])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertFalse(any('follows.user_following_id' in statement
+                             and 'messages.user_id IN' in statement
+                             for statement in statements))
+
+    def test_never_built_timeline_read_from_messages(self):
+        db.session.add(Message(id=1, text="bulk loaded", user_id=4040))
+        db.session.commit()
+
+        reader = User.query.get(5050)
+        self.assertEqual([m.id for m in timeline.home_messages(reader)], [1])
+
+    def test_trim_all(self):
+        length = timeline.TIMELINE_LENGTH
+        timeline.TIMELINE_LENGTH = 2
+        try:
+            for id in range(1, 5):
+                self.post(f"message {id}", id)
+            self.assertEqual(self.entries_for(5050), 4)
+
+            self.assertEqual(timeline.trim_all(batch_users=1000), 6)
+        finally:
+            timeline.TIMELINE_LENGTH = length
+
+        self.assertEqual(
+            {e.message_id for e in TimelineEntry.query.filter_by(user_id=5050)},
+            {3, 4})
+
+    def test_paging_after_unfollow(self):
+        db.session.add(Follows(user_being_followed_id=6060,
+                               user_following_id=5050))
+        db.session.commit()
+
+        length = timeline.TIMELINE_LENGTH
+        timeline.TIMELINE_LENGTH = 10
+        try:
+            # 4040 and 6060 take turns posting
+            for id in range(1, 41):
+                msg = Message(id=id, text=f"message {id}",
+                              user_id=4040 if id % 2 else 6060,
+                              timestamp=datetime(2020, 1, 1)
+                              + timedelta(minutes=id))
+                db.session.add(msg)
+                db.session.flush()
+                timeline.fan_out(msg)
+            db.session.commit()
+            timeline.trim_all()
+
+            Follows.query.filter_by(user_being_followed_id=6060,
+                                    user_following_id=5050).delete()
+            timeline.remove_author(5050, 6060)
+            db.session.commit()
+
+            reader = User.query.get(5050)
+            seen, before = [], None
+            while True:
+                page = timeline.home_messages(reader, before, per_page=3)
+                seen += [m.id for m in page]
+                if not page.next_cursor:
+                    break
+                before = decode_cursor(page.next_cursor)
+        finally:
+            timeline.TIMELINE_LENGTH = length
+
+        self.assertEqual(seen, list(range(39, 0, -2)))
@@ -0,0 +1,96 @@
+"""Session user cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_cache.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from user_cache import user_cache
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class UserCacheTestCase(TestCase):
+    """Test that g.user is lazy and cached."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        user = User.signup("cached", "cached@test.com", "password", None)
+        user.id = 6060
+        db.session.commit()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 6060
+
+    def test_anonymous_request_runs_no_queries(self):
+        resp = self.client.get("/login")
+        self.assertIn('desc="0 queries"', resp.headers["Server-Timing"])
+
+    def test_view_without_g_user_runs_no_queries(self):
+        self.login()
+        resp = self.client.get("/logout")
+        self.assertIn('desc="0 queries"', resp.headers["Server-Timing"])
+
+    def test_cached_user_needs_no_query(self):
+        self.login()
+        self.client.get("/messages/new")
+
+        db.session.remove()
+        resp = self.client.get("/messages/new")
+        self.assertIn('alt="cached"', str(resp.data))
+        self.assertIn('desc="0 queries"', resp.headers["Server-Timing"])
+
+    def test_profile_invalidates(self):
+        self.login()
+        self.client.get("/messages/new")
+
+        self.client.post("/users/profile", data={
+            "username": "renamed",
+            "email": "cached@test.com",
+            "password": "password",
+        })
+
+        db.session.remove()
+        resp = self.client.get("/messages/new")
+        self.assertIn('alt="renamed"', str(resp.data))
+        self.assertNotIn('alt="cached"', str(resp.data))
+
+    def test_profile_checks_current_row(self):
+        self.login()
+        self.client.get("/messages/new")
+
+        # renamed elsewhere; our cached snapshot still says "cached"
+        User.query.get(6060).username = "elsewhere"
+        db.session.commit()
+        db.session.remove()
+
+        resp = self.client.post("/users/profile", data={
+            "username": "renamed",
+            "email": "cached@test.com",
+            "password": "password",
+        })
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(User.query.get(6060).username, "renamed")
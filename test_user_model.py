@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +21,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from testing import reset_caches
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -37,6 +38,7 @@ class UserModelTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        reset_caches()
 
         user1 = User.signup("test1", "email1@email.com", "password", None)
         user1.id = 1111
@@ -105,6 +107,74 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.user2.is_followed_by(self.user1))
         self.assertFalse(self.user1.is_followed_by(self.user2))
 
+    def test_following_status(self):
+        """test batched following_status lookup"""
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_status([2222, 1111, 404]), {2222})
+        self.assertEqual(self.user2.following_status([1111]), set())
+        self.assertEqual(self.user1.following_status([]), set())
+
+    def test_liked_among(self):
+        """test batched liked_among lookup"""
+        db.session.add_all([Message(id=321, text="one", user_id=2222),
+                            Message(id=322, text="two", user_id=2222)])
+        db.session.commit()
+        db.session.add(Likes(user_id=1111, message_id=321))
+        db.session.commit()
+
+        self.assertEqual(self.user1.liked_among([321, 322, 404]), {321})
+        self.assertEqual(self.user2.liked_among([321]), set())
+        self.assertEqual(self.user1.liked_among([]), set())
+
+    def test_counters(self):
+        """Are the denormalized counters kept in step?"""
+        db.session.add(Follows(user_being_followed_id=2222, user_following_id=1111))
+        db.session.add(Message(id=321, text="counted", user_id=2222))
+        db.session.commit()
+
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user2.follower_count, 1)
+        self.assertEqual(self.user2.message_count, 1)
+
+        db.session.delete(Message.query.get(321))
+        db.session.commit()
+        self.assertEqual(self.user2.message_count, 0)
+
+    def test_collection_counters(self):
+        """Do the following/likes collections keep the counters too?"""
+        db.session.add(Message(id=321, text="counted", user_id=2222))
+        db.session.commit()
+
+        self.user1.following.append(self.user2)
+        self.user1.likes.append(Message.query.get(321))
+        db.session.commit()
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user2.follower_count, 1)
+        self.assertEqual(self.user1.likes_count, 1)
+        self.assertEqual(Message.query.get(321).likes_count, 1)
+
+        self.user1.following.remove(self.user2)
+        self.user1.likes.clear()
+        db.session.commit()
+        self.assertEqual(self.user1.following_count, 0)
+        self.assertEqual(self.user2.follower_count, 0)
+        self.assertEqual(self.user1.likes_count, 0)
+        self.assertEqual(Message.query.get(321).likes_count, 0)
+
+    def test_recount(self):
+        """Does recount repair counters written around the ORM?"""
+        db.session.execute(Follows.__table__.insert().values(
+            user_being_followed_id=2222, user_following_id=1111))
+        db.session.commit()
+        self.assertEqual(self.user1.following_count, 0)
+
+        User.recount()
+        db.session.commit()
+        self.assertEqual(self.user1.following_count, 1)
+        self.assertEqual(self.user2.follower_count, 1)
+
 #signup tests
     def test_valid_signup(self):
         """test valid user signup"""
@@ -9,6 +9,7 @@ from bs4 import BeautifulSoup
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY
+from testing import reset_caches
 
 db.create_all()
 
@@ -22,6 +23,7 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        reset_caches()
 
         self.client = app.test_client()
 
@@ -79,6 +81,33 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("@testuser", str(resp.data))
 
+    def test_user_show_paginates(self):
+        db.session.add_all([
+            Message(id=n, text=f"warble number {n}", user_id=self.testuser_id)
+            for n in range(1, 4)
+        ])
+        db.session.commit()
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{self.testuser_id}")
+                soup = BeautifulSoup(resp.data, 'html.parser')
+                self.assertIn("warble number 3", str(resp.data))
+                self.assertIn("warble number 2", str(resp.data))
+                self.assertNotIn("warble number 1", str(resp.data))
+
+                older = soup.find("a", string="Older warbles")["href"]
+                resp = c.get(f"/users/{self.testuser_id}{older}")
+                self.assertIn("warble number 1", str(resp.data))
+                self.assertNotIn("warble number 2", str(resp.data))
+                self.assertNotIn("Older warbles", str(resp.data))
+
+                resp = c.get(f"/users/{self.testuser_id}?before=garbage")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['MESSAGES_PER_PAGE'] = 100
+
     def setup_likes(self):
         msg1 = Message(text="trending warble", user_id=self.testuser_id)
         msg2 = Message(text="Eating some lunch", user_id=self.testuser_id)
@@ -0,0 +1,197 @@
+"""Write-behind queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_write_behind.py
+
+
+import os
+import shutil
+import tempfile
+from time import sleep
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from testing import reset_caches
+from write_behind import write_queue, APPLY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class WriteBehindTestCase(TestCase):
+    """Test queued follows and likes, and reading them back."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        reset_caches()
+
+        self.client = app.test_client()
+
+        for id, name in ((4040, "author"), (5050, "reader")):
+            user = User.signup(name, f"{name}@test.com", "password", None)
+            user.id = id
+        db.session.commit()
+
+        msg = Message(text="queued", user_id=4040)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+        self.dir = tempfile.mkdtemp()
+        write_queue.enabled = True
+        write_queue.path = os.path.join(self.dir, 'queue.sqlite3')
+        # Drained explicitly with flush(), except in test_worker.
+        write_queue._start_worker = lambda: None
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 5050
+
+    def tearDown(self):
+        del write_queue._start_worker
+        write_queue.enabled = False
+        shutil.rmtree(self.dir)
+        db.session.rollback()
+
+    def test_like_visible_before_flush(self):
+        resp = self.client.post(f"/api/messages/{self.msg_id}/like")
+        self.assertEqual(resp.json['liked'], True)
+        self.assertEqual(resp.json['likes_count'], 1)
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(User.query.get(5050).liked_among([self.msg_id]),
+                         {self.msg_id})
+        self.assertEqual(write_queue.depth(), 1)
+
+        self.assertEqual(write_queue.flush(), 1)
+        self.assertEqual(write_queue.depth(), 0)
+        db.session.expire_all()
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 1)
+
+    def test_toggles_coalesce(self):
+        for _ in range(3):
+            self.client.post(f"/messages/{self.msg_id}/like")
+        resp = self.client.post(f"/api/messages/{self.msg_id}/like")
+        self.assertEqual(resp.json['liked'], False)
+
+        write_queue.flush()
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 0)
+
+    def test_replay_is_harmless(self):
+        write_queue.enqueue('like', 5050, self.msg_id, True)
+        write_queue.flush()
+        # as if the batch committed but the process died before dequeueing
+        write_queue.enqueue('like', 5050, self.msg_id, True)
+        write_queue.flush()
+
+        db.session.expire_all()
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(Message.query.get(self.msg_id).likes_count, 1)
+
+    def test_follow_and_unfollow(self):
+        self.client.post("/users/follow/4040")
+
+        reader, author = User.query.get(5050), User.query.get(4040)
+        self.assertTrue(reader.is_following(author))
+        self.assertTrue(author.is_followed_by(reader))
+        self.assertIsNone(Follows.query.get((4040, 5050)))
+        self.assertIn(b"@author", self.client.get("/users/5050/following").data)
+
+        write_queue.flush()
+        self.assertIsNotNone(Follows.query.get((4040, 5050)))
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=5050).count(), 1)
+
+        self.client.post("/users/stop-following/4040")
+        self.assertEqual(User.query.get(5050).following_status([4040]), set())
+        self.assertNotIn(b"@author", self.client.get("/users/5050/following").data)
+
+        write_queue.flush()
+        self.assertIsNone(Follows.query.get((4040, 5050)))
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=5050).count(), 0)
+
+    def test_unfollow_not_following(self):
+        resp = self.client.post("/users/stop-following/4040")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(write_queue.depth(), 0)
+
+    def test_op_for_deleted_message_dropped(self):
+        self.client.post(f"/messages/{self.msg_id}/like")
+        db.session.delete(Message.query.get(self.msg_id))
+        db.session.commit()
+
+        write_queue.enqueue('follow', 5050, 4040, True)
+        self.assertEqual(write_queue.flush(), 2)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertIsNotNone(Follows.query.get((4040, 5050)))
+
+    def test_worker(self):
+        del write_queue._start_worker
+        write_queue.interval = 0
+
+        self.client.post(f"/messages/{self.msg_id}/like")
+        for _ in range(100):
+            if not write_queue.depth():
+                break
+            sleep(0.05)
+
+        write_queue._start_worker = lambda: None
+        write_queue.interval = app.config['WRITE_BEHIND_INTERVAL']
+        self.assertEqual(write_queue.depth(), 0)
+        self.assertEqual(Likes.query.count(), 1)
+
+    def test_failing_op_dead_lettered(self):
+        def fail(*args):
+            raise ValueError("broken")
+
+        write_queue.max_attempts, write_queue.retry_seconds = 3, 0
+        write_queue.enqueue('like', 5050, self.msg_id, True)
+        write_queue.enqueue('follow', 5050, 4040, True)
+        apply_like, APPLY['like'] = APPLY['like'], fail
+        try:
+            write_queue.flush()
+        finally:
+            APPLY['like'] = apply_like
+            write_queue.max_attempts = app.config['WRITE_BEHIND_MAX_ATTEMPTS']
+            write_queue.retry_seconds = app.config['WRITE_BEHIND_RETRY_SECONDS']
+
+        # the follow went in past it
+        self.assertIsNotNone(Follows.query.get((4040, 5050)))
+        self.assertEqual(write_queue.depth(), 0)
+        dead = write_queue.dead_ops()
+        self.assertEqual([(op['kind'], op['attempts']) for op in dead],
+                         [('like', 3)])
+        self.assertIn("broken", dead[0]['error'])
+
+    def test_failing_op_backs_off(self):
+        def fail(*args):
+            raise ValueError("broken")
+
+        write_queue.enqueue('like', 5050, self.msg_id, True)
+        apply_like, APPLY['like'] = APPLY['like'], fail
+        try:
+            write_queue.flush()
+        finally:
+            APPLY['like'] = apply_like
+
+        # waiting out its retry delay, not blocking later ops
+        self.assertEqual(write_queue.depth(), 1)
+        self.assertGreater(write_queue._retry_due(), 0)
+        write_queue.enqueue('follow', 5050, 4040, True)
+        write_queue.flush()
+        self.assertIsNotNone(Follows.query.get((4040, 5050)))
+        self.assertEqual(write_queue.depth(), 1)
+
+    def test_connection_reopened_after_fork(self):
+        conn = write_queue._connection()
+        self.assertIs(write_queue._connection(), conn)
+
+        write_queue._local.pid = -1     # as if inherited from a parent
+        self.assertIsNot(write_queue._connection(), conn)
@@ -0,0 +1,14 @@
+"""Helpers shared by the test modules."""
+
+from fragments import fragment_cache
+import timeline
+from user_cache import user_cache
+
+
+def reset_caches():
+    """Forget what's cached about rows. Tests recreate the tables, and
+    the new rows reuse the old ones' ids."""
+
+    user_cache.clear()
+    fragment_cache.clear()
+    timeline.large_authors.clear()
@@ -0,0 +1,378 @@
+"""Materialized home timelines for Warbler.
+
+Every user has a bounded list of the newest message ids from the people
+they follow (plus their own), kept in `timeline_entries`. It is filled
+when a message is posted (fan-out-on-write) and patched up when follows
+change or messages are deleted, so the home page is one indexed range
+read instead of an `IN (...)` over everyone the user follows.
+
+Two kinds of account are left out, because writing for them would cost
+more than it saves:
+
+- Readers following more than FANOUT_READ_THRESHOLD accounts read their
+  home page straight from `messages` (`fan_out_on_read()`), so nothing
+  is fanned out to them.
+- Authors with more than FANOUT_WRITE_THRESHOLD followers aren't fanned
+  out at all, so posting stays a couple of inserts. Their followers'
+  home pages merge in their newest messages at read time instead. The
+  read side pulls from authors above half the threshold, so an author
+  crossing it either way is never in neither place.
+
+Posting doesn't trim anyone's timeline: `trim_all()` (`flask
+trim-timelines`, run from cron) cuts timelines back to TIMELINE_LENGTH
+in batches. In between they can run a little long, which readers never
+notice. Following someone trims the follower's timeline straight away,
+since the backfill can add a whole TIMELINE_LENGTH of entries.
+
+A timeline that has lost older entries to trimming (or never got them:
+a rebuild or backfill only copies the newest) is marked
+`users.timeline_trimmed`. Unfollows and deletes can shrink it below
+TIMELINE_LENGTH again, so it's the mark, not the length, that tells a
+reader who ran off its end whether there's more to read from `messages`.
+"""
+
+from sqlalchemy import and_, exists, func, literal, select, tuple_
+from sqlalchemy.orm import joinedload
+
+from cache import LRUCache
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import Page, encode_cursor, id_ranges, paginate
+
+# How many entries we keep per user.
+TIMELINE_LENGTH = 800
+
+# Users following more accounts than this are served by the
+# fan-out-on-read query instead of their materialized timeline.
+FANOUT_READ_THRESHOLD = 5000
+
+# Authors with more followers than this are pulled at read time rather
+# than fanned out on write.
+FANOUT_WRITE_THRESHOLD = 10000
+
+# How long each process keeps its list of pulled authors.
+LARGE_AUTHORS_TTL = 60
+
+# Users per transaction for `rebuild()` and `trim_all()`.
+BATCH_USERS = 10000
+
+entries = TimelineEntry.__table__
+
+large_authors = LRUCache(maxsize=1, ttl=LARGE_AUTHORS_TTL)
+
+
+def fan_out(message):
+    """Add `message` to its author's timeline and their followers'.
+
+    Followers who read on read are skipped, and so is everyone if the
+    author has too many followers. The message must already be flushed
+    (so it has an id and timestamp).
+    """
+
+    db.session.execute(entries.insert().values(
+        user_id=message.user_id,
+        message_id=message.id,
+        timestamp=message.timestamp,
+    ))
+
+    if _counter(message.user_id, 'follower_count') > FANOUT_WRITE_THRESHOLD:
+        return
+
+    followers = (select([
+                    Follows.user_following_id,
+                    literal(message.id, db.Integer),
+                    literal(message.timestamp, db.DateTime),
+                 ])
+                 .where(Follows.user_being_followed_id == message.user_id)
+                 .where(User.id == Follows.user_following_id)
+                 .where(User.following_count <= FANOUT_READ_THRESHOLD))
+
+    db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'], followers))
+
+
+def backfill(follower_id, followed_id):
+    """Copy `followed_id`'s newest messages into `follower_id`'s timeline,
+    unless one of them is left out of fan-out."""
+
+    if (_counter(follower_id, 'following_count') > FANOUT_READ_THRESHOLD
+            or _counter(followed_id, 'follower_count')
+            > FANOUT_WRITE_THRESHOLD):
+        return
+
+    newest = (select([
+                 literal(follower_id, db.Integer),
+                 Message.id,
+                 Message.timestamp,
+              ])
+              .where(Message.user_id == followed_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(TIMELINE_LENGTH))
+
+    added = db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'], newest)).rowcount
+    if added == TIMELINE_LENGTH:
+        # `followed_id` may well have older messages.
+        _mark_trimmed([follower_id])
+
+    trim([follower_id])
+
+
+def remove_author(follower_id, followed_id):
+    """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+    authored = select([Message.id]).where(Message.user_id == followed_id)
+
+    db.session.execute(entries.delete().where(and_(
+        entries.c.user_id == follower_id,
+        entries.c.message_id.in_(authored),
+    )))
+
+
+def remove_message(message_id):
+    """Drop a message from every timeline it was fanned out to."""
+
+    db.session.execute(
+        entries.delete().where(entries.c.message_id == message_id))
+
+
+def trim(user_ids):
+    """Keep only the newest TIMELINE_LENGTH entries for `user_ids`.
+
+    `user_ids` can be a list or a select of ids. Returns how many
+    entries were removed.
+    """
+
+    position = (func.row_number()
+                .over(partition_by=entries.c.user_id,
+                      order_by=(entries.c.timestamp.desc(),
+                                entries.c.message_id.desc()))
+                .label('position'))
+
+    ranked = (select([entries.c.user_id, entries.c.message_id, position])
+              .where(entries.c.user_id.in_(user_ids))
+              .alias('ranked'))
+
+    stale = (select([ranked.c.user_id, ranked.c.message_id])
+             .where(ranked.c.position > TIMELINE_LENGTH))
+
+    _mark_trimmed(select([ranked.c.user_id])
+                  .where(ranked.c.position > TIMELINE_LENGTH))
+    return db.session.execute(entries.delete().where(
+        tuple_(entries.c.user_id, entries.c.message_id).in_(stale))).rowcount
+
+
+def trim_all(batch_users=BATCH_USERS):
+    """Trim every timeline that has run past TIMELINE_LENGTH.
+
+    Works through `batch_users` users at a time, committing each batch.
+    Returns how many entries were removed.
+    """
+
+    removed = 0
+    for start, end in id_ranges(User.id, batch_users):
+        overlong = (select([entries.c.user_id])
+                    .where(entries.c.user_id >= start)
+                    .where(entries.c.user_id < end)
+                    .group_by(entries.c.user_id)
+                    .having(func.count() > TIMELINE_LENGTH))
+        removed += trim(overlong)
+        db.session.commit()
+    return removed
+
+
+def rebuild(batch_users=BATCH_USERS):
+    """Rebuild every timeline from scratch.
+
+    Used after bulk loads (see seed.py), which bypass `fan_out`. Works
+    through `batch_users` readers at a time, committing each batch.
+    """
+
+    for start, end in id_ranges(User.id, batch_users):
+        _rebuild_range(start, end)
+        db.session.commit()
+
+
+def _rebuild_range(start, end):
+    """Rebuild the timelines of users with ids in `[start, end)`."""
+
+    users = User.__table__
+    db.session.execute(entries.delete()
+                       .where(entries.c.user_id >= start)
+                       .where(entries.c.user_id < end))
+    db.session.execute(users.update()
+                       .where(users.c.id >= start)
+                       .where(users.c.id < end)
+                       .where(users.c.timeline_trimmed)
+                       .values(timeline_trimmed=False))
+
+    # Only what fan_out() would have written.
+    reader = User.__table__.alias('reader')
+    author = User.__table__.alias('author')
+    authors = (select([
+                  Follows.user_following_id.label('user_id'),
+                  Follows.user_being_followed_id.label('author_id'),
+               ])
+               .where(reader.c.id == Follows.user_following_id)
+               .where(reader.c.following_count <= FANOUT_READ_THRESHOLD)
+               .where(author.c.id == Follows.user_being_followed_id)
+               .where(author.c.follower_count <= FANOUT_WRITE_THRESHOLD)
+               .where(Follows.user_following_id >= start)
+               .where(Follows.user_following_id < end)
+               .union_all(select([
+                  User.id.label('user_id'),
+                  User.id.label('author_id'),
+               ])
+               .where(User.id >= start)
+               .where(User.id < end))
+               .alias('authors'))
+
+    position = (func.row_number()
+                .over(partition_by=authors.c.user_id,
+                      order_by=(Message.timestamp.desc(), Message.id.desc()))
+                .label('position'))
+
+    ranked = (select([authors.c.user_id, Message.id.label('message_id'),
+                      Message.timestamp, position])
+              .select_from(authors.join(
+                  Message, Message.user_id == authors.c.author_id))
+              .alias('ranked'))
+
+    db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'timestamp'],
+        select([ranked.c.user_id, ranked.c.message_id, ranked.c.timestamp])
+        .where(ranked.c.position <= TIMELINE_LENGTH)))
+
+    # Filled to the brim: there may have been more.
+    _mark_trimmed(select([entries.c.user_id])
+                  .where(entries.c.user_id >= start)
+                  .where(entries.c.user_id < end)
+                  .group_by(entries.c.user_id)
+                  .having(func.count() >= TIMELINE_LENGTH))
+
+
+def _mark_trimmed(user_ids):
+    """Note that `user_ids` (a list or a select of ids) are missing older
+    entries from their timelines."""
+
+    users = User.__table__
+    db.session.execute(users.update()
+                       .where(users.c.id.in_(user_ids))
+                       .where(~users.c.timeline_trimmed)
+                       .values(timeline_trimmed=True))
+
+
+def _counter(user_id, counter):
+    return (db.session.query(getattr(User, counter))
+            .filter(User.id == user_id)
+            .scalar()) or 0
+
+
+def _large_authors():
+    """Ids of the accounts whose messages readers pull, cached a while."""
+
+    ids = large_authors.get('ids')
+    if ids is None:
+        ids = frozenset(
+            id for id, in db.session.query(User.id).filter(
+                User.follower_count > FANOUT_WRITE_THRESHOLD // 2))
+        large_authors.set('ids', ids)
+    return ids
+
+
+def _pulled_authors(user_id):
+    """Which of the accounts `user_id` follows are pulled at read time?"""
+
+    large = _large_authors()
+    if not large:
+        return []
+    return [id for id, in db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    Follows.user_being_followed_id.in_(large))]
+
+
+def _has_entries(user_id):
+    """Has anything ever been materialized into `user_id`'s timeline?"""
+
+    return db.session.query(
+        exists().where(entries.c.user_id == user_id)).scalar()
+
+
+def _merge(page, other, per_page):
+    """Two newest-first pages of messages as one, without duplicates."""
+
+    seen, items = set(), []
+    for msg in sorted(page.items + other.items,
+                      key=lambda msg: (msg.timestamp, msg.id), reverse=True):
+        if msg.id not in seen:
+            seen.add(msg.id)
+            items.append(msg)
+
+    more = page.next_cursor or other.next_cursor or len(items) > per_page
+    items = items[:per_page]
+    if not (more and items):
+        return Page(items)
+    return Page(items, encode_cursor(items[-1].timestamp, items[-1].id))
+
+
+def home_messages(user, before=None, per_page=100):
+    """One page of `user`'s home timeline, newest first.
+
+    `before` is a decoded cursor from `pagination`. If the reader pages
+    past the materialized window -- or it was never built -- the rest of
+    the page comes from the fan-out-on-read query.
+    """
+
+    if user.following_count > FANOUT_READ_THRESHOLD:
+        return fan_out_on_read(user, before, per_page)
+
+    page = paginate(Message
+                    .query
+                    .options(joinedload(Message.user))
+                    # The timestamp lets a partitioned `messages` (see
+                    # partitions.py) look each one up in a single month.
+                    .join(TimelineEntry,
+                          and_(TimelineEntry.message_id == Message.id,
+                               TimelineEntry.timestamp == Message.timestamp))
+                    .filter(TimelineEntry.user_id == user.id),
+                    TimelineEntry.timestamp, TimelineEntry.message_id,
+                    before=before, per_page=per_page)
+
+    pulled = _pulled_authors(user.id)
+    if pulled:
+        page = _merge(page, paginate(Message
+                                     .query
+                                     .options(joinedload(Message.user))
+                                     .filter(Message.user_id.in_(pulled)),
+                                     Message.timestamp, Message.id,
+                                     before=before, per_page=per_page),
+                      per_page)
+
+    if page.next_cursor or len(page) == per_page:
+        return page
+
+    # The timeline ran out. That's the end of it, unless older entries
+    # were cut from it or nothing was ever materialized.
+    if not user.timeline_trimmed and _has_entries(user.id):
+        return page
+
+    if page.items:
+        before = (page.items[-1].timestamp, page.items[-1].id)
+
+    rest = fan_out_on_read(user, before, per_page - len(page))
+    return Page(page.items + rest.items, rest.next_cursor)
+
+
+def fan_out_on_read(user, before=None, per_page=100):
+    """One page of messages by `user` and everyone they follow, computed
+    straight from `messages`."""
+
+    followed = (select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user.id))
+
+    return paginate(Message
+                    .query
+                    .options(joinedload(Message.user))
+                    .filter((Message.user_id == user.id)
+                            | Message.user_id.in_(followed)),
+                    Message.timestamp, Message.id,
+                    before=before, per_page=per_page)
@@ -0,0 +1,81 @@
+"""Short-lived cache of logged-in users.
+
+Looking up the session's user used to be a primary-key SELECT on every
+request. Instead we keep a snapshot of the user's profile columns for a
+few seconds and re-attach it to the session without touching the
+database. Columns left out of the snapshot (the password hash and the
+denormalized counters, which other people's actions change) are loaded
+on first access like any expired attribute.
+
+`profile()` and `delete_user()` invalidate their user's entry; anything
+else that changes profile columns should too.
+"""
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from cache import LRUCache, TieredCache
+from models import db, User
+
+CACHED_COLUMNS = (
+    'id',
+    'email',
+    'username',
+    'image_url',
+    'header_image_url',
+    'bio',
+    'location',
+)
+
+
+class UserCache:
+    """Cache of `User` snapshots keyed by id."""
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = 0
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_TTL', 30)
+        app.config.setdefault('USER_CACHE_SIZE', 10000)
+        # Optional shared store (see cache.py) sitting behind the local LRU.
+        app.config.setdefault('USER_CACHE_BACKEND', None)
+
+        self.ttl = app.config['USER_CACHE_TTL']
+        self.backend = LRUCache(maxsize=app.config['USER_CACHE_SIZE'],
+                                ttl=self.ttl)
+        if app.config['USER_CACHE_BACKEND'] is not None:
+            self.backend = TieredCache(self.backend,
+                                       app.config['USER_CACHE_BACKEND'])
+
+    @staticmethod
+    def key(user_id):
+        return f'user:{user_id}'
+
+    def get(self, user_id):
+        """Get user `user_id` attached to the current session, or None."""
+
+        if not self.ttl:
+            return User.query.get(user_id)
+
+        snapshot = self.backend.get(self.key(user_id))
+        if snapshot is not None:
+            user = User(**snapshot)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+
+        user = User.query.get(user_id)
+        if user is not None:
+            self.backend.set(self.key(user_id),
+                             {col: getattr(user, col) for col in CACHED_COLUMNS})
+        return user
+
+    def invalidate(self, user_id):
+        if self.backend is not None:
+            self.backend.delete(self.key(user_id))
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+
+user_cache = UserCache()
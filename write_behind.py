@@ -0,0 +1,476 @@
+"""Write-behind queue for follows and likes.
+
+With `WRITE_BEHIND_ENABLED`, following, unfollowing and liking don't
+commit to the database on the request thread. The request appends an
+op to a local SQLite file in WAL mode (an append without an fsync, so
+it costs microseconds), and a background worker takes ops off the queue
+in batches and applies each batch in a single database transaction.
+Under a burst of clicks that's one commit per batch instead of one per
+click, and request latency no longer waits on the database at all.
+
+Ops record the state asked for ("5050 likes 17: yes"), not a toggle, so
+applying one twice does nothing new. That makes recovery simple: ops
+are only removed from the queue after their batch has committed, and
+anything still there after a crash is applied again on the next start.
+
+Until an op is applied, `User.is_following`, `following_status` and
+`liked_among` lay the user's pending ops over what the database says,
+so people see their own writes straight away. Counters (follower and
+like counts) catch up when the batch lands.
+
+Every process on a host shares the queue file. A lock file makes sure
+only one of them drains it at a time, which keeps ops for the same
+(user, target) pair in order.
+
+The queue is per host, and so is read-your-writes: a request served by
+another host doesn't see ops queued here until their batch commits
+(normally within WRITE_BEHIND_INTERVAL). Behind a load balancer, keep
+each user on one host (sticky sessions) for as long as their ops can
+be pending.
+
+An op that fails for its own reasons (anything but the database being
+unreachable) is retried with backoff, and after
+WRITE_BEHIND_MAX_ATTEMPTS tries it moves to the `dead_ops` table for
+someone to look at. Ops for other (user, target) pairs carry on past it.
+"""
+
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+from time import perf_counter, sleep, time
+
+from sqlalchemy.exc import (DisconnectionError, IntegrityError,
+                            InterfaceError, OperationalError)
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+KINDS = ('follow', 'like')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ops (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ops_user ON ops (kind, user_id, target_id);
+CREATE TABLE IF NOT EXISTS dead_ops (
+    seq INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    target_id INTEGER NOT NULL,
+    state INTEGER NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    failed REAL NOT NULL,
+    error TEXT NOT NULL
+);
+"""
+
+# The database itself being unavailable: retry the whole batch, and
+# don't count it against the ops in it.
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, DisconnectionError)
+
+batch_seconds = REGISTRY.histogram(
+    'warbler_write_behind_batch_seconds',
+    'Time spent applying one batch of queued writes.')
+
+batch_lag_seconds = REGISTRY.histogram(
+    'warbler_write_behind_lag_seconds',
+    'Age of the oldest op in a batch when the batch committed.',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+
+class WriteBehindQueue:
+    """Durable local queue of follow and like ops, drained in batches."""
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.batch_size = 500
+        self.interval = 0.05
+        self.max_attempts = 5
+        self.retry_seconds = 1.0
+        self._app = None
+        self._recovered = None
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._worker = None
+        self._start_lock = threading.Lock()
+
+        REGISTRY.gauge('warbler_write_behind_queue_depth',
+                       'Ops waiting to be written to the database.',
+                       function=self.depth)
+        self._applied = REGISTRY.counter(
+            'warbler_write_behind_applied_total',
+            'Queued ops written to the database.',
+            labels=('kind',))
+        self._dropped = REGISTRY.counter(
+            'warbler_write_behind_dropped_total',
+            'Queued ops that could not be applied (e.g. the message was '
+            'deleted first).',
+            labels=('kind',))
+        self._dead = REGISTRY.counter(
+            'warbler_write_behind_dead_total',
+            'Queued ops moved to dead_ops after failing too many times.',
+            labels=('kind',))
+
+    def init_app(self, app):
+        app.config.setdefault('WRITE_BEHIND_ENABLED', False)
+        app.config.setdefault('WRITE_BEHIND_PATH',
+                              os.path.join(app.instance_path,
+                                           'write_behind.sqlite3'))
+        app.config.setdefault('WRITE_BEHIND_BATCH_SIZE', 500)
+        # How long the worker waits for more ops before writing a batch.
+        app.config.setdefault('WRITE_BEHIND_INTERVAL', 0.05)
+        # Tries before a failing op goes to dead_ops; the wait between
+        # them doubles from WRITE_BEHIND_RETRY_SECONDS.
+        app.config.setdefault('WRITE_BEHIND_MAX_ATTEMPTS', 5)
+        app.config.setdefault('WRITE_BEHIND_RETRY_SECONDS', 1.0)
+
+        self._app = app
+        self.enabled = app.config['WRITE_BEHIND_ENABLED']
+        self.path = app.config['WRITE_BEHIND_PATH']
+        self.batch_size = app.config['WRITE_BEHIND_BATCH_SIZE']
+        self.interval = app.config['WRITE_BEHIND_INTERVAL']
+        self.max_attempts = app.config['WRITE_BEHIND_MAX_ATTEMPTS']
+        self.retry_seconds = app.config['WRITE_BEHIND_RETRY_SECONDS']
+
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            # Not here: app servers fork after importing the app, and
+            # neither the SQLite connection nor the worker thread would
+            # survive that.
+            app.before_request(self._recover)
+
+    def _recover(self):
+        """Once per process: drain ops left over from a crash or restart."""
+
+        if self._recovered == os.getpid():
+            return
+        self._recovered = os.getpid()
+        if self.depth():
+            self._start_worker()
+            self._wake.set()
+
+    ##########################################################################
+    # Request side
+
+    def enqueue(self, kind, user_id, target_id, state):
+        """Queue "`user_id` follows/likes `target_id`: `state`"."""
+
+        assert kind in KINDS
+        self._connection().execute(
+            "INSERT INTO ops (kind, user_id, target_id, state, created) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (kind, user_id, target_id, int(bool(state)), time()))
+
+        self._start_worker()
+        self._wake.set()
+
+    def pending(self, kind, user_id, target_ids=None):
+        """`user_id`'s queued `kind` ops, as {target_id: state}.
+
+        Only the latest op per target counts. With `target_ids`, only
+        those targets are looked at.
+        """
+
+        if not self.enabled:
+            return {}
+
+        sql = ("SELECT target_id, state FROM ops "
+               "WHERE kind = ? AND user_id = ?")
+        params = [kind, user_id]
+        if target_ids is not None:
+            target_ids = list(target_ids)
+            if not target_ids:
+                return {}
+            sql += f" AND target_id IN ({', '.join('?' * len(target_ids))})"
+            params += target_ids
+
+        rows = self._connection().execute(sql + " ORDER BY seq", params)
+        return {target_id: bool(state) for target_id, state in rows}
+
+    def overlay(self, kind, user_id, found, target_ids=None):
+        """Apply `user_id`'s pending ops to `found`, a set of target ids
+        the database says are on."""
+
+        for target_id, state in self.pending(kind, user_id, target_ids).items():
+            if state:
+                found.add(target_id)
+            else:
+                found.discard(target_id)
+        return found
+
+    def depth(self):
+        if not self.enabled:
+            return 0
+        return self._connection().execute("SELECT count(*) FROM ops").fetchone()[0]
+
+    def dead_ops(self):
+        """Ops given up on, oldest first, as dicts."""
+
+        if not self.enabled:
+            return []
+        cursor = self._connection().execute(
+            "SELECT * FROM dead_ops ORDER BY seq")
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    ##########################################################################
+    # Worker side
+
+    def flush(self):
+        """Apply everything queued so far, on this thread.
+
+        Needs an app context. Used by `flask flush-writes` and tests.
+        """
+
+        if not self.enabled:
+            return 0
+
+        applied = 0
+        with self._drain_lock(blocking=True):
+            while True:
+                count = self._apply_batch()
+                if not count:
+                    return applied
+                applied += count
+
+    def _start_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name='write-behind', daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        from models import db
+
+        with self._app.app_context():
+            while True:
+                self._wake.wait(self._retry_due())
+                # Let a burst pile up so it goes in as one batch.
+                sleep(self.interval)
+                self._wake.clear()
+
+                try:
+                    with self._drain_lock(blocking=False) as locked:
+                        if locked:
+                            while self._apply_batch() == self.batch_size:
+                                pass
+                        else:
+                            # Another process is draining; check back.
+                            self._wake.set()
+                except Exception:
+                    log.exception("write-behind batch failed; will retry")
+                    sleep(1)
+                    self._wake.set()
+                finally:
+                    # Hand the connection back to the pool between batches.
+                    db.session.remove()
+
+    def _apply_batch(self):
+        """Apply up to `batch_size` ops in one transaction; returns how many."""
+
+        # Imported here: models imports this module for the read overlay.
+        from models import db
+
+        conn = self._connection()
+        ops = conn.execute(
+            "SELECT seq, kind, user_id, target_id, state, created FROM ops "
+            "WHERE not_before <= ? ORDER BY seq LIMIT ?",
+            (time(), self.batch_size)).fetchall()
+        if not ops:
+            return 0
+
+        started = perf_counter()
+
+        # Only the last op for each (kind, user, target) matters.
+        latest = {}
+        for seq, kind, user_id, target_id, state, created in ops:
+            latest[(kind, user_id, target_id)] = (seq, bool(state))
+
+        done, failed = [], []
+        try:
+            for (kind, user_id, target_id), (seq, state) in latest.items():
+                # A savepoint each, so one bad op doesn't sink the batch.
+                savepoint = db.session.begin_nested()
+                try:
+                    APPLY[kind](user_id, target_id, state)
+                    savepoint.commit()
+                    self._applied.inc(1, kind)
+                except IntegrityError:
+                    savepoint.rollback()
+                    self._dropped.inc(1, kind)
+                    log.warning("dropping %s %s -> %s: target is gone",
+                                kind, user_id, target_id)
+                except TRANSIENT_ERRORS:
+                    raise
+                except Exception as e:
+                    savepoint.rollback()
+                    log.exception("write-behind %s %s -> %s failed",
+                                  kind, user_id, target_id)
+                    failed.append((kind, user_id, target_id, seq, repr(e)))
+                    continue
+                done.append((kind, user_id, target_id, seq))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        # Only now is it safe to forget them -- along with any older ops
+        # for the same pair that were waiting to be retried.
+        conn.executemany(
+            "DELETE FROM ops WHERE kind = ? AND user_id = ? "
+            "AND target_id = ? AND seq <= ?", done)
+        for op in failed:
+            self._retry_later(conn, *op)
+
+        batch_seconds.observe(perf_counter() - started)
+        batch_lag_seconds.observe(time() - ops[0][5])
+        return len(ops)
+
+    def _retry_later(self, conn, kind, user_id, target_id, seq, error):
+        """Back off a failed op (and the older ones for its pair), or
+        give up on it after `max_attempts` tries."""
+
+        now = time()
+        key = (kind, user_id, target_id, seq)
+        with conn:
+            conn.execute(
+                "UPDATE ops SET attempts = attempts + 1, "
+                "not_before = ? * (1 << attempts) + ? "
+                "WHERE kind = ? AND user_id = ? AND target_id = ? "
+                "AND seq <= ?", (self.retry_seconds, now) + key)
+            dead = ("FROM ops WHERE kind = ? AND user_id = ? "
+                    "AND target_id = ? AND seq <= ? AND attempts >= ?")
+            moved = conn.execute(
+                "INSERT INTO dead_ops SELECT seq, kind, user_id, target_id, "
+                f"state, created, attempts, ?, ? {dead}",
+                (now, error) + key + (self.max_attempts,)).rowcount
+            conn.execute(f"DELETE {dead}", key + (self.max_attempts,))
+
+        if moved:
+            self._dead.inc(moved, kind)
+            log.error("write-behind %s %s -> %s moved to dead_ops after "
+                      "%d attempts", kind, user_id, target_id,
+                      self.max_attempts)
+
+    def _retry_due(self):
+        """Seconds until the next backed-off op may run, or None."""
+
+        if not self.enabled:
+            return None
+        due = self._connection().execute(
+            "SELECT min(not_before) FROM ops WHERE not_before > 0"
+        ).fetchone()[0]
+        return None if due is None else max(due - time(), 0)
+
+    ##########################################################################
+    # Plumbing
+
+    def _connection(self):
+        """This thread's connection to the queue file.
+
+        Opened on first use, and again after a fork: a SQLite connection
+        mustn't be used from a process other than the one that opened
+        it.
+        """
+
+        conn = getattr(self._local, 'conn', None)
+        if (conn is None or self._local.path != self.path
+                or self._local.pid != os.getpid()):
+            # Autocommit: each enqueue is its own (tiny) transaction.
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL survives a process crash; only losing power
+            # before the next checkpoint can lose the newest ops.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.path = self.path
+            self._local.pid = os.getpid()
+        return conn
+
+    def _drain_lock(self, blocking):
+        return _FileLock(self.path + '.lock', blocking)
+
+    def clear(self):
+        """Forget every queued op without applying it."""
+
+        if self.enabled:
+            self._connection().execute("DELETE FROM ops")
+
+
+class _FileLock:
+    """An flock on `path`; `as` gives whether it was acquired."""
+
+    def __init__(self, path, blocking):
+        self.path = path
+        self.blocking = blocking
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        flags = fcntl.LOCK_EX | (0 if self.blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(self._file, flags)
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+##############################################################################
+# Applying ops; each must be a no-op when the state already holds.
+
+def _apply_follow(follower_id, followed_id, following):
+    from models import db, Follows
+    import timeline
+
+    follow = Follows.query.get((followed_id, follower_id))
+    if following and follow is None:
+        db.session.add(Follows(user_being_followed_id=followed_id,
+                               user_following_id=follower_id))
+        db.session.flush()
+        timeline.backfill(follower_id, followed_id)
+    elif not following and follow is not None:
+        db.session.delete(follow)
+        db.session.flush()
+        timeline.remove_author(follower_id, followed_id)
+
+
+def _apply_like(user_id, message_id, liked):
+    from models import Likes
+
+    Likes.set(user_id, message_id, liked)
+
+
+APPLY = {
+    'follow': _apply_follow,
+    'like': _apply_like,
+}
+
+
+write_queue = WriteBehindQueue()